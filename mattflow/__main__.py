@@ -15,9 +15,11 @@ import os
 
 import click
 
-from mattflow import (config as conf,
+from mattflow import (benchmark,
+                      config as conf,
                       logger,
                       mattflow_post,
+                      memory_planner,
                       mattflow_solver,
                       utils)
 from mattflow.utils import time_this
@@ -36,6 +38,12 @@ def _configure(**kwargs):
     conf.FPS = kwargs.get("fps", 18)
     conf.DPI = kwargs.get("dpi", 75)
     conf.FIG_HEIGHT = kwargs.get("fig_height", 18)
+    conf.LIVE_PREVIEW = kwargs.get("preview", False)
+    conf.PROFILE = kwargs.get("profile", False)
+    conf.AUTOTUNE = kwargs.get("autotune", False)
+    memory_limit = kwargs.get("memory_limit")
+    if memory_limit:
+        conf.MEMORY_LIMIT = memory_planner.parse_size(memory_limit)
 
     if conf.SAVE_ANIMATION:
         save_dir = input("save directory: ")
@@ -44,14 +52,14 @@ def _configure(**kwargs):
         conf.SAVE_DIR = save_dir
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option('-m', "--mode", default="drops", show_default=True,
               type=click.Choice(["drop", "drops", "rain"],
                                 case_sensitive=False))
 @click.option('-d', "--drops", type=click.INT, default=5, show_default=True,
               help="number of drops to generate")
 @click.option('-s', "--style", default="wireframe", show_default=True,
-              type=click.Choice(["water", "contour", "wireframe"],
+              type=click.Choice(["water", "contour", "wireframe", "raster"],
                                 case_sensitive=False))
 @click.option("--rotation/--no-rotation", default=True, show_default=True,
               help="rotate the domain")
@@ -59,25 +67,112 @@ def _configure(**kwargs):
 @click.option("--show/--no-show", default=True, show_default=True)
 @click.option("--save", is_flag=True)
 @click.option("--format", default="mp4", show_default=True,
-              type=click.Choice(["mp4", "gif"], case_sensitive=False))
+              type=click.Choice(["mp4", "gif", "png"], case_sensitive=False))
 @click.option("--fps", type=click.INT, default=18, show_default=True)
 @click.option("--dpi", type=click.INT, default=75, show_default=True)
 @click.option("--fig-height", type=click.INT, default=18, show_default=True,
               help="figure height (width is 1.618 * height)")
+@click.option("--preview", is_flag=True,
+              help="show the solution live, while it is computed")
+@click.option("--profile", is_flag=True,
+              help="time the phases of the solver and save a Chrome trace")
+@click.option("--autotune", is_flag=True,
+              help="pick the fastest number of workers for the grid")
+@click.option("--memory-limit", default=None,
+              help="e.g. 4G: fit the storage of the frames to the limit")
+@click.option("--dry-run", is_flag=True,
+              help="print the memory plan of the run, without running it")
+@click.pass_context
+def main(ctx, **kwargs):
+    """Runs a simulation (or one of the COMMANDS)."""
+    if ctx.invoked_subcommand is None:
+        _simulate(**kwargs)
+
+
 @time_this
-def main(**kwargs):
+def _simulate(**kwargs):
     _configure(**kwargs)
     # Uncomment this to delete previous log, dat and png files (for debugging).
     # utils.delete_prev_runs_data()
 
     # Pre-processing (mesh construction)
     utils.preprocessing(kwargs.get("mode", "drops"))
+    if kwargs.get("dry_run"):
+        _dry_run()
+        return
 
     # Solution
-    h_hist, t_hist, U_ds = mattflow_solver.simulate()
+    result = mattflow_solver.simulate()
+    print("\n".join(result.summary))
 
     # Post-processing
-    mattflow_post.animate(h_hist, t_hist)
+    mattflow_post.animate(result.h_hist, result.t_hist)
+
+
+def _dry_run():
+    """Prints the memory plan (fitted to the memory limit, if there is one).
+    """
+    if conf.MEMORY_LIMIT:
+        try:
+            plan, changes = memory_planner.fit(conf.MEMORY_LIMIT)
+        except MemoryError as err:
+            print(err)
+            plan, changes = memory_planner.MemoryPlan(), []
+        for change in changes:
+            print(f"Memory limit: {change}")
+    else:
+        plan = memory_planner.MemoryPlan()
+    print("\n".join(plan.lines()))
+
+
+@main.command("render-dats")
+@click.argument("data_dir", type=click.Path(exists=True, file_okay=False))
+@click.option('-s', "--style", default="wireframe", show_default=True,
+              type=click.Choice(["water", "contour", "wireframe", "raster"],
+                                case_sensitive=False))
+@click.option("--rotation/--no-rotation", default=True, show_default=True,
+              help="rotate the domain")
+@click.option('-w', "--workers", type=click.INT, default=None,
+              help="rendering processes  [default: cpu count]")
+@click.option("--force", is_flag=True,
+              help="re-render the frames that have an up-to-date .png")
+def render_dats(data_dir, style, rotation, workers, force):
+    """Renders the solution*.dat files of DATA_DIR to session/*.png"""
+    conf.PLOTTING_STYLE = style
+    conf.ROTATION = rotation
+    mattflow_post.render_dats(data_dir, workers=workers, force=force)
+
+
+@main.command("bench")
+@click.option("--quick", is_flag=True, help="small grids and 3 repeats")
+@click.option('-k', "--select", default=None,
+              help="run only the cases whose name contains SELECT")
+@click.option('-w', "--workers", default="1,2,4", show_default=True,
+              help="worker counts of the parallel flux")
+@click.option('-o', "--output", default="mattflow_bench.json",
+              show_default=True, type=click.Path(dir_okay=False),
+              help="the report")
+@click.option("--baseline", default=None,
+              type=click.Path(exists=True, dir_okay=False),
+              help="a previous report to compare against")
+@click.option("--tolerance", type=click.FLOAT, default=0.2,
+              show_default=True, help="slow-down that counts as a regression")
+@click.pass_context
+def bench(ctx, quick, select, workers, output, baseline, tolerance):
+    """Benchmarks the solver, I/O and rendering paths"""
+    workers = tuple(int(w) for w in workers.split(','))
+    report = benchmark.run(quick=quick, select=select, workers=workers)
+    benchmark.save_report(report, output)
+    print(f"Report saved at: {output}")
+    if baseline is None:
+        return
+    regressions = benchmark.compare(report, benchmark.load_report(baseline),
+                                    tolerance)
+    for name, ratio in regressions:
+        print(f"Regression: {name} is {ratio:.2f}x slower")
+    if regressions:
+        ctx.exit(1)
+    print(f"No regressions against {baseline}")
 
 
 if __name__ == "__main__":
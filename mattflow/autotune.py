@@ -0,0 +1,162 @@
+# autotune.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Picks the fastest parallel configuration of the flux, for the machine and
+the grid, before the simulation."""
+
+# candidates: {WORKERS: 1}, {WORKERS: 2, DUMP_MEMMAP: False},
+#             {WORKERS: 2, DUMP_MEMMAP: True}, {WORKERS: 4, ...}, ...
+#
+# Every candidate evaluates the flux of the initial state of the actual grid
+# for a few steps (after a warm-up step). The fastest one is applied and
+# cached at AUTOTUNE_CACHE, keyed by (machine fingerprint, Nx x Ny, solver),
+# so that the next runs skip the measurements.
+
+import hashlib
+import json
+import os
+import statistics
+from timeit import default_timer as timer
+
+from mattflow import config as conf, flux, logger, utils
+
+# The configuration options that are tuned
+_TUNED = ("WORKERS", "DUMP_MEMMAP")
+
+
+def machine_fingerprint():
+    """Short hash of the machine and of the numerical stack."""
+    info = json.dumps(utils.machine_info(), sort_keys=True)
+    return hashlib.sha1(info.encode()).hexdigest()[:12]
+
+
+def cache_key():
+    return f"{machine_fingerprint()}|{conf.Nx}x{conf.Ny}|{conf.SOLVER_TYPE}"
+
+
+def candidates(max_workers=None):
+    """The configurations to be measured.
+
+    Args:
+        max_workers (int) : default: the cpu count
+
+    Returns:
+        candidates (list) : dicts of configuration options
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    workers = [1]
+    while workers[-1] * 2 <= max_workers:
+        workers.append(workers[-1] * 2)
+    if workers[-1] != max_workers:
+        workers.append(max_workers)
+    candidates = [{"WORKERS": 1, "DUMP_MEMMAP": False}]
+    for w in workers[1:]:
+        candidates.append({"WORKERS": w, "DUMP_MEMMAP": False})
+        candidates.append({"WORKERS": w, "DUMP_MEMMAP": True})
+    return candidates
+
+
+def measure(U, candidate, steps=5, budget=None):
+    """Median duration of a flux evaluation with the <candidate>
+    configuration.
+
+    Args:
+        U (3D array)     : the state variables
+        candidate (dict) : configuration options
+        steps (int)      : timed evaluations (after a warm-up one)
+        budget (float)   : stop early, if an evaluation is slower (sec)
+
+    Returns:
+        duration (float) : inf, if it exceeded the budget
+    """
+    for name, value in candidate.items():
+        setattr(conf, name, value)
+    try:
+        flux.flux(U)
+        durations = []
+        for _ in range(steps):
+            start = timer()
+            flux.flux(U)
+            durations.append(timer() - start)
+            if budget is not None and durations[-1] > budget:
+                return float("inf")
+    finally:
+        if conf.DUMP_MEMMAP and conf.WORKERS > 1:
+            utils.delete_memmap()
+    return statistics.median(durations)
+
+
+def tune(U, steps=5, max_workers=None):
+    """Measures the candidates and returns the fastest one.
+
+    Returns:
+        best (dict)    : configuration options
+        timings (list) : (candidate, duration) pairs
+    """
+    snapshot = {name: getattr(conf, name) for name in _TUNED}
+    timings = []
+    best, best_time = None, float("inf")
+    try:
+        for candidate in candidates(max_workers):
+            # Candidates 3x slower than the best one are dropped early.
+            duration = measure(U, candidate, steps, budget=3 * best_time)
+            timings.append((candidate, duration))
+            if duration < best_time:
+                best, best_time = candidate, duration
+    finally:
+        utils.restore_config(snapshot)
+    return best, timings
+
+
+def _load_cache():
+    try:
+        with open(conf.AUTOTUNE_CACHE, 'r') as fr:
+            return json.load(fr)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _save_cache(cache):
+    tmp_path = conf.AUTOTUNE_CACHE + ".tmp"
+    with open(tmp_path, 'w') as fw:
+        json.dump(cache, fw, indent=2)
+    os.replace(tmp_path, conf.AUTOTUNE_CACHE)
+
+
+def autotune(U):
+    """Applies the fastest configuration for the current grid and solver,
+    from the cache or by measuring the candidates.
+
+    Args:
+        U (3D array) : the initial state variables
+
+    Returns:
+        best (dict) : the applied configuration options
+    """
+    key = cache_key()
+    cache = _load_cache()
+    if key in cache:
+        best = cache[key]["config"]
+        source = "cached"
+    else:
+        best, timings = tune(U, conf.AUTOTUNE_STEPS)
+        cache[key] = {
+            "config": best,
+            "timings_ms": [[candidate, 1e3 * duration]
+                           for candidate, duration in timings]
+        }
+        _save_cache(cache)
+        source = "measured"
+    for name, value in best.items():
+        setattr(conf, name, value)
+    logger.log("Auto-tuned (" + source + "): "
+               + ", ".join(f"{name}={value}" for name, value in best.items()))
+    return best
@@ -0,0 +1,272 @@
+# benchmark.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Benchmarks the solver, I/O and rendering paths (mattflow bench)."""
+
+# Every case is a setup function that configures the domain and returns the
+# callable to be timed. The callable is called once to warm up (compiling the
+# numba kernels) and then <repeat> times, keeping the median.
+#
+# Scaling of the parallel flux:
+# - strong : fixed grid, more workers     efficiency = t_1 / (w * t_w)
+# - weak   : cells per worker fixed       efficiency = t_1 / t_w
+#
+# Comparing against a baseline report, a case is a regression if its median
+# is slower than the baseline's by more than the tolerance.
+
+from datetime import datetime
+import json
+import math
+import os
+import shutil
+import statistics
+import tempfile
+from timeit import default_timer as timer
+
+import numpy as np
+
+from mattflow import (bcmanager,
+                      config as conf,
+                      dat_writer,
+                      exporter,
+                      flux,
+                      frame_history,
+                      initializer,
+                      mattflow_post,
+                      mattflow_solver,
+                      raster,
+                      utils,
+                      __version__)
+
+
+def _domain(N, workers=1):
+    """Configures an N x N domain and returns an initialized U."""
+    utils.preprocessing("drops", N=N)
+    conf.WORKERS = workers
+    conf.DUMP_MEMMAP = False
+    conf.WRITE_DAT = False
+    return initializer._init_U()
+
+
+def _flux_case(N, workers):
+    U = _domain(N, workers)
+    return lambda: flux.flux(U)
+
+
+def _cfl_case(N):
+    U = _domain(N)
+    return lambda: mattflow_solver._dt(U)
+
+
+def _ghost_cells_case(N):
+    U = _domain(N)
+    return lambda: bcmanager.update_ghost_cells(U)
+
+
+def _drop_case(N):
+    h = _domain(N)[0].copy()
+    return lambda: initializer.drop(h)
+
+
+def _dat_writer_case(N):
+    U = _domain(N)
+    frame = U[0, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng]
+    return lambda: dat_writer.write_dat(frame, time=0, it=1)
+
+
+def _history_case(N, storage, frames=32):
+    frame = _domain(N)[0, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng]
+
+    def append_frames():
+        if storage == "spill":
+            h_hist = frame_history.SpillHistory(frame.shape, chunk_frames=8,
+                                                ram_chunks=0)
+        else:
+            h_hist = frame_history.CompressedHistory(frame.shape,
+                                                     chunk_frames=8)
+        for _ in range(frames):
+            h_hist.append(frame)
+        if storage == "compressed":
+            h_hist.flush()
+    return append_frames
+
+
+def _render_case(N, style):
+    frame = _domain(N)[0, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng]
+    conf.PLOTTING_STYLE = style
+    conf.DPI = 60
+    conf.FIG_HEIGHT = 6
+    if style == "raster":
+        renderer = raster.raster_renderer(conf.FIG_HEIGHT * conf.DPI)
+        return lambda: renderer.render(frame)
+    renderer = mattflow_post.FrameRenderer()
+    return lambda: renderer.render(frame, 0)
+
+
+def _export_case(N, frames=16):
+    frame = _domain(N)[0, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng]
+    h_hist = np.repeat(frame[None], frames, axis=0)
+    conf.PLOTTING_STYLE = "raster"
+    conf.DPI = 60
+    conf.FIG_HEIGHT = 6
+    conf.FPS = 18
+    conf.VID_FORMAT = "mp4"
+    conf.SAVE_GIF = True
+    conf.FRAME_CACHE = None
+    conf.SAVE_DIR = os.getcwd()
+    return lambda: exporter.save_animation(h_hist)
+
+
+def _weak_N(N, workers):
+    """Grid size that keeps the cells per worker of an N x N grid."""
+    return int(round(N * math.sqrt(workers)))
+
+
+def cases(quick=False, workers=(1, 2, 4)):
+    """Lists the benchmark cases.
+
+    Args:
+        quick (bool)    : small grids only
+        workers (tuple) : worker counts of the parallel flux
+
+    Returns:
+        cases (list) : (name, setup) pairs
+    """
+    sizes = (100, 200) if quick else (100, 200, 400)
+    scaling_N = 200 if quick else 400
+    small = sizes[0]
+    cases = []
+    for N in sizes:
+        for w in workers:
+            cases.append((f"flux/N{N}/w{w}",
+                          lambda N=N, w=w: _flux_case(N, w)))
+        cases.append((f"cfl/N{N}", lambda N=N: _cfl_case(N)))
+        cases.append((f"ghost_cells/N{N}", lambda N=N: _ghost_cells_case(N)))
+        cases.append((f"drop/N{N}", lambda N=N: _drop_case(N)))
+    cases.append((f"dat_writer/N{small}", lambda: _dat_writer_case(small)))
+    for storage in ("spill", "compressed"):
+        cases.append((f"history/{storage}/N{sizes[-1]}",
+                      lambda s=storage: _history_case(sizes[-1], s)))
+    for style in ("raster", "wireframe"):
+        cases.append((f"render/{style}/N{small}",
+                      lambda s=style: _render_case(small, s)))
+    if shutil.which(conf.PATH_TO_FFMPEG):
+        cases.append((f"export/N{small}", lambda: _export_case(small)))
+    for w in workers:
+        cases.append((f"scaling/strong/w{w}",
+                      lambda w=w: _flux_case(scaling_N, w)))
+        cases.append((f"scaling/weak/w{w}",
+                      lambda w=w: _flux_case(_weak_N(small, w), w)))
+    return cases
+
+
+def measure(func, repeat=5):
+    """Times <func> (after a warm-up call).
+
+    Returns:
+        stats (dict) : median, min and max duration (sec) and repeat
+    """
+    func()
+    durations = []
+    for _ in range(repeat):
+        start = timer()
+        func()
+        durations.append(timer() - start)
+    return {"median_s": statistics.median(durations),
+            "min_s": min(durations),
+            "max_s": max(durations),
+            "repeat": repeat}
+
+
+def scaling_efficiency(results):
+    """Strong and weak scaling efficiency of the parallel flux, per worker
+    count."""
+    efficiency = {}
+    for kind in ("strong", "weak"):
+        times = {int(name.rsplit("/w", 1)[1]): stats["median_s"]
+                 for name, stats in results.items()
+                 if name.startswith(f"scaling/{kind}/")}
+        if 1 not in times:
+            continue
+        efficiency[kind] = {
+            str(w): (times[1] / (w * t) if kind == "strong" else times[1] / t)
+            for w, t in sorted(times.items())
+        }
+    return efficiency
+
+
+def run(quick=False, select=None, workers=(1, 2, 4), repeat=None):
+    """Runs the benchmark cases, at a temporary working directory.
+
+    Args:
+        quick (bool)    : small grids and 3 repeats
+        select (str)    : run only the cases whose name contains it
+        workers (tuple) : worker counts of the parallel flux
+        repeat (int)    : timed calls per case (default: 3 if quick, else 5)
+
+    Returns:
+        report (dict) : machine-readable report (see save_report())
+    """
+    repeat = repeat or (3 if quick else 5)
+    snapshot = utils.config_snapshot()
+    cwd = os.getcwd()
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            conf.HISTORY_DIR = os.path.join(tmp_dir, "history")
+            for name, setup in cases(quick, workers):
+                if select and select not in name:
+                    continue
+                results[name] = measure(setup(), repeat)
+                print(f"{name:<32}{results[name]['median_s'] * 1e3:>10.3f} ms")
+    finally:
+        os.chdir(cwd)
+        utils.restore_config(snapshot)
+    return {
+        "version": __version__,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "machine": utils.machine_info(),
+        "results": results,
+        "scaling": scaling_efficiency(results)
+    }
+
+
+def save_report(report, path):
+    with open(path, 'w') as fw:
+        json.dump(report, fw, indent=2)
+
+
+def load_report(path):
+    with open(path, 'r') as fr:
+        return json.load(fr)
+
+
+def compare(report, baseline, tolerance=0.2):
+    """Compares the medians of the common cases of two reports.
+
+    Args:
+        report (dict)     : the current report
+        baseline (dict)   : the report to compare against
+        tolerance (float) : slow-down that counts as a regression
+
+    Returns:
+        regressions (list) : (name, ratio) pairs, ratio = current / baseline
+    """
+    regressions = []
+    for name, stats in report["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        ratio = stats["median_s"] / base["median_s"]
+        if ratio > 1 + tolerance:
+            regressions.append((name, ratio))
+    return regressions
@@ -33,8 +33,15 @@ import numpy as np
 
 # Select whether a .log file will be generated or not.
 LOGGING_MODE = False
+# The log messages are buffered and written every <LOG_FLUSH_INTERVAL> sec,
+# or as soon as <LOG_BUFFER_RECORDS> messages are pending.
+LOG_FLUSH_INTERVAL = 1.
+LOG_BUFFER_RECORDS = 1024
 DTYPE = np.dtype("float32")
 
+# Unique id of the current run (set at the start of the simulation)
+RUN_ID = None
+
 
 # Pre-processing configuration {
 #
@@ -69,6 +76,13 @@ CY = None
 STOPPING_TIME = 30000
 MAX_ITERS = None
 
+# Steady state
+# Once no drops remain to fall, the run ends as soon as the max rate of change
+# of the state variables (max |dU/dt|) stays below <STEADY_STATE_TOL> for
+# <STEADY_STATE_PATIENCE> consecutive iterations (None: not used).
+STEADY_STATE_TOL = None
+STEADY_STATE_PATIENCE = 20
+
 # Saving <FRAMES_PER_PERIOD> frames every <FRAME_SAVE_FREQ> iters.
 # - resulting to a lighter animation (less fps)
 # - visualizing and debugging long simulations
@@ -76,6 +90,90 @@ MAX_ITERS = None
 FRAME_SAVE_FREQ = 3
 FRAMES_PER_PERIOD = 1
 
+# Output scheduling in simulated time
+# Instead of the above, a frame is saved every <OUTPUT_DT> of simulated time
+# and/or whenever the height has changed by more than <OUTPUT_MAX_CHANGE>
+# (max |dh|) since the last saved frame (None: not used). The storage of
+# h_hist is then preallocated from an estimate and grows, if needed.
+OUTPUT_DT = None
+OUTPUT_MAX_CHANGE = None
+
+# Temporal interpolation of the animation
+# Sparsely saved frames are resampled to uniform time spacing, with
+# <INTERP_FACTOR> animation frames per saved frame (1: no resampling), so a
+# higher FRAME_SAVE_FREQ can be used without a choppy animation.
+INTERP_FACTOR = 1
+
+# Storage of the saved frames (h_hist)
+# ------------------------------------
+# Options:
+# 1. 'ram'   : a preallocated array, sized from MAX_ITERS
+# 2. 'spill' : chunks of <HISTORY_CHUNK_FRAMES> frames, keeping the last
+#              <HISTORY_RAM_CHUNKS> completed chunks in RAM and spilling the
+#              older ones to a memory-mapped file under HISTORY_DIR
+# 3. 'compressed' : chunks of <HISTORY_CHUNK_FRAMES> frames, kept in RAM
+#                   quantized to <HISTORY_QUANT_BITS> (8 or 16) bits over
+#                   <HISTORY_QUANT_RANGE>, delta-encoded along time and
+#                   compressed with <HISTORY_CODEC> ('zlib', 'bz2', 'lzma') on
+#                   <HISTORY_COMPRESS_WORKERS> threads
+HISTORY_STORAGE = "ram"
+HISTORY_CHUNK_FRAMES = 64
+HISTORY_RAM_CHUNKS = 4
+HISTORY_DIR = os.path.join(os.getcwd(), "history")
+HISTORY_QUANT_RANGE = (0., 4.)
+HISTORY_QUANT_BITS = 16
+HISTORY_CODEC = "zlib"
+HISTORY_COMPRESS_WORKERS = 2
+
+# Mip pyramid of the chunked h_hist ('spill' or 'compressed')
+# Every chunk is also stored at <HISTORY_MIP_LEVELS> decimated levels (1/2,
+# 1/4, 1/8, ... resolution, reduced by LOD_MODE), so that the overviews and
+# the LOD of the 3D plots read only the level they need (0: no pyramid).
+HISTORY_MIP_LEVELS = 0
+
+# Profiling of the solver
+# -----------------------
+# Times the phases of every iteration (CFL, ghost cells, flux stages, drops,
+# frame saving, I/O) and saves a per-phase report (durations histogram) and a
+# Chrome trace (the first <PROFILE_MAX_EVENTS> intervals) under PROFILE_DIR.
+# When off, the timers cost a function call per phase.
+PROFILE = False
+PROFILE_DIR = os.path.join(os.getcwd(), "profile")
+PROFILE_MAX_EVENTS = 100000
+
+# Memory limit (bytes, None: no limit)
+# The peak memory of the run is planned from the configuration (see
+# memory_planner) and, if it exceeds the limit, h_hist is spilled to disk,
+# compressed or saved with a larger FRAME_SAVE_FREQ.
+MEMORY_LIMIT = None
+
+# Conservation diagnostics
+# ------------------------
+# The total mass, momentum and energy are computed every step and saved as a
+# time series under DIAGNOSTICS_DIR, along with a summary of the mass balance
+# (see diagnostics).
+DIAGNOSTICS = False
+DIAGNOSTICS_DIR = os.path.join(os.getcwd(), "diagnostics")
+
+# Probes
+# ------
+# h, u and v are sampled every step at the <PROBES> points, a list of (x, y)
+# inside the basin, by bilinear interpolation of the cell centers, and saved
+# at the end of the run as probes_<RUN_ID>.npz under PROBES_DIR (see probes).
+PROBES = None
+PROBES_DIR = os.path.join(os.getcwd(), "probes")
+
+# Field statistics
+# ----------------
+# The max height (and when it was reached), the arrival time (the first time
+# that the elevation exceeded <FIELD_STATS_THRESHOLD>) and the mean, std and
+# RMS elevation of every cell are accumulated every step, without the saved
+# frames, and saved as field_stats_<RUN_ID>.npz under FIELD_STATS_DIR (see
+# field_stats).
+FIELD_STATS = False
+FIELD_STATS_THRESHOLD = 0.01
+FIELD_STATS_DIR = os.path.join(os.getcwd(), "field_stats")
+
 # Number of workers for multiprocessing
 WORKERS = 1
 
@@ -83,6 +181,16 @@ WORKERS = 1
 DUMP_MEMMAP = False
 MEMMAP_DIR = os.path.join(os.getcwd(), "flux_memmap")
 
+# Auto-tuning
+# -----------
+# Before the simulation, the flux is evaluated for <AUTOTUNE_STEPS> steps with
+# a few WORKERS / DUMP_MEMMAP candidates, on the actual grid, and the fastest
+# one is used. The decision is cached at AUTOTUNE_CACHE, per machine, grid
+# size and solver.
+AUTOTUNE = False
+AUTOTUNE_STEPS = 5
+AUTOTUNE_CACHE = os.path.join(os.getcwd(), "mattflow_tune.json")
+
 # Courant number
 # --------------
 # dx * COURANT = 0.015 for a more realistic result, in the current fps range
@@ -149,8 +257,22 @@ BOUNDARY_CONDITIONS = 'reflective'
 # 3. 'MacCormack experimental'  : 2nd order in time: O(Δt^2, Δx^2, Δy^2)
 SOLVER_TYPE = '2-stage Runge-Kutta'
 
-# Select whether to save a memmap with the simulation data or not (for ML).
+# Select whether to save the simulation data or not (for ML).
 SAVE_DS_FOR_ML = False
+
+# Dataset format
+# --------------
+# Options:
+# 1. 'shards' : every <DS_STRIDE> iters, in shards of <DS_SHARD_SIZE> samples,
+#               each one with an index (iteration, time, is_drop), under
+#               DS_DIR (DS_DTYPE: 'float32' or 'float16')
+# 2. 'memmap' : a single .npy memmap, holding every iteration, with the drop
+#               iterations saved at a separate .npy
+DS_FORMAT = "memmap"
+DS_DIR = os.path.join(os.getcwd(), "mattflow_dataset")
+DS_STRIDE = 1
+DS_SHARD_SIZE = 256
+DS_DTYPE = "float32"
 #
 # }
 
@@ -158,9 +280,27 @@ SAVE_DS_FOR_ML = False
 # Post-processing configuration {
 #
 # Plotting style
-# Options: water, contour, wireframe
+# Options: water, contour, wireframe, raster
+# (raster: top-down shaded relief, rendered without matplotlib 3D, see raster)
 PLOTTING_STYLE = None
 
+# Raster style options
+# RASTER_CMAP: 'deep' or 'shallow' (see mattflow_cmaps)
+# RASTER_RANGE: heights mapped to the ends of the colormap
+# RASTER_SHADE: apply hillshading
+RASTER_CMAP = "deep"
+RASTER_RANGE = (0.5, 1.5)
+RASTER_SHADE = True
+
+# Level of detail (LOD) of the 3D plots
+# LOD: decimate the grid to the polygons that the frame can show
+# LOD_MODE: 'mean' (area-averaged) or 'max' (max-preserving, keeps crests)
+# LOD_PIXELS_PER_CELL: minimum pixels per plotted cell, along the frame
+#                      height (FIG_HEIGHT * DPI)
+LOD = False
+LOD_MODE = "mean"
+LOD_PIXELS_PER_CELL = 4
+
 # frames per sec
 FPS = None
 # dots per inch
@@ -191,16 +331,69 @@ SAVE_DIR = None
 # Path to ffmpeg
 PATH_TO_FFMPEG = '/usr/bin/ffmpeg'
 
+# Saving the animation
+# --------------------
+# The frames are rendered offscreen on <EXPORT_WORKERS> processes, in ranges
+# of <EXPORT_CHUNK_FRAMES> frames, and streamed to ffmpeg (1: rendered
+# in-process).
+EXPORT_WORKERS = 1
+EXPORT_CHUNK_FRAMES = 8
+
+# Rendered-frame cache
+# --------------------
+# Rendered frames are cached as compressed RGB, so that replaying or
+# re-exporting the animation of a run only encodes the frames.
+# The frames are keyed on their heights and the rendering options.
+# FRAME_CACHE: None, 'memory' or 'disk' (under FRAME_CACHE_DIR, shared among
+#              processes and runs), LRU, bounded to FRAME_CACHE_MB
+FRAME_CACHE = None
+FRAME_CACHE_MB = 512
+FRAME_CACHE_DIR = os.path.join(os.getcwd(), "frame_cache")
+
 # Animation video format
 # ----------------------
 # Supported:
 # 1. 'mp4'
 # 2. 'gif'
+# 3. 'png' : a sequence of .png frames
 VID_FORMAT = 'mp4'
 
+# Light gif
+# ---------
+# Besides the VID_FORMAT video, a downscaled gif is encoded from the same
+# stream of rendered frames (every frame is rendered once). The palette of
+# the gif is generated from <GIF_PALETTE_FRAMES> frames, sampled evenly.
+SAVE_GIF = False
+GIF_WIDTH = 240
+GIF_PALETTE_FRAMES = 16
+
 # Writing dat files mode
 # ----------------------
 # Select whether dat files are generated or not.
 WRITE_DAT = False
+
+# Asynchronous output pipeline
+# ----------------------------
+# With ASYNC_OUTPUT and WRITE_DAT, the frames are copied into a ring of
+# <OUTPUT_QUEUE_DEPTH> preallocated buffers and a writer thread drains them, so
+# that the solver does not wait on the disk and on matplotlib.
+#
+# OUTPUT_BACKPRESSURE options:
+# 1. 'block' : the solver waits for a free buffer
+# 2. 'drop'  : the frame is skipped, if all the buffers are in use
+#
+# The .png frames are rendered on a pool of <RENDER_WORKERS> processes
+# (1: rendered at the writer thread).
+ASYNC_OUTPUT = False
+OUTPUT_QUEUE_DEPTH = 8
+OUTPUT_BACKPRESSURE = "block"
+RENDER_WORKERS = 1
+
+# Live preview
+# ------------
+# The solver publishes the latest frame to a shared-memory slot, without
+# ever waiting, and a viewer process shows it at <PREVIEW_FPS> frames/sec.
+LIVE_PREVIEW = False
+PREVIEW_FPS = 15
 #
 # }
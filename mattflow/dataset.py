@@ -0,0 +1,310 @@
+# dataset.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Writes and reads the simulation data, used as a dataset for ML."""
+
+# Layout of a dataset directory (every run writes only its own files, so
+# many simulations can write into the same directory concurrently):
+#
+#   <DS_DIR>/
+#       <run_id>_00000.npy   : shard, shape (<= shard_size, 3, Ny, Nx)
+#       <run_id>_00000.json  : index of the shard (iteration, time, is_drop)
+#       <run_id>_00001.npy
+#       <run_id>_00001.json
+#       ...
+#
+# The index of a shard is written after the shard itself, so a shard is
+# visible to the readers only when it is complete.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import glob
+from itertools import islice
+import json
+import os
+import threading
+from timeit import default_timer as timer
+
+import numpy as np
+
+from mattflow import config as conf, utils
+
+
+def _atomic_write(path, write):
+    """Writes to a temporary file and renames it, so that readers never see
+    a partially written file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fw:
+        write(fw)
+    os.replace(tmp_path, path)
+
+
+class DatasetWriter:
+    """Writes the state variables every <stride> iters, in fixed-size shards.
+
+    Every stored sample is accompanied by its iteration, its time and the
+    is_drop flag, which is True if a drop fell after the previously stored
+    sample. Such a sample cannot be used as a label of the previous ones,
+    because the previous states cannot know when and where a new drop falls.
+
+    Args:
+        ds_dir (str)        : the dataset directory (shared among runs)
+        frame_shape (tuple) : shape of a sample, (3, Ny, Nx)
+        stride (int)        : store a sample every <stride> iters
+        shard_size (int)    : samples per shard
+        dtype (str)         : 'float32' or 'float16'
+        run_id (str)        : prefix of the shard files (default: unique)
+    """
+
+    def __init__(self, ds_dir, frame_shape, stride=1, shard_size=256,
+                 dtype="float32", run_id=None):
+        os.makedirs(ds_dir, exist_ok=True)
+        self.ds_dir = ds_dir
+        self.frame_shape = tuple(frame_shape)
+        self.stride = stride
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+        self.run_id = utils.new_run_id() if run_id is None else run_id
+        self.shards_written = 0
+        self.samples_written = 0
+        self._shard = np.empty((shard_size,) + self.frame_shape,
+                               dtype=self.dtype)
+        self._index = {"iteration": [], "time": [], "is_drop": []}
+        self._drop_pending = False
+
+    def __len__(self):
+        return self.samples_written
+
+    def write(self, U, it, time, is_drop=False):
+        """Stores U, if it is a multiple of the stride.
+
+        Args:
+            U (3D array)   : the state variables, without the ghost cells
+            it (int)       : current iteration
+            time (float)   : current time
+            is_drop (bool) : a drop fell at this iteration
+        """
+        self._drop_pending |= bool(is_drop)
+        if it % self.stride:
+            return
+        n = len(self._index["iteration"])
+        self._shard[n] = U
+        self._index["iteration"].append(int(it))
+        self._index["time"].append(float(time))
+        self._index["is_drop"].append(self._drop_pending)
+        self._drop_pending = False
+        self.samples_written += 1
+        if n + 1 == self.shard_size:
+            self._flush_shard()
+
+    def _flush_shard(self):
+        n = len(self._index["iteration"])
+        if n == 0:
+            return
+        name = f"{self.run_id}_{self.shards_written:05d}"
+        shard_path = os.path.join(self.ds_dir, name + ".npy")
+        _atomic_write(shard_path, lambda fw: np.save(fw, self._shard[:n]))
+        index = dict(run_id=self.run_id,
+                     shard=self.shards_written,
+                     file=name + ".npy",
+                     stride=self.stride,
+                     shape=[n, *self.frame_shape],
+                     dtype=self.dtype.name,
+                     **self._index)
+        index_path = os.path.join(self.ds_dir, name + ".json")
+        _atomic_write(index_path,
+                      lambda fw: fw.write(json.dumps(index).encode()))
+        self.shards_written += 1
+        self._index = {"iteration": [], "time": [], "is_drop": []}
+
+    def close(self):
+        """Writes the last, partially filled, shard."""
+        self._flush_shard()
+
+
+def dataset_writer(frame_shape):
+    """Creates a DatasetWriter, configured by the DS_* options."""
+    return DatasetWriter(conf.DS_DIR,
+                         frame_shape,
+                         stride=conf.DS_STRIDE,
+                         shard_size=conf.DS_SHARD_SIZE,
+                         dtype=conf.DS_DTYPE,
+                         run_id=conf.RUN_ID)
+
+
+def _shard_sources(ds_dir):
+    """Yields the (array, iterations, is_drop, stride) of every run in a
+    sharded dataset directory, concatenating the shards of the run."""
+    runs = {}
+    for index_path in sorted(glob.glob(os.path.join(ds_dir, "*.json"))):
+        with open(index_path, 'r') as fr:
+            index = json.load(fr)
+        runs.setdefault(index["run_id"], []).append(index)
+    for run_id in sorted(runs):
+        indices = sorted(runs[run_id], key=lambda index: index["shard"])
+        arrays = [np.load(os.path.join(ds_dir, index["file"]), mmap_mode='r')
+                  for index in indices]
+        yield (arrays,
+               np.concatenate([index["iteration"] for index in indices]),
+               np.concatenate([index["is_drop"] for index in indices]),
+               indices[0]["stride"])
+
+
+def _memmap_source(ds_path):
+    """Returns the (array, iterations, is_drop, stride) of a memmap dataset,
+    reading its drop iterations from the accompanying drop_iters_list."""
+    U_ds = np.load(ds_path, mmap_mode='r')
+    drop_iters_path = os.path.join(
+        os.path.dirname(ds_path),
+        os.path.basename(ds_path).replace("mattflow_data_", "drop_iters_list_")
+    )
+    iterations = np.arange(len(U_ds))
+    is_drop = np.isin(iterations, np.load(drop_iters_path))
+    return [U_ds], iterations, is_drop, 1
+
+
+def _sources(path):
+    if os.path.isfile(path):
+        return [_memmap_source(path)]
+    if glob.glob(os.path.join(path, "*.json")):
+        return list(_shard_sources(path))
+    return [_memmap_source(ds_path) for ds_path
+            in sorted(glob.glob(os.path.join(path, "mattflow_data_*.npy")))]
+
+
+class DatasetLoader:
+    """Yields batches of (U_t, U_{t+k}) input-label pairs.
+
+    A pair is used only if the label is k stored samples after the input, at
+    the same run, and no drop fell in between (a drop cannot be predicted).
+
+    Shuffling happens at chunk granularity: the pairs are split into chunks
+    of <chunk_size> consecutive inputs and the order of the chunks (as well
+    as the order inside every chunk) is shuffled, so that every batch reads
+    a few contiguous regions of the memmaps. Batches are loaded by a pool of
+    <workers> threads, <prefetch> batches ahead of the consumer.
+
+    Args:
+        path (str)       : a sharded dataset directory, a mattflow_data_*.npy
+                           memmap or a directory with memmaps
+        k (int)          : distance of the label from the input, in samples
+        batch_size (int) : number of pairs per batch
+        shuffle (bool)   : shuffle the chunks of pairs at every epoch
+        chunk_size (int) : consecutive pairs per chunk
+        prefetch (int)   : number of batches loaded ahead
+        workers (int)    : loading threads
+        dtype (str)      : dtype of the batches
+        seed (int)       : seed of the shuffling
+    """
+
+    def __init__(self, path, k=1, batch_size=32, shuffle=True, chunk_size=64,
+                 prefetch=4, workers=2, dtype="float32", seed=None):
+        self.k = k
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.workers = workers
+        self.dtype = np.dtype(dtype)
+        self._rng = np.random.default_rng(seed)
+
+        # Flat indexing of all the samples: (array id, index in the array)
+        self._arrays = []
+        array_ids, local_idxs, inputs = [], [], []
+        n_samples = 0
+        for arrays, iterations, is_drop, stride in _sources(path):
+            for array in arrays:
+                array_ids.append(np.full(len(array), len(self._arrays)))
+                local_idxs.append(np.arange(len(array)))
+                self._arrays.append(array)
+            drops = np.cumsum(is_drop)
+            contiguous = iterations[k:] - iterations[:-k] == k * stride
+            no_drop = drops[k:] - drops[:-k] == 0
+            inputs.append(n_samples + np.flatnonzero(contiguous & no_drop))
+            n_samples += len(iterations)
+        if not self._arrays:
+            raise FileNotFoundError(f"No mattflow dataset found at {path}")
+        self._array_ids = np.concatenate(array_ids)
+        self._local_idxs = np.concatenate(local_idxs)
+        self.inputs = np.concatenate(inputs)
+        self.sample_shape = self._arrays[0].shape[1:]
+
+        # stats
+        self._lock = threading.Lock()
+        self.samples = 0
+        self.load_time = 0.
+        self.elapsed = 0.
+
+    @property
+    def num_pairs(self):
+        return len(self.inputs)
+
+    def __len__(self):
+        return -(-self.num_pairs // self.batch_size)
+
+    def _order(self):
+        chunks = [self.inputs[i: i + self.chunk_size]
+                  for i in range(0, self.num_pairs, self.chunk_size)]
+        if self.shuffle:
+            self._rng.shuffle(chunks)
+            chunks = [self._rng.permutation(chunk) for chunk in chunks]
+        return np.concatenate(chunks) if chunks else self.inputs
+
+    def _gather(self, sample_idxs):
+        out = np.empty((len(sample_idxs),) + self.sample_shape,
+                       dtype=self.dtype)
+        # Read in storage order, for locality.
+        for j in np.argsort(sample_idxs, kind="stable"):
+            idx = sample_idxs[j]
+            out[j] = self._arrays[self._array_ids[idx]][self._local_idxs[idx]]
+        return out
+
+    def _load_batch(self, input_idxs):
+        start = timer()
+        batch = self._gather(input_idxs), self._gather(input_idxs + self.k)
+        with self._lock:
+            self.load_time += timer() - start
+        return batch
+
+    def __iter__(self):
+        order = self._order()
+        batches = iter([order[i: i + self.batch_size]
+                        for i in range(0, len(order), self.batch_size)])
+        start = timer()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                pending = deque(pool.submit(self._load_batch, batch)
+                                for batch in islice(batches, self.prefetch))
+                while pending:
+                    batch = pending.popleft().result()
+                    for next_batch in islice(batches, 1):
+                        pending.append(pool.submit(self._load_batch,
+                                                   next_batch))
+                    self.samples += len(batch[0])
+                    yield batch
+        finally:
+            self.elapsed += timer() - start
+
+    @property
+    def samples_per_sec(self):
+        """Delivered throughput (including the time spent by the consumer)."""
+        return self.samples / max(self.elapsed, 1e-9)
+
+    @property
+    def load_samples_per_sec(self):
+        """Loading throughput, per loading thread."""
+        return self.samples / max(self.load_time, 1e-9)
+
+    def report(self):
+        return (f"Dataset loader | pairs: {self.samples}"
+                f" | delivered: {self.samples_per_sec:.0f} samples/s"
+                f" | loading: {self.load_samples_per_sec:.0f}"
+                " samples/s/thread")
@@ -0,0 +1,165 @@
+# diagnostics.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Monitors the conservation of mass, momentum and energy, every step."""
+
+# After every step, a compiled kernel reduces the state variables of the
+# domain (without the ghost cells) in a single pass:
+#
+#   mass       = sum(h) dA
+#   momentum_x = sum(hu) dA
+#   momentum_y = sum(hv) dA
+#   energy     = sum(0.5 (hu^2 + hv^2) / h + 0.5 g h^2) dA
+#
+# The totals form a per-step time series (a structured array, saved as .npy).
+# The mass changes of the steps with a drop are attributed to the drops, so
+# that the drift of the rest of the steps measures the conservation error.
+
+import os
+
+import numba as nb
+import numpy as np
+
+from mattflow import config as conf, logger
+
+SERIES_DTYPE = np.dtype([("it", np.int64),
+                         ("time", np.float64),
+                         ("mass", np.float64),
+                         ("momentum_x", np.float64),
+                         ("momentum_y", np.float64),
+                         ("energy", np.float64),
+                         ("is_drop", np.bool_)])
+
+
+# compiled at the first call, for the U of the solver
+@nb.njit(nogil=True)
+def _totals(U, Ng, cell_area):
+    """Total mass, x and y momentum and energy of the domain."""
+    g = 9.81
+    mass = 0.
+    momentum_x = 0.
+    momentum_y = 0.
+    energy = 0.
+    for j in range(Ng, U.shape[1] - Ng):
+        for i in range(Ng, U.shape[2] - Ng):
+            h = np.float64(U[0, j, i])
+            hu = np.float64(U[1, j, i])
+            hv = np.float64(U[2, j, i])
+            mass += h
+            momentum_x += hu
+            momentum_y += hv
+            if h > 0:
+                energy += 0.5 * (hu * hu + hv * hv) / h
+            energy += 0.5 * g * h * h
+    return (mass * cell_area, momentum_x * cell_area,
+            momentum_y * cell_area, energy * cell_area)
+
+
+def totals(U):
+    """(mass, momentum_x, momentum_y, energy) of U."""
+    return _totals(U, conf.Ng, conf.dx * conf.dy)
+
+
+class Diagnostics:
+    """Per-step time series of the conserved quantities.
+
+    Args:
+        max_steps (int) : steps to preallocate (including the initial state)
+    """
+
+    def __init__(self, max_steps):
+        self._series = np.zeros(max_steps, dtype=SERIES_DTYPE)
+        self._len = 0
+
+    def record(self, it, time, U, is_drop=False):
+        self._series[self._len] = (it, time, *totals(U), is_drop)
+        self._len += 1
+
+    @property
+    def series(self):
+        return self._series[:self._len]
+
+    def mass_balance(self):
+        return mass_balance(self.series)
+
+    def summary(self):
+        return summary(self.series)
+
+    def save(self, path):
+        np.save(path, self.series)
+
+
+def mass_balance(series):
+    """Returns the mass added by the drops and the drift of the rest of the
+    steps, relative to the initial mass."""
+    dmass = np.diff(series["mass"])
+    is_drop = series["is_drop"][1:]
+    mass_0 = series["mass"][0]
+    return (dmass[is_drop].sum() / mass_0,
+            dmass[~is_drop].sum() / mass_0)
+
+
+def summary(series):
+    """Returns the conservation summary of a time series as lines of text
+    (none, if the series is None)."""
+    if series is None:
+        return []
+    added, drift = mass_balance(series)
+    last = series[-1]
+    return [
+        f"{'Mass added by the drops':-<29} {100 * added:+.4f} %",
+        f"{'Mass drift':-<29} {100 * drift:+.2e} %",
+        f"{'Final momentum (x, y)':-<29} "
+        f"{last['momentum_x']:+.2e}, {last['momentum_y']:+.2e}",
+        f"{'Energy (initial -> final)':-<30}"
+        f"{series['energy'][0]:.4e} -> {last['energy']:.4e}"
+    ]
+
+
+# The diagnostics of the current run (None: DIAGNOSTICS is off)
+_diagnostics = None
+
+
+def start(U):
+    """Starts monitoring a run, recording the initial state."""
+    global _diagnostics
+    if not conf.DIAGNOSTICS:
+        _diagnostics = None
+        return
+    _diagnostics = Diagnostics(conf.MAX_ITERS)
+    _diagnostics.record(0, 0., U)
+
+
+def record(it, time, U, is_drop=False):
+    """Records the totals of a step (no-op, if DIAGNOSTICS is off)."""
+    if _diagnostics is not None:
+        _diagnostics.record(it, time, U, is_drop)
+
+
+def stop():
+    """Stops monitoring, logs the summary and saves the time series under
+    DIAGNOSTICS_DIR.
+
+    Returns:
+        series (structured array) : None, if DIAGNOSTICS is off
+    """
+    global _diagnostics
+    diagnostics, _diagnostics = _diagnostics, None
+    if diagnostics is None:
+        return None
+    for line in diagnostics.summary():
+        logger.log(line)
+    os.makedirs(conf.DIAGNOSTICS_DIR, exist_ok=True)
+    path = os.path.join(conf.DIAGNOSTICS_DIR,
+                        f"diagnostics_{conf.RUN_ID}.npy")
+    diagnostics.save(path)
+    logger.log(f"Diagnostics saved at: {path}")
+    return diagnostics.series
@@ -0,0 +1,326 @@
+# exporter.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Exports the animation, rendering the frames in parallel."""
+
+#   h_hist ---> [0:8] [8:16] [16:24] ...  frame ranges
+#                 |     |      |
+#                 v     v      v
+#               worker worker worker      each one owns an Agg figure
+#                 |     |      |
+#                 +-----+------+--------> encoders (raw rgb24, in order)
+#                                          |-> ffmpeg: mp4
+#                                          |-> ffmpeg: gif (sampled palette)
+#                                          '-> png sequence
+#
+# Every frame is rendered once, regardless of the number of the encoders.
+# The frames sampled for the gif palette are rendered first and cached,
+# until their turn comes in the stream.
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import os
+import subprocess
+import tempfile
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from mattflow import (config as conf, lod, logger, mattflow_post, raster,
+                      resampling, utils)
+
+
+# The FrameRenderer of a worker process
+_renderer = None
+
+
+def _init_worker(config_snapshot, t_hist, iterations):
+    global _renderer
+    utils.restore_config(config_snapshot)
+    _renderer = mattflow_post.FrameRenderer(t_hist, iterations)
+
+
+def _render_list(frame_numbers, frames):
+    """Renders the frames, numbered by <frame_numbers>."""
+    return [_renderer.render(frame, frame_number)
+            for frame_number, frame in zip(frame_numbers, frames)]
+
+
+def render_frames(h_hist, t_hist=None, workers=1, chunk_frames=8,
+                  frame_numbers=None):
+    """Renders the frames of the animation, yielding them in order.
+
+    Frames found at the rendered-frame cache are not rendered again, and the
+    rendered ones are cached.
+
+    Args:
+        h_hist (array)       : array of iter-wise heights solutions (or a
+                               frame_history sink)
+        t_hist (array)       : holds the iter-wise times
+        workers (int)        : rendering processes (1: render in-process)
+        chunk_frames (int)   : frames rendered per task
+        frame_numbers (list) : the frames to render (default: all of them)
+
+    Yields:
+        rgb (3D array) : shape: (height, width, 3), dtype: uint8
+    """
+    if frame_numbers is None:
+        frame_numbers = range(len(h_hist))
+    cache = mattflow_post.rendered_frame_cache()
+    if cache is None:
+        yield from _render(h_hist, t_hist, workers, chunk_frames,
+                           frame_numbers)
+        return
+
+    if isinstance(h_hist, resampling.ResampledHistory):
+        iterations = h_hist.iterations
+    else:
+        iterations = None
+    Z = lod.plot_history(h_hist)
+    keys = {n: mattflow_post.frame_key(Z[n], n, t_hist, iterations)
+            for n in frame_numbers}
+    missing = [n for n in frame_numbers if keys[n] not in cache]
+    rendered = _render(h_hist, t_hist, workers, chunk_frames, missing)
+    cache.misses += len(missing)
+    missing = set(missing)
+    for frame_number in frame_numbers:
+        key = keys[frame_number]
+        if frame_number in missing:
+            rgb = next(rendered)
+            cache.put(key, rgb)
+        else:
+            rgb = cache.get(key)
+            if rgb is None:
+                # evicted, while rendering the missing frames
+                rgb = next(_render(h_hist, t_hist, 1, 1, [frame_number]))
+        yield rgb
+
+
+def _render(h_hist, t_hist, workers, chunk_frames, frame_numbers):
+    if conf.PLOTTING_STYLE == 'raster':
+        # Hundreds of frames per second, no need for a process pool.
+        renderer = raster.raster_renderer(
+            frame_height=int(conf.FIG_HEIGHT * conf.DPI)
+        )
+        for frame_number in frame_numbers:
+            yield renderer.render(h_hist[frame_number])
+        return
+    if isinstance(h_hist, resampling.ResampledHistory):
+        iterations = h_hist.iterations
+    else:
+        iterations = None
+    # Decimate the frames once, before they are passed to the renderers.
+    h_hist = lod.plot_history(h_hist)
+    if workers == 1:
+        renderer = mattflow_post.FrameRenderer(t_hist, iterations)
+        for frame_number in frame_numbers:
+            yield renderer.render(h_hist[frame_number], frame_number)
+        return
+
+    chunks = iter([frame_numbers[i: i + chunk_frames]
+                   for i in range(0, len(frame_numbers), chunk_frames)])
+    initargs = (utils.config_snapshot(), t_hist, iterations)
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=initargs) as pool:
+        pending = deque()
+
+        def submit_next():
+            chunk = next(chunks, None)
+            if chunk is not None:
+                frames = np.stack([h_hist[n] for n in chunk])
+                pending.append(pool.submit(_render_list, chunk, frames))
+
+        # Keep 2 tasks per worker in flight, bounding the buffered frames.
+        for _ in range(2 * workers):
+            submit_next()
+        while pending:
+            rendered = pending.popleft().result()
+            submit_next()
+            yield from rendered
+
+
+def _palette_samples(frames, n):
+    """Frame numbers of <n> frames, spread evenly across the animation."""
+    return sorted(set(np.linspace(0, frames - 1, min(n, frames), dtype=int)))
+
+
+def _file_name():
+    date_n_time = str(datetime.now())[:19]
+    # Replace ':' with '-' for compatibility with windows file formating.
+    date_n_time = date_n_time.replace(':', '-').replace(' ', '_')
+    return conf.MODE + '_animation_' + date_n_time
+
+
+def _ffmpeg_input(size, fps):
+    """ffmpeg arguments of the raw rgb24 frames, read from stdin."""
+    return [conf.PATH_TO_FFMPEG, '-y', '-hide_banner', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+            '-s', f"{size[0]}x{size[1]}", '-r', str(fps), '-i', '-']
+
+
+def _ffmpeg_video_cmd(size, fps, path):
+    """ffmpeg command that encodes raw rgb24 frames from stdin."""
+    return _ffmpeg_input(size, fps) + [
+        # yuv420p needs even dimensions
+        '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+        '-pix_fmt', 'yuv420p', '-vcodec', 'libx264', '-r', str(fps), path
+    ]
+
+
+def _gif_scale():
+    return f"scale={conf.GIF_WIDTH}:-1:flags=lanczos"
+
+
+def _ffmpeg_palette_cmd(size, path):
+    """ffmpeg command that generates the gif palette of the (sampled) raw
+    rgb24 frames from stdin."""
+    return _ffmpeg_input(size, 1) + [
+        '-vf', f"{_gif_scale()},palettegen=stats_mode=full", path
+    ]
+
+
+def _ffmpeg_gif_cmd(size, fps, palette_path, path):
+    """ffmpeg command that encodes raw rgb24 frames from stdin to a gif."""
+    return _ffmpeg_input(size, fps) + [
+        '-i', palette_path,
+        '-lavfi', f"{_gif_scale()}[x];[x][1:v]paletteuse", '-loop', '0', path
+    ]
+
+
+class _FFmpegEncoder:
+    """Streams raw rgb24 frames to an ffmpeg process."""
+
+    def __init__(self, cmd):
+        self._ffmpeg = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, rgb):
+        self._ffmpeg.stdin.write(rgb.tobytes())
+
+    def close(self):
+        self._ffmpeg.stdin.close()
+        if self._ffmpeg.wait():
+            raise subprocess.CalledProcessError(self._ffmpeg.returncode,
+                                                self._ffmpeg.args)
+
+
+class _PngEncoder:
+    """Saves every frame as a .png, in the <save_dir>."""
+
+    def __init__(self, save_dir):
+        os.makedirs(save_dir, exist_ok=True)
+        self.save_dir = save_dir
+        self._frame_number = 0
+
+    def write(self, rgb):
+        file_name = f"frame_{self._frame_number:0>{5}}.png"
+        plt.imsave(os.path.join(self.save_dir, file_name), rgb)
+        self._frame_number += 1
+
+    def close(self):
+        pass
+
+
+def _generate_palette(frames, size, path):
+    """Generates the gif palette of the <frames> (rgb arrays)."""
+    encoder = _FFmpegEncoder(_ffmpeg_palette_cmd(size, path))
+    for rgb in frames:
+        encoder.write(rgb)
+    encoder.close()
+
+
+def _frame_stream(h_hist, t_hist, samples):
+    """Yields all the rendered frames in order, taking the already rendered
+    <samples> ({frame_number: rgb}) from the cache."""
+    rest = render_frames(
+        h_hist, t_hist,
+        workers=conf.EXPORT_WORKERS,
+        chunk_frames=conf.EXPORT_CHUNK_FRAMES,
+        frame_numbers=[n for n in range(len(h_hist)) if n not in samples]
+    )
+    for frame_number in range(len(h_hist)):
+        if frame_number in samples:
+            yield samples.pop(frame_number)
+        else:
+            yield next(rest)
+
+
+def _encoder(fmt, file_name, fps, size, palette_path):
+    path = os.path.join(conf.SAVE_DIR, f"{file_name}.{fmt}")
+    if fmt == 'png':
+        return _PngEncoder(os.path.join(conf.SAVE_DIR, file_name))
+    if fmt == 'gif':
+        return _FFmpegEncoder(_ffmpeg_gif_cmd(size, fps, palette_path, path))
+    return _FFmpegEncoder(_ffmpeg_video_cmd(size, fps, path))
+
+
+def _encode(h_hist, t_hist, formats, file_name, fps, tmp_dir):
+    """Renders every frame once and streams it to the encoders of all the
+    <formats>."""
+    # Render the palette samples first, so that the palette is ready before
+    # the gif encoder starts. They are kept until their turn in the stream.
+    samples = {}
+    palette_path = os.path.join(tmp_dir, "palette.png")
+    if 'gif' in formats:
+        sample_numbers = _palette_samples(len(h_hist), conf.GIF_PALETTE_FRAMES)
+        samples = dict(zip(
+            sample_numbers,
+            render_frames(h_hist, t_hist,
+                          workers=conf.EXPORT_WORKERS,
+                          chunk_frames=conf.EXPORT_CHUNK_FRAMES,
+                          frame_numbers=sample_numbers)
+        ))
+        rgb = samples[0]
+        _generate_palette(samples.values(), (rgb.shape[1], rgb.shape[0]),
+                          palette_path)
+
+    encoders = []
+    try:
+        for rgb in _frame_stream(h_hist, t_hist, samples):
+            if not encoders:
+                size = (rgb.shape[1], rgb.shape[0])
+                encoders = [_encoder(fmt, file_name, fps, size, palette_path)
+                            for fmt in formats]
+            for encoder in encoders:
+                encoder.write(rgb)
+    finally:
+        for encoder in encoders:
+            encoder.close()
+
+
+def save_animation(h_hist, t_hist=None):
+    """Saves the animation in <VID_FORMAT> and, if SAVE_GIF, as a light gif.
+
+    The frames are rendered once, on <EXPORT_WORKERS> processes, and streamed
+    to all the encoders simultaneously.
+
+    Args:
+        h_hist (array) : array of iter-wise heights solutions
+        t_hist (array) : holds the iter-wise times
+    """
+    fps = conf.FPS
+    file_name = _file_name()
+    formats = [conf.VID_FORMAT]
+    if conf.SAVE_GIF and conf.VID_FORMAT != 'gif':
+        formats.append('gif')
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            _encode(h_hist, t_hist, formats, file_name, fps, tmp_dir)
+    except FileNotFoundError:
+        logger.log('Configure PATH_TO_FFMPEG')
+        return
+    except (BrokenPipeError, subprocess.CalledProcessError):
+        logger.log('ffmpeg failed to encode the animation')
+        return
+    for fmt in formats:
+        suffix = '' if fmt == 'png' else f'.{fmt}'
+        logger.log(f'Animation saved as: {file_name}{suffix} | fps: {fps}')
@@ -0,0 +1,140 @@
+# field_stats.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Accumulates per-cell statistics of the height, every step, so that they
+do not need the saved frames."""
+
+# After every step, a compiled kernel updates, in a single pass over h:
+#
+#   max height    : the running max and the time it was reached
+#   arrival time  : the first time that h - SURFACE_LEVEL exceeded the
+#                   FIELD_STATS_THRESHOLD (nan: never)
+#   mean, std     : Welford's online mean and variance
+#
+#       n += 1;  delta = h - mean;  mean += delta / n;  M2 += delta (h - mean)
+#       var = M2 / n
+#
+# The RMS elevation (about SURFACE_LEVEL) follows from the mean and the
+# variance: rms^2 = var + (mean - SURFACE_LEVEL)^2.
+
+import os
+
+import numba as nb
+import numpy as np
+
+from mattflow import config as conf, logger
+
+
+# compiled at the first call, for the U of the solver
+@nb.njit(nogil=True)
+def _update(U, Ng, n, time, level, threshold,
+            max_height, max_time, arrival_time, mean, M2):
+    """Updates the statistics with the (n-th) height of the domain."""
+    for j in range(max_height.shape[0]):
+        for i in range(max_height.shape[1]):
+            h = U[0, j + Ng, i + Ng]
+            if h > max_height[j, i]:
+                max_height[j, i] = h
+                max_time[j, i] = time
+            if np.isnan(arrival_time[j, i]) and h - level > threshold:
+                arrival_time[j, i] = time
+            delta = h - mean[j, i]
+            mean[j, i] += delta / n
+            M2[j, i] += delta * (h - mean[j, i])
+
+
+class FieldStats:
+    """Per-cell statistics of the height of a run.
+
+    Args:
+        shape (tuple)     : (Ny, Nx)
+        threshold (float) : elevation that counts as the arrival of a wave
+    """
+
+    def __init__(self, shape, threshold):
+        self.threshold = threshold
+        self.steps = 0
+        self.max_height = np.full(shape, -np.inf, dtype=conf.DTYPE)
+        self.max_time = np.zeros(shape)
+        self.arrival_time = np.full(shape, np.nan)
+        self.mean = np.zeros(shape)
+        self._M2 = np.zeros(shape)
+
+    def update(self, time, U):
+        self.steps += 1
+        _update(U, conf.Ng, self.steps, time, conf.SURFACE_LEVEL,
+                self.threshold, self.max_height, self.max_time,
+                self.arrival_time, self.mean, self._M2)
+
+    @property
+    def variance(self):
+        return self._M2 / max(self.steps, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def rms(self):
+        """RMS elevation, about SURFACE_LEVEL."""
+        return np.sqrt(self.variance + (self.mean - conf.SURFACE_LEVEL)**2)
+
+    def to_dict(self):
+        return {
+            "max_height": self.max_height,
+            "max_time": self.max_time,
+            "arrival_time": self.arrival_time,
+            "mean": self.mean,
+            "std": self.std,
+            "rms": self.rms
+        }
+
+    def save(self, path):
+        np.savez(path, steps=self.steps, threshold=self.threshold,
+                 **self.to_dict())
+
+
+# The statistics of the current run (None: FIELD_STATS is off)
+_stats = None
+
+
+def start(U):
+    """Starts accumulating the statistics of a run, from the initial state."""
+    global _stats
+    if not conf.FIELD_STATS:
+        _stats = None
+        return
+    _stats = FieldStats((conf.Ny, conf.Nx), conf.FIELD_STATS_THRESHOLD)
+    _stats.update(0., U)
+
+
+def update(time, U):
+    """Updates the statistics with a step (no-op, if FIELD_STATS is off)."""
+    if _stats is not None:
+        _stats.update(time, U)
+
+
+def stop():
+    """Stops accumulating and saves the maps under FIELD_STATS_DIR.
+
+    Returns:
+        stats (FieldStats) : None, if FIELD_STATS is off
+    """
+    global _stats
+    stats, _stats = _stats, None
+    if stats is None:
+        return None
+    os.makedirs(conf.FIELD_STATS_DIR, exist_ok=True)
+    path = os.path.join(conf.FIELD_STATS_DIR,
+                        f"field_stats_{conf.RUN_ID}.npz")
+    stats.save(path)
+    logger.log(f"Field statistics saved at: {path}")
+    return stats
@@ -322,7 +322,10 @@ def flux(U):
                              mode="w+")
 
         Parallel(n_jobs=workers)(
-            delayed(_flux_batch)(U, window, slicing_obj, flux_out, idx)
+            delayed(_flux_batch)(U, window, slicing_obj,
+                                 domain_dims=domain_dims,
+                                 flux_out=flux_out,
+                                 idx=idx)
             for idx, slicing_obj in enumerate(slices)
         )
     else:
@@ -0,0 +1,186 @@
+# frame_cache.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Caches the rendered frames, as compressed RGB arrays."""
+
+# A frame is identified by everything that affects its pixels, e.g.:
+#   (hash of the heights, title, plotting style, view angle, dpi, ...)
+# so the same frame is found again by another run or process. The key is
+# hashed, so it can be used as a file name as well.
+#
+# Both storages are bounded to <max_bytes> of compressed frames and evict the
+# least recently used ones. On disk, the recency is the modification time of
+# the files, which is renewed at every hit.
+
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+import zlib
+
+import numpy as np
+
+from mattflow import config as conf
+
+
+def _hash(key):
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def content_hash(array):
+    """Hash of the values of an array (part of a frame key)."""
+    array = np.ascontiguousarray(array)
+    return hashlib.sha1(array.dtype.str.encode() + array.tobytes()).hexdigest()
+
+
+def _encode(rgb):
+    header = np.array(rgb.shape, dtype=np.int32).tobytes()
+    return header + zlib.compress(np.ascontiguousarray(rgb).tobytes(), 1)
+
+
+def _decode(payload):
+    shape = np.frombuffer(payload[:12], dtype=np.int32)
+    rgb = np.frombuffer(zlib.decompress(payload[12:]), dtype=np.uint8)
+    return rgb.reshape(shape)
+
+
+class FrameCache:
+    """Maps frame keys to rendered (RGB, uint8) frames.
+
+    Args:
+        max_bytes (int)  : bound of the compressed frames, in memory or on
+                           disk (least recently used frames are evicted)
+        cache_dir (str)  : if given, the frames are stored on disk, instead
+    """
+
+    def __init__(self, max_bytes=512 * 2**20, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.nbytes = sum(size for _, size, _ in self._disk_frames())
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, _hash(key) + ".rgbz")
+
+    def _disk_frames(self):
+        """(path, size, last use) of the frames on disk."""
+        frames = []
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".rgbz"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # evicted by another process
+                    continue
+                frames.append((entry.path, stat.st_size, stat.st_mtime))
+        return frames
+
+    def _evict_disk(self):
+        """Removes the least recently used frames, until the frames on disk
+        (also written by other processes) fit in max_bytes."""
+        frames = sorted(self._disk_frames(), key=lambda frame: frame[2])
+        self.nbytes = sum(size for _, size, _ in frames)
+        # keep at least the last frame
+        for path, size, _ in frames[:-1]:
+            if self.nbytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.nbytes -= size
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            with self._lock:
+                payload = self._frames.get(_hash(key))
+                if payload is not None:
+                    self._frames.move_to_end(_hash(key))
+            return payload
+        try:
+            with open(self._path(key), "rb") as fr:
+                payload = fr.read()
+            # renew the last use
+            os.utime(self._path(key))
+        except OSError:
+            return None
+        return payload
+
+    def get(self, key):
+        """Returns the cached frame, or None."""
+        payload = self._load(key)
+        if payload is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return _decode(payload)
+
+    def put(self, key, rgb):
+        payload = _encode(rgb)
+        if self.cache_dir is not None:
+            # Rename a complete file, so that other processes never read a
+            # partially written frame.
+            tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as fw:
+                fw.write(payload)
+            os.replace(tmp_path, self._path(key))
+            with self._lock:
+                self.nbytes += len(payload)
+                if self.nbytes > self.max_bytes:
+                    self._evict_disk()
+            return
+        with self._lock:
+            old = self._frames.pop(_hash(key), None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self._frames[_hash(key)] = payload
+            self.nbytes += len(payload)
+            while self.nbytes > self.max_bytes and len(self._frames) > 1:
+                self.nbytes -= len(self._frames.popitem(last=False)[1])
+
+    def __contains__(self, key):
+        if self.cache_dir is None:
+            with self._lock:
+                return _hash(key) in self._frames
+        return os.path.isfile(self._path(key))
+
+    def report(self):
+        storage = "memory" if self.cache_dir is None else "disk"
+        return (f"Frame cache | hits: {self.hits} | misses: {self.misses}"
+                f" | {storage}: {self.nbytes / 2**20:.1f} MB")
+
+
+_cache = None
+
+
+def frame_cache():
+    """The FrameCache of the process, configured by the FRAME_CACHE options
+    (None, if caching is disabled)."""
+    global _cache
+    if conf.FRAME_CACHE is None:
+        return None
+    config = (conf.FRAME_CACHE, conf.FRAME_CACHE_MB, conf.FRAME_CACHE_DIR)
+    if _cache is None or _cache[0] != config:
+        disk = conf.FRAME_CACHE == "disk"
+        cache = FrameCache(conf.FRAME_CACHE_MB * 2**20,
+                           cache_dir=conf.FRAME_CACHE_DIR if disk else None)
+        _cache = (config, cache)
+    return _cache[1]
@@ -0,0 +1,453 @@
+# frame_history.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Chunked storage of the saved frames (h_hist), spilled or compressed."""
+
+#   chunk:   0         1         2         3         4
+#          [=====]   [=====]   [=====]   [=====]   [==   ]
+#          \_______________/   \_______________/   \_____/
+#           spilled to disk     in-RAM window      open chunk
+#           (memory-mapped)     (completed)        (being filled)
+#
+# With mip levels, every completed chunk is also decimated to 1/2, 1/4, ...
+# resolution and each level is kept in a store of the same kind, so that a
+# viewer reads only the resolution it needs:
+#
+#   level 0 (full)  [=====]   [=====]   [==   ]
+#   level 1 (1/2)   [===]     [===]     (the open chunk is decimated on read)
+#   level 2 (1/4)   [=]       [=]
+
+import bz2
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import lzma
+import os
+import threading
+from timeit import default_timer as timer
+import uuid
+import weakref
+import zlib
+
+import numpy as np
+
+from mattflow import config as conf, lod, logger
+
+
+class _ChunkedHistory:
+    """Append-only sequence of frames, stored in chunks of <chunk_frames>.
+
+    It mimics the parts of the ndarray interface that are used on h_hist:
+    len(), indexing with ints and slices, iteration and sequential item
+    assignment (h_hist[len(h_hist)] = frame appends the frame).
+
+    Subclasses decide what happens to a chunk when it is completed, through
+    _store_chunk(), and how it is read back, through _load_chunk(). They also
+    create the stores of the mip levels, through _new_level().
+
+    Args:
+        frame_shape (tuple) : shape of a single frame
+        chunk_frames (int)  : number of frames per chunk
+        dtype (np.dtype)    : dtype of the frames
+        mip_levels (int)    : number of the decimated levels (1/2, 1/4, ...)
+                              stored along with the full frames
+        mip_mode (str)      : 'mean' or 'max' (see lod.decimate)
+    """
+
+    def __init__(self, frame_shape, chunk_frames=64, dtype=conf.DTYPE,
+                 mip_levels=0, mip_mode="mean"):
+        self.frame_shape = tuple(frame_shape)
+        self.chunk_frames = chunk_frames
+        self.dtype = np.dtype(dtype)
+        self.mip_levels = mip_levels
+        self.mip_mode = mip_mode
+        # stores of the levels 1, 2, ... (created with the 1st chunk)
+        self._levels = None
+        self._len = 0
+        self._open_chunk = self._new_chunk()
+
+    def _new_chunk(self):
+        return np.empty((self.chunk_frames,) + self.frame_shape,
+                        dtype=self.dtype)
+
+    @property
+    def shape(self):
+        return (self._len,) + self.frame_shape
+
+    @property
+    def frame_bytes(self):
+        return int(np.prod(self.frame_shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return self._len
+
+    def append(self, frame):
+        self._open_chunk[self._len % self.chunk_frames] = frame
+        self._len += 1
+        if self._len % self.chunk_frames == 0:
+            chunk_idx = self._len // self.chunk_frames - 1
+            self._store_chunk(chunk_idx, self._open_chunk)
+            if self.mip_levels:
+                self._store_levels(chunk_idx, self._open_chunk)
+            self._open_chunk = self._new_chunk()
+
+    def _store_levels(self, chunk_idx, chunk):
+        """Stores the completed chunk at the mip levels."""
+        pyramid = mip_pyramid(chunk, self.mip_levels, self.mip_mode)
+        if self._levels is None:
+            self._levels = [self._new_level(level, frames.shape[1:])
+                            for level, frames in enumerate(pyramid, 1)]
+        for store, frames in zip(self._levels, pyramid):
+            store._store_chunk(chunk_idx, frames)
+            store._len += self.chunk_frames
+
+    def level(self, level):
+        """Read-only view of the frames at 1 / 2**level resolution."""
+        if level == 0:
+            return self
+        if not 0 < level <= self.mip_levels:
+            raise ValueError(f"mip level {level} is not stored")
+        return _MipLevel(self, level)
+
+    def __setitem__(self, idx, frame):
+        if idx == self._len:
+            self.append(frame)
+        elif self._open_chunk_start() <= idx < self._len:
+            self._open_chunk[idx % self.chunk_frames] = frame
+        else:
+            raise IndexError("Only the frames of the open chunk can be"
+                             " overwritten.")
+
+    def _open_chunk_start(self):
+        return self._len - self._len % self.chunk_frames
+
+    def _chunk(self, chunk_idx):
+        """Returns the chunk that holds the frames of the chunk_idx."""
+        if chunk_idx * self.chunk_frames == self._open_chunk_start():
+            return self._open_chunk
+        return self._load_chunk(chunk_idx)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            idxs = range(*key.indices(self._len))
+            frames = np.empty((len(idxs),) + self.frame_shape,
+                              dtype=self.dtype)
+            for i, idx in enumerate(idxs):
+                frames[i] = self[idx]
+            return frames
+        idx = int(key)
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError("frame index out of range")
+        return self._chunk(idx // self.chunk_frames)[idx % self.chunk_frames]
+
+    def __iter__(self):
+        for idx in range(self._len):
+            yield self[idx]
+
+    def __array__(self, dtype=None, copy=None):
+        frames = self[:]
+        return frames if dtype is None else frames.astype(dtype)
+
+    def _store_chunk(self, chunk_idx, chunk):
+        raise NotImplementedError
+
+    def _load_chunk(self, chunk_idx):
+        raise NotImplementedError
+
+    def _new_level(self, level, frame_shape):
+        """Creates the (level-less) store of a mip level."""
+        raise NotImplementedError
+
+    def report(self):
+        """Returns a one-line summary of the storage."""
+        raise NotImplementedError
+
+
+def mip_pyramid(frames, levels, mode="mean"):
+    """Decimates the frames successively by 2, <levels> times.
+
+    Args:
+        frames (array) : shape: (..., Ny, Nx)
+        levels (int)   : number of levels
+        mode (str)     : 'mean' or 'max'
+
+    Returns:
+        pyramid (list) : the frames at 1/2, 1/4, ... resolution
+    """
+    pyramid = []
+    for _ in range(levels):
+        frames = lod.decimate(frames, 2, mode)
+        pyramid.append(frames)
+    return pyramid
+
+
+class _MipLevel:
+    """Read-only view of a chunked history at a mip level.
+
+    The completed chunks are read from the store of the level, and the
+    frames of the open chunk are decimated on read.
+    """
+
+    def __init__(self, history, level):
+        self.history = history
+        self.mip_level = level
+
+    def __len__(self):
+        return len(self.history)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            idxs = range(*key.indices(len(self)))
+            return np.stack([self[idx] for idx in idxs])
+        idx = int(key)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("frame index out of range")
+        levels = self.history._levels
+        if levels is not None and idx < len(levels[0]):
+            return levels[self.mip_level - 1][idx]
+        return mip_pyramid(self.history[idx], self.mip_level,
+                           self.history.mip_mode)[-1]
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class SpillHistory(_ChunkedHistory):
+    """Keeps a window of completed chunks in RAM and spills the older ones to
+    a memory-mapped file.
+
+    Memory usage is bounded to (ram_chunks + 1) chunks, regardless of the
+    number of the saved frames.
+
+    Args:
+        frame_shape (tuple) : shape of a single frame
+        chunk_frames (int)  : number of frames per chunk
+        ram_chunks (int)    : completed chunks kept in RAM (None: never spill)
+        path (str)          : the spill file (default: a unique file under
+                              conf.HISTORY_DIR, removed with the object)
+        dtype (np.dtype)    : dtype of the frames
+        mip_levels (int)    : number of the decimated levels (each one spilled
+                              to its own file)
+        mip_mode (str)      : 'mean' or 'max'
+    """
+
+    def __init__(self, frame_shape, chunk_frames=64, ram_chunks=4, path=None,
+                 dtype=conf.DTYPE, mip_levels=0, mip_mode="mean"):
+        super().__init__(frame_shape, chunk_frames, dtype, mip_levels,
+                         mip_mode)
+        self.ram_chunks = ram_chunks
+        self._ram = OrderedDict()
+        self._spilled = 0
+        self._mmap = None
+        self._file = None
+        if path is None:
+            os.makedirs(conf.HISTORY_DIR, exist_ok=True)
+            path = os.path.join(conf.HISTORY_DIR,
+                                f"h_hist_{uuid.uuid4().hex[:12]}.bin")
+            weakref.finalize(self, _remove_file, path)
+        self.path = path
+
+    @property
+    def chunk_bytes(self):
+        return self.chunk_frames * self.frame_bytes
+
+    def _new_level(self, level, frame_shape):
+        root, ext = os.path.splitext(self.path)
+        store = SpillHistory(frame_shape, self.chunk_frames, self.ram_chunks,
+                             path=f"{root}_mip{level}{ext}", dtype=self.dtype)
+        weakref.finalize(store, _remove_file, store.path)
+        return store
+
+    def _store_chunk(self, chunk_idx, chunk):
+        self._ram[chunk_idx] = chunk
+        if self.ram_chunks is None:
+            return
+        while len(self._ram) > self.ram_chunks:
+            self._spill(*self._ram.popitem(last=False))
+
+    def _spill(self, chunk_idx, chunk):
+        if self._file is None:
+            self._file = open(self.path, "w+b")
+            weakref.finalize(self, self._file.close)
+        self._file.seek(chunk_idx * self.chunk_bytes)
+        self._file.write(chunk.tobytes())
+        self._spilled = max(self._spilled, chunk_idx + 1)
+
+    def _load_chunk(self, chunk_idx):
+        if chunk_idx in self._ram:
+            return self._ram[chunk_idx]
+        if self._mmap is None or len(self._mmap) < self._spilled:
+            # The file has grown since it was last mapped.
+            self._file.flush()
+            self._mmap = np.memmap(
+                self.path, dtype=self.dtype, mode='r',
+                shape=(self._spilled, self.chunk_frames) + self.frame_shape
+            )
+        return self._mmap[chunk_idx]
+
+    def report(self):
+        ram_chunks = len(self._ram) + 1
+        return (f"Spilled h_hist | frames: {self._len}"
+                f" | RAM: {ram_chunks * self.chunk_bytes / 2**20:.1f} MB"
+                f" | disk: {self._spilled * self.chunk_bytes / 2**20:.1f} MB")
+
+
+# codec: (compress, decompress), all of them release the GIL
+_CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 1), zlib.decompress),
+    "bz2": (bz2.compress, bz2.decompress),
+    "lzma": (lzma.compress, lzma.decompress)
+}
+
+
+class CompressedHistory(_ChunkedHistory):
+    """Keeps the completed chunks in RAM, quantized, delta-encoded along time
+    and compressed.
+
+    Encoding of a chunk:
+    1. quantization : heights in h_range are mapped to uint8 or uint16
+                      (heights out of the range are clipped)
+    2. delta        : every frame is replaced by its difference from the
+                      previous frame (modular arithmetic, so it is lossless)
+    3. byte shuffle : the bytes are grouped by significance
+    4. codec        : zlib, bz2 or lzma
+
+    Chunks are encoded on a thread pool, as soon as they are completed, and
+    decoded on access (the last decoded chunk is cached).
+
+    Args:
+        frame_shape (tuple) : shape of a single frame
+        chunk_frames (int)  : number of frames per chunk
+        h_range (tuple)     : (min, max) quantization range of the heights
+        bits (int)          : 8 or 16 quantization bits
+        codec (str)         : one of ["zlib", "bz2", "lzma"]
+        workers (int)       : encoding threads (1: encode at append)
+        dtype (np.dtype)    : dtype of the decoded frames
+        mip_levels (int)    : number of the decimated levels (each one
+                              compressed the same way)
+        mip_mode (str)      : 'mean' or 'max'
+    """
+
+    def __init__(self, frame_shape, chunk_frames=64, h_range=(0., 4.),
+                 bits=16, codec="zlib", workers=2, dtype=conf.DTYPE,
+                 mip_levels=0, mip_mode="mean"):
+        super().__init__(frame_shape, chunk_frames, dtype, mip_levels,
+                         mip_mode)
+        self.h_range = h_range
+        self.bits = bits
+        self.codec = codec
+        self.workers = workers
+        self.h_min, self.h_max = h_range
+        self.qdtype = np.dtype({8: np.uint8, 16: np.uint16}[bits])
+        self._qmax = np.iinfo(self.qdtype).max
+        self._scale = self._qmax / (self.h_max - self.h_min)
+        self._compress, self._decompress = _CODECS[codec]
+        if workers > 1:
+            self._pool = ThreadPoolExecutor(max_workers=workers)
+            weakref.finalize(self, self._pool.shutdown, False)
+        else:
+            self._pool = None
+        self._chunks = {}
+        self._decoded = (None, None)
+
+        # stats
+        self._lock = threading.Lock()
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.encode_time = 0.
+        self.clipped = 0
+
+    def _store_chunk(self, chunk_idx, chunk):
+        if self._pool is None:
+            self._chunks[chunk_idx] = self._encode(chunk)
+        else:
+            self._chunks[chunk_idx] = self._pool.submit(self._encode, chunk)
+
+    def _new_level(self, level, frame_shape):
+        store = CompressedHistory(frame_shape, self.chunk_frames,
+                                  self.h_range, self.bits, self.codec,
+                                  workers=1, dtype=self.dtype)
+        # The levels are encoded on the thread pool of the full frames.
+        store._pool = self._pool
+        return store
+
+    def _encode(self, chunk):
+        start = timer()
+        q = (chunk - self.h_min) * self._scale
+        clipped = np.count_nonzero((q < 0) | (q > self._qmax))
+        q = np.rint(np.clip(q, 0, self._qmax)).astype(self.qdtype)
+        np.subtract(q[1:], q[:-1].copy(), out=q[1:])
+        shuffled = q.view(np.uint8).reshape(-1, self.qdtype.itemsize).T
+        payload = self._compress(np.ascontiguousarray(shuffled).tobytes())
+        with self._lock:
+            self.raw_bytes += chunk.nbytes
+            self.compressed_bytes += len(payload)
+            self.encode_time += timer() - start
+            self.clipped += clipped
+        return payload
+
+    def _decode(self, payload):
+        shuffled = np.frombuffer(self._decompress(payload), dtype=np.uint8)
+        q = (np.ascontiguousarray(shuffled.reshape(self.qdtype.itemsize, -1).T)
+             .view(self.qdtype)
+             .reshape((self.chunk_frames,) + self.frame_shape))
+        q = np.cumsum(q, axis=0, dtype=self.qdtype)
+        return (q / self._scale + self.h_min).astype(self.dtype)
+
+    def _load_chunk(self, chunk_idx):
+        if self._decoded[0] == chunk_idx:
+            return self._decoded[1]
+        payload = self._chunks[chunk_idx]
+        if isinstance(payload, Future):
+            payload = self._chunks[chunk_idx] = payload.result()
+        frames = self._decode(payload)
+        self._decoded = (chunk_idx, frames)
+        return frames
+
+    def flush(self):
+        """Waits for the pending chunks to be encoded."""
+        for chunk_idx, payload in self._chunks.items():
+            if isinstance(payload, Future):
+                self._chunks[chunk_idx] = payload.result()
+
+    @property
+    def compression_ratio(self):
+        self.flush()
+        return self.raw_bytes / max(self.compressed_bytes, 1)
+
+    @property
+    def encode_throughput(self):
+        """Encoded MB/s, per encoding thread."""
+        self.flush()
+        return self.raw_bytes / 2**20 / max(self.encode_time, 1e-9)
+
+    def report(self):
+        return (f"Compressed h_hist | frames: {self._len}"
+                f" | ratio: {self.compression_ratio:.1f}x"
+                f" | encode: {self.encode_throughput:.0f} MB/s/thread"
+                f" | clipped heights: {self.clipped}")
+
+
+def log_report(h_hist):
+    """Logs the summary of a chunked h_hist and returns it (None, if h_hist
+    is not chunked)."""
+    if not isinstance(h_hist, _ChunkedHistory):
+        return None
+    report = h_hist.report()
+    logger.log(report)
+    return report
@@ -31,7 +31,15 @@ from random import randint, uniform
 import numpy as np
 from numpy.lib.format import open_memmap
 
-from mattflow import config as conf, dat_writer, logger, utils
+from mattflow import (autotune,
+                      config as conf,
+                      dataset,
+                      dat_writer,
+                      frame_history,
+                      logger,
+                      memory_planner,
+                      scheduler,
+                      utils)
 
 
 def _variance():
@@ -144,10 +152,10 @@ def _init_U():
     U[0, :, :] = conf.SURFACE_LEVEL + drop(U[0, :, :], drops_count=1)
     # Write a .dat file (default: False)
     if conf.WRITE_DAT:
-        dat_writer.writeDat(U[0, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng],
-                            time=0, it=0)
+        dat_writer.write_dat(U[0, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng],
+                             time=0, it=0)
         from mattflow import mattflow_post
-        mattflow_post.plotFromDat(time=0, it=0)
+        mattflow_post.plot_from_dat(time=0, it=0)
     elif not conf.WRITE_DAT:
         pass
     else:
@@ -155,28 +163,73 @@ def _init_U():
     return U
 
 
-def _init_h_hist(U):
+def _num_states_to_save(U):
+    """Number of frames to preallocate, sized from the output trigger policy
+    (see scheduler)."""
+    if scheduler.iteration_based():
+        dt = None
+    else:
+        dt = scheduler.dt_estimate(U[0, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng])
+    return scheduler.frame_scheduler().capacity(
+        conf.MAX_ITERS, dt=dt, stopping_time=conf.STOPPING_TIME
+    )
+
+
+def _init_h_hist(U, num_states):
     """Creates and initializes h_hist, which holds the stepwise height data.
 
     - holds the states of the fluid for post-processing
-    - saving <FRAMES_PER_PERIOD> frames every <FRAME_SAVE_FREQ> iters
+    - saving <FRAMES_PER_PERIOD> frames every <FRAME_SAVE_FREQ> iters (or
+      by simulated time and change, see scheduler)
+    - HISTORY_STORAGE selects a preallocated array or a chunked sink (see
+      frame_history)
+
+    Args:
+        U (3D array)     : the state variables
+        num_states (int) : frames to preallocate ('ram' storage)
+
+    Raises:
+        ValueError : if HISTORY_STORAGE is not a valid option
     """
-    # Number of integer divisions with the freq, times the consecutive frames,
-    # plus the consecutive frames that we can take from the remainder of the
-    # division.
-    num_states_to_save = (
-        conf.MAX_ITERS
-        // conf.FRAME_SAVE_FREQ
-        * conf.FRAMES_PER_PERIOD
-        + min(conf.MAX_ITERS % conf.FRAME_SAVE_FREQ, conf.FRAMES_PER_PERIOD)
-    )
-    h_hist = np.zeros((num_states_to_save, conf.Nx, conf.Ny), dtype=conf.DTYPE)
-    h_hist[0] = U[0, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng]
+    frame = U[0, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng]
+    if conf.HISTORY_STORAGE == "ram":
+        h_hist = np.zeros((num_states, conf.Nx, conf.Ny), dtype=conf.DTYPE)
+    elif conf.HISTORY_STORAGE == "spill":
+        h_hist = frame_history.SpillHistory(
+            frame.shape,
+            chunk_frames=conf.HISTORY_CHUNK_FRAMES,
+            ram_chunks=conf.HISTORY_RAM_CHUNKS,
+            mip_levels=conf.HISTORY_MIP_LEVELS,
+            mip_mode=conf.LOD_MODE
+        )
+    elif conf.HISTORY_STORAGE == "compressed":
+        h_hist = frame_history.CompressedHistory(
+            frame.shape,
+            chunk_frames=conf.HISTORY_CHUNK_FRAMES,
+            h_range=conf.HISTORY_QUANT_RANGE,
+            bits=conf.HISTORY_QUANT_BITS,
+            codec=conf.HISTORY_CODEC,
+            workers=conf.HISTORY_COMPRESS_WORKERS,
+            mip_levels=conf.HISTORY_MIP_LEVELS,
+            mip_mode=conf.LOD_MODE
+        )
+    else:
+        raise ValueError("Configure HISTORY_STORAGE | options:"
+                         " 'ram', 'spill', 'compressed'")
+    h_hist[0] = frame
     return h_hist
 
 
 def _init_U_ds(U):  # pragma: no cover
     """Creates and initializes U_ds, which holds stepwise data for ML."""
+    if conf.DS_FORMAT == "shards":
+        U_ds = dataset.dataset_writer(
+            U[:, conf.Ng: - conf.Ng, conf.Ng: - conf.Ng].shape
+        )
+        # The initial state holds the 1st drop.
+        U_ds.write(U[:, conf.Ng: - conf.Ng, conf.Ng: - conf.Ng],
+                   it=0, time=0, is_drop=True)
+        return U_ds
     dss = utils.ds_shape()
     ds_name = f"mattflow_data_{dss[0]}x{dss[1]}x{dss[2]}x{dss[3]}.npy"
     U_ds = open_memmap(os.path.join(os.getcwd(), ds_name),
@@ -197,18 +250,25 @@ def initialize():
                           - U[1] : y dimention (rows)
                           - U[2] : x dimention (columns)
         h_hist (array) :  holds the step-wise height solutions for the
-                                 post-processing animation
+                          post-processing animation (an array or a
+                          frame_history sink)
         t_hist (array) :  holds the step-wise times for the post-
                           processing animation
         U_ds (memmap)  :  holds the state-variables 3D matrix data for all
                           the timesteps
                           (conf.MAX_ITERS, 3, Nx + 2 * Ng, Ny + 2 * Ng)
+                          (a dataset.DatasetWriter, if DS_FORMAT is 'shards')
     """
     logger.log('Initialization...')
 
     U = _init_U()
-    h_hist = _init_h_hist(U)
-    t_hist = np.zeros(len(h_hist), dtype=conf.DTYPE)
+    if conf.AUTOTUNE:
+        autotune.autotune(U)
+    if conf.MEMORY_LIMIT:
+        memory_planner.enforce(conf.MEMORY_LIMIT)
+    num_states = _num_states_to_save(U)
+    h_hist = _init_h_hist(U, num_states)
+    t_hist = np.zeros(num_states, dtype=conf.DTYPE)
     if conf.SAVE_DS_FOR_ML:
         U_ds = _init_U_ds(U)
     else:
@@ -0,0 +1,178 @@
+# live_preview.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Shows the solution live, at a separate process, while it is computed."""
+
+#   solver ---> FrameSlot (shared memory) ---> viewer process (raster)
+#
+# The slot holds only the latest frame. The solver overwrites it without
+# waiting (seqlock: the sequence is odd while a frame is being written) and
+# the viewer keeps a frame only if the sequence did not change while it was
+# copying it.
+#
+# slot layout: [seq, it, closed, -] (int64) | [time] (float64) | frame
+
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from timeit import default_timer as timer
+
+import numpy as np
+
+from mattflow import config as conf, logger, raster, utils
+
+_HEADER_BYTES = 48
+
+
+class FrameSlot:
+    """A single-frame, shared-memory slot, guarded by a seqlock.
+
+    Args:
+        frame_shape (tuple) : shape of the frame
+        name (str)          : attach to an existing slot (default: create a
+                              new one)
+        dtype (np.dtype)    : dtype of the frame
+    """
+
+    def __init__(self, frame_shape, name=None, dtype=conf.DTYPE):
+        self.frame_shape = tuple(frame_shape)
+        frame_bytes = int(np.prod(frame_shape)) * np.dtype(dtype).itemsize
+        self._owner = name is None
+        self._shm = shared_memory.SharedMemory(
+            name=name, create=self._owner, size=_HEADER_BYTES + frame_bytes
+        )
+        self.name = self._shm.name
+        self._header = np.ndarray((4,), dtype=np.int64, buffer=self._shm.buf)
+        self._time = np.ndarray((1,), dtype=np.float64, buffer=self._shm.buf,
+                                offset=32)
+        self._frame = np.ndarray(self.frame_shape, dtype=dtype,
+                                 buffer=self._shm.buf, offset=_HEADER_BYTES)
+        if self._owner:
+            self._header[:] = 0
+
+    @property
+    def seq(self):
+        return int(self._header[0])
+
+    @property
+    def closed(self):
+        """The writer will not write any more frames."""
+        return bool(self._header[2])
+
+    def write(self, frame, time, it):
+        self._header[0] += 1
+        self._frame[...] = frame
+        self._header[1] = it
+        self._time[0] = time
+        self._header[0] += 1
+
+    def read(self, last_seq=0):
+        """Copies the frame, if a new (and complete) one has been written.
+
+        Returns:
+            (seq, frame, time, it) or None
+        """
+        seq = self.seq
+        if seq == last_seq or seq % 2:
+            return None
+        frame = self._frame.copy()
+        it = int(self._header[1])
+        time = float(self._time[0])
+        if self.seq != seq:
+            # overwritten while copying
+            return None
+        return seq, frame, time, it
+
+    def mark_closed(self):
+        self._header[2] = 1
+
+    def close(self):
+        # The arrays have to be released, before the memory is unmapped.
+        del self._header, self._time, self._frame
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def _viewer(slot_name, frame_shape, fps, config_snapshot):
+    """The loop of the viewer process."""
+    utils.restore_config(config_snapshot)
+    import matplotlib.pyplot as plt
+
+    slot = FrameSlot(frame_shape, name=slot_name)
+    renderer = raster.raster_renderer()
+    fig = plt.figure(figsize=(6, 6.4))
+    ax = fig.add_axes([0, 0, 1, 0.94])
+    ax.axis('off')
+    image = ax.imshow(renderer.render(np.ones(frame_shape)),
+                      interpolation='nearest')
+    title = fig.text(0.5, 0.96, "waiting for the solver", ha='center')
+    plt.show(block=False)
+
+    seq = 0
+    try:
+        while plt.fignum_exists(fig.number) and not slot.closed:
+            latest = slot.read(seq)
+            if latest is not None:
+                seq, frame, time, it = latest
+                image.set_data(renderer.render(frame))
+                title.set_text(f"time: {time:>{6}.3f}    iter: {it:>{4}d}")
+            plt.pause(1 / fps)
+    finally:
+        plt.close(fig)
+        slot.close()
+
+
+class LivePreview:
+    """Publishes the frames of the solver to a viewer process.
+
+    publish() never waits for the viewer, and it copies a frame only if the
+    viewer is due for a new one, so it costs close to nothing per iteration.
+
+    Args:
+        frame_shape (tuple) : shape of the frame
+        fps (int)           : frames per second of the viewer
+    """
+
+    def __init__(self, frame_shape, fps=15):
+        self.slot = FrameSlot(frame_shape)
+        self.interval = 1 / fps
+        self._next_publish = 0.
+        self.published = 0
+        # spawn: the viewer starts a GUI, which does not survive a fork
+        ctx = mp.get_context("spawn")
+        self._viewer = ctx.Process(
+            target=_viewer,
+            args=(self.slot.name, frame_shape, fps, utils.config_snapshot()),
+            daemon=True
+        )
+        self._viewer.start()
+
+    def publish(self, frame, time, it):
+        now = timer()
+        if now < self._next_publish:
+            return
+        self._next_publish = now + self.interval
+        self.slot.write(frame, time, it)
+        self.published += 1
+
+    def close(self):
+        """Stops the viewer and releases the shared memory."""
+        self.slot.mark_closed()
+        self._viewer.join(timeout=5)
+        if self._viewer.is_alive():
+            self._viewer.terminate()
+        self.slot.close()
+        logger.log(f"Live preview | published frames: {self.published}")
+
+
+def live_preview():
+    """Creates a LivePreview, configured by the PREVIEW_* options."""
+    return LivePreview((conf.Ny, conf.Nx), fps=conf.PREVIEW_FPS)
@@ -0,0 +1,152 @@
+# lod.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Level of detail (LOD) of the 3D plots, decimating the height fields."""
+
+# A frame of FIG_HEIGHT * DPI pixels cannot show more than a few hundred
+# cells per side, so the height field is reduced in blocks of factor x factor
+# cells, before it reaches plot_surface():
+#
+#   [a b | c d]
+#   [e f | g h]   --->  [mean(a b e f) | mean(c d g h)]   (area-averaged)
+#                       [max(a b e f)  | max(c d g h) ]   (max-preserving)
+
+import math
+
+import numpy as np
+
+from mattflow import config as conf
+
+_REDUCTIONS = {"mean": np.mean, "max": np.max}
+
+
+def lod_factor(shape, frame_height, pixels_per_cell=4):
+    """Decimation factor that fits a grid to the polygon budget of a frame.
+
+    Args:
+        shape (tuple)         : (Ny, Nx) of the grid
+        frame_height (int)    : height of the frame, in pixels
+        pixels_per_cell (int) : minimum pixels per plotted cell (side)
+
+    Returns:
+        factor (int) : 1 means full resolution
+    """
+    budget = max(1, int(frame_height // pixels_per_cell))
+    return max(1, math.ceil(max(shape) / budget))
+
+
+def decimate(Z, factor, mode="mean"):
+    """Reduces the last two axes of Z in blocks of factor x factor cells.
+
+    The grid is padded with its edge values, if its dimensions are not
+    multiples of the factor.
+
+    Args:
+        Z (array)    : shape: (..., Ny, Nx)
+        factor (int) : block size
+        mode (str)   : 'mean' (area-averaged) or 'max' (keeps the crests)
+
+    Returns:
+        Z_lod (array) : shape: (..., ceil(Ny / factor), ceil(Nx / factor))
+    """
+    Z = np.asarray(Z)
+    if factor == 1:
+        return Z
+    ny, nx = Z.shape[-2:]
+    pad = [(0, 0)] * (Z.ndim - 2) + [(0, -ny % factor), (0, -nx % factor)]
+    Z_pad = np.pad(Z, pad, mode="edge")
+    blocks = Z_pad.reshape(Z.shape[:-2] + (Z_pad.shape[-2] // factor, factor,
+                                           Z_pad.shape[-1] // factor, factor))
+    return _REDUCTIONS[mode](blocks, axis=(-3, -1)).astype(Z.dtype)
+
+
+class LODHistory:
+    """Read-only view of h_hist at a lower level of detail.
+
+    The frames are decimated in batches of <batch_frames>, as they are
+    requested, and the last batch is kept (the animation reads the frames
+    in order).
+
+    Args:
+        h_hist (array)     : array of iter-wise heights solutions (or a
+                             frame_history sink)
+        factor (int)       : decimation factor
+        mode (str)         : 'mean' or 'max'
+        batch_frames (int) : frames decimated at once
+    """
+
+    def __init__(self, h_hist, factor, mode="mean", batch_frames=16):
+        self.h_hist = h_hist
+        self.factor = factor
+        self.mode = mode
+        self.batch_frames = batch_frames
+        self._batch = (None, None)
+
+    def __len__(self):
+        return len(self.h_hist)
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("frame index out of range")
+        batch_idx = idx // self.batch_frames
+        if self._batch[0] != batch_idx:
+            start = batch_idx * self.batch_frames
+            frames = self.h_hist[start: start + self.batch_frames]
+            self._batch = (batch_idx,
+                           decimate(frames, self.factor, self.mode))
+        return self._batch[1][idx % self.batch_frames]
+
+
+def plot_factor():
+    """Decimation factor of the 3D plots, configured by the LOD_* options."""
+    if not conf.LOD or conf.PLOTTING_STYLE == 'raster':
+        return 1
+    return lod_factor((conf.Ny, conf.Nx), conf.FIG_HEIGHT * conf.DPI,
+                      conf.LOD_PIXELS_PER_CELL)
+
+
+def plot_grid(factor=None):
+    """Meshgrid of the cell centers (without the ghost cells), decimated."""
+    factor = plot_factor() if factor is None else factor
+    X, Y = np.meshgrid(conf.CX[conf.Ng: -conf.Ng], conf.CY[conf.Ng: -conf.Ng])
+    return decimate(X, factor), decimate(Y, factor)
+
+
+def mip_level(h_hist, factor, mode):
+    """Highest mip level of h_hist that the decimation by <factor> can start
+    from (0: the full frames)."""
+    level = 0
+    if getattr(h_hist, "mip_mode", None) == mode:
+        while (level < h_hist.mip_levels
+               and factor % 2 ** (level + 1) == 0):
+            level += 1
+    return level
+
+
+def plot_history(h_hist, factor=None):
+    """Returns h_hist at the level of detail of the 3D plots.
+
+    If h_hist stores a mip pyramid (see frame_history), the decimation starts
+    from the closest level, instead of the full frames.
+    """
+    factor = plot_factor() if factor is None else factor
+    if factor == 1:
+        return h_hist
+    level = mip_level(h_hist, factor, conf.LOD_MODE)
+    if level:
+        h_hist = h_hist.level(level)
+        factor //= 2 ** level
+        if factor == 1:
+            return h_hist
+    return LODHistory(h_hist, factor, conf.LOD_MODE)
@@ -11,8 +11,10 @@
 # ======================================================================
 """Handles the logging precess."""
 
+import atexit
 from datetime import datetime, timedelta
 import os
+import threading
 
 from mattflow import config as conf
 from mattflow import __version__, __author__, __license__
@@ -26,42 +28,115 @@ author_msg = 'Author: ' + __author__ + ', 2019'
 license_msg = __license__
 
 
+def _header():
+    return (
+        version_msg + '\n' + author_msg + '\n' + license_msg + '\n'
+        + len(license_msg) * '-' + '\n'
+        + str(datetime.now())[:19] + '\n\n'
+        + 'Configuration of the simulation' + '\n'
+        + 31 * '-' + '\n'
+        + 'Number of cells        : ' + str(conf.Nx * conf.Ny) + '\n'
+        + 'Number of ghost cells  : ' + str(conf.Ng) + '\n'
+        + 'Courant number         : ' + str(conf.COURANT) + '\n'
+        + 'Simulation mode        : ' + str(conf.MODE) + '\n'
+        + 'Boundary conditions    : ' + str(conf.BOUNDARY_CONDITIONS) + '\n'
+        + 'Solver type            : ' + str(conf.SOLVER_TYPE) + '\n'
+        + 'Plotting style         : ' + str(conf.PLOTTING_STYLE) + '\n\n'
+    )
+
+
+class _LogWriter:
+    """Holds the log file open and buffers the records, which are written by
+    a background thread every <flush_interval> sec, or as soon as
+    <buffer_records> records are pending.
+
+    Args:
+        path (str)             : the log file
+        mode (str)             : 'w' (new log) or 'a' (open log)
+        flush_interval (float) : max seconds that a record is buffered
+        buffer_records (int)   : max number of buffered records
+    """
+
+    def __init__(self, path, mode, flush_interval=1., buffer_records=1024):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.buffer_records = buffer_records
+        self._file = open(path, mode)
+        self._records = []
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, record):
+        with self._lock:
+            self._records.append(record)
+            full = len(self._records) >= self.buffer_records
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        # The solver only waits for the swap of the buffer, not for the disk.
+        with self._io_lock:
+            with self._lock:
+                records, self._records = self._records, []
+            if records and not self._file.closed:
+                self._file.write('\n'.join(records) + '\n')
+                self._file.flush()
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        self._file.close()
+
+
+# The writer of the log file of this process (opened by the 1st record)
+_writer = None
+
+
+def _open_writer():
+    """Opens the log file, continuing an open log, if there is one, or else
+    creating a new one, headed by the simulation info."""
+    open_log = find_open_log()
+    if open_log:
+        # Update log name with the current time.
+        os.rename(open_log, file_name)
+        writer = _LogWriter(file_name, 'a', conf.LOG_FLUSH_INTERVAL,
+                            conf.LOG_BUFFER_RECORDS)
+    else:
+        writer = _LogWriter(file_name, 'w', conf.LOG_FLUSH_INTERVAL,
+                            conf.LOG_BUFFER_RECORDS)
+        # Written at once, so that the file is recognized as a mattflow log.
+        writer.write(_header().rstrip('\n') + '\n')
+        writer.flush()
+    return writer
+
+
 def log(state):
     """Appends a state-message at a new line of the log file.
 
     If a log file does not exist, it creates one, printing the simulation info.
+    The messages are buffered and written in the background (see flush()).
 
     Args:
         state (str) : the string to be logged
     """
+    global _writer
     if not conf.LOGGING_MODE:
         return
-    open_log = find_open_log()
-
-    if open_log:
-        # Append the state.
-        with open(open_log, 'a') as fa:
-            fa.write(state + '\n')
-        # Update log name with the current time.
-        os.rename(open_log, file_name)
-    else:
-        fw = open(file_name, 'w')
-        fw.write(
-            version_msg + '\n' + author_msg + '\n' + license_msg + '\n'
-            + len(license_msg) * '-' + '\n'
-            + str(datetime.now())[:19] + '\n\n'
-            + 'Configuration of the simulation' + '\n'
-            + 31 * '-' + '\n'
-            + 'Number of cells        : ' + str(conf.Nx * conf.Ny) + '\n'
-            + 'Number of ghost cells  : ' + str(conf.Ng) + '\n'
-            + 'Courant number         : ' + str(conf.COURANT) + '\n'
-            + 'Simulation mode        : ' + str(conf.MODE) + '\n'
-            + 'Boundary conditions    : ' + str(conf.BOUNDARY_CONDITIONS) + '\n'
-            + 'Solver type            : ' + str(conf.SOLVER_TYPE) + '\n'
-            + 'Plotting style         : ' + str(conf.PLOTTING_STYLE) + '\n\n')
-
-        fw.write(state + '\n')
-        fw.close()
+    if _writer is None:
+        _writer = _open_writer()
+    _writer.write(state)
 
 
 def log_timestep(it, time):
@@ -73,6 +148,23 @@ def log_timestep(it, time):
     log(f"{it: >{6}d}    {time:0.3f}")
 
 
+def flush():
+    """Writes the buffered messages to the log file."""
+    if _writer is not None:
+        _writer.flush()
+
+
+def _reset_after_fork():
+    # The writer thread does not survive the fork.
+    global _writer
+    _writer = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(flush)
+
+
 def find_open_log():
     """Returns the 1st encountered open log file (False if there isn't one).
 
@@ -89,29 +181,22 @@ def find_open_log():
 
 def close():
     """Closes the log file, appending '_done' to the file name."""
+    global _writer
     if not conf.LOGGING_MODE:
         return
-    try:
-        open_log = find_open_log()
-        if open_log:
-            # append blank line
-            with open(open_log, 'a') as fa:
-                fa.write('\n')
-            # append '_done' at the file name
-            os.rename(open_log, file_name[:-4] + '_done'
-                      + file_name[-4:])
-        else:
-            fw = open(file_name, 'w')
+    if _writer is None and find_open_log():
+        _writer = _open_writer()
+    if _writer is not None:
+        # append blank line
+        _writer.write('')
+        _writer.close()
+        _writer = None
+        # append '_done' at the file name
+        os.rename(file_name, file_name[:-4] + '_done' + file_name[-4:])
+    else:
+        with open(file_name, 'w') as fw:
             fw.write('Trying to close a log file that does not exist...\n\n')
-            os.rename(open_log, file_name[:-4] + '_errored'
-                      + file_name[-4:])
-            fw.close()
-    except TypeError:
-        fw = open(file_name, 'w')
-        fw.write('Trying to close a log file that does not exist...\n\n')
-        os.rename(open_log, file_name[:-4] + '_errored'
-                  + file_name[-4:])
-        fw.close()
+        os.rename(file_name, file_name[:-4] + '_errored' + file_name[-4:])
 
 
 def is_open(log_file: str):
@@ -134,6 +219,7 @@ def log_duration(start, end, process):
     """Logs the duration of a process."""
     process_name = {
         "main": "Total",
+        "_simulate": "Total",
         "simulate": "Solution",
         "createAnimation": "Post-processing"
     }
@@ -11,14 +11,18 @@
 # ======================================================================
 """Handles the post-processing of the simulation."""
 
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import glob
 import os
 
 import numpy as np
 import matplotlib.animation as animation
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
 
-from mattflow import config as conf, logger, utils, __version__
+from mattflow import (config as conf, frame_cache, lod, logger, raster,
+                      resampling, utils, __version__)
 from mattflow.utils import time_this
 
 
@@ -49,47 +53,40 @@ def _plot_basin(sub):
         logger.log("Configure SHOW_BASIN. Options: True, False")
 
 
-def _data_from_dat(it):
-    """Pulls solution data from a .dat file."""
-    zeros_left = (4 - len(str(it))) * '0'
-    file_name = 'solution' + zeros_left + str(it) + '.dat'
+def _dat_path(it, data_dir=None):
+    if data_dir is None:
+        data_dir = os.path.join(os.getcwd(), "data_files")
+    return os.path.join(data_dir, f"solution{it:0>{4}}.dat")
+
 
-    dat_path = os.path.join(os.getcwd(), "data_files", file_name)
+def _data_from_dat(dat_path):
+    """Pulls solution data from a .dat file."""
     with open(dat_path, 'r') as fr:
         Nx = int(fr.readline().split(":")[1])
         Ny = int(fr.readline().split(":")[1])
         # Ng = int(fr.readline().split(":")[1])
+        fr.readline()
         time = float(fr.readline().split(":")[1])
 
     # hu and hv are not written in the dat file, to reduce the overhead.
-    # x, y, h, hu, hv = np.loadtxt('./data_files/' + file_name, skiprows = 4,
-    #                              unpack = True)
-    x, y, h = np.loadtxt('./data_files/' + file_name, skiprows=4, unpack=True)
+    # x, y, h, hu, hv = np.loadtxt(dat_path, skiprows = 4, unpack = True)
+    x, y, h = np.loadtxt(dat_path, skiprows=4, unpack=True)
     # Unpack the row-major vectors into matrices.
     X = x.reshape(Ny, Nx)
     Y = y.reshape(Ny, Nx)
     Z = h.reshape(Ny, Nx)
-    return X, Y, Z, Nx, Ny
+    return X, Y, Z, time
 
 
-def plot_from_dat(time, it):
-    """Creates and saves a frame as .png, reading data from a .dat file.
+# The figure of plot_from_dat(), reused by all the frames of the process
+_dat_fig = None
 
-    Args:
-        time (float) : current time
-        it (int)     : current itereration
-    """
-    # Create ./session directory for saving the results.
-    utils.child_dir("session")
 
-    # Extract data from dat.
-    X, Y, Z, Nx, Ny = _data_from_dat(it)
-
-    # plot {
-    #
-    fig = plt.figure(figsize=(9.6, 6.4), dpi=112)  # 1080x720
+def _plot_dat_frame(fig, X, Y, Z, time, it):
+    """Plots a frame on the (cleared) figure."""
+    fig.clear()
     sub = fig.add_subplot(111, projection="3d")
-    plt.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
+    fig.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
 
     if conf.PLOTTING_STYLE == 'water':
         if conf.ROTATION:
@@ -116,73 +113,136 @@ def plot_from_dat(time, it):
             sub.view_init(45, 55)
         sub.plot_wireframe(X, Y, Z, rstride=2, cstride=2, linewidth=1,)
     else:
-        styles = ['water', 'contour', 'wireframe']
+        styles = ['water', 'contour', 'wireframe', 'raster']
         logger.log(f"Configure PLOTTING_STYLE | options: {styles}")
 
-    fig.gca().set_zlim([-0.5, 4])
-    plt.title(f"time: {time: >{6}.3f}\titer: {it: >{4}d}", y=0.8, fontsize=18)
+    sub.set_zlim([-0.5, 4])
+    sub.set_title(f"time: {time: >{6}.3f}    iter: {it: >{4}d}", y=0.8,
+                  fontsize=18)
     sub.title.set_position([0.51, 0.80])
     plt.rcParams.update({'font.size': 20})
-    plt.axis('off')
+    sub.axis('off')
 
     # Render the basin that contains the fluid.
     _plot_basin(sub)
 
-    # save
-    # fig.tight_layout()
+
+def _render_dat(dat_path, it, fig_file, time=None):
+    """Renders the frame of a .dat file to a .png.
+
+    Args:
+        dat_path (str) : the .dat file
+        it (int)       : iteration of the frame
+        fig_file (str) : the .png file
+        time (float)   : time of the frame (default: read from the .dat)
+    """
+    global _dat_fig
+    X, Y, Z, dat_time = _data_from_dat(dat_path)
+    time = dat_time if time is None else time
+
+    if conf.PLOTTING_STYLE == 'raster':
+        renderer = raster.raster_renderer(frame_height=720)
+        plt.imsave(fig_file, renderer.render(Z))
+        return
+
+    if conf.LOD:
+        factor = lod.lod_factor(Z.shape, 720, conf.LOD_PIXELS_PER_CELL)
+        X, Y = lod.decimate(X, factor), lod.decimate(Y, factor)
+        Z = lod.decimate(Z, factor, conf.LOD_MODE)
+
+    if _dat_fig is None:
+        # An offscreen figure, reused by the frames (building a figure costs
+        # more than plotting a frame).
+        _dat_fig = Figure(figsize=(9.6, 6.4), dpi=112)  # 1080x720
+        FigureCanvasAgg(_dat_fig)
+    _plot_dat_frame(_dat_fig, X, Y, Z, time, it)
+    _dat_fig.savefig(fig_file)
+
+
+def plot_from_dat(time, it):
+    """Creates and saves a frame as .png, reading data from a .dat file.
+
+    Args:
+        time (float) : current time
+        it (int)     : current itereration
+    """
+    # Create ./session directory for saving the results.
+    utils.child_dir("session")
     fig_file = os.path.join("session", f"iter_{it:0>{4}}.png")
-    plt.savefig(fig_file)
-    plt.close()
-    #
-    # }
+    _render_dat(_dat_path(it), it, fig_file, time)
+
+
+def _init_dat_worker(config_snapshot):
+    utils.restore_config(config_snapshot)
+
+
+def _render_dat_task(dat_path, it, fig_file):
+    _render_dat(dat_path, it, fig_file)
+    return it
 
 
-def _save_ani(ani):
-    """Saves the animation in .mp4 and .gif formats.
+def _dat_frames(data_dir):
+    """Yields the (iteration, path) of the solution*.dat files."""
+    for dat_path in sorted(glob.glob(os.path.join(data_dir,
+                                                  "solution*.dat"))):
+        digits = os.path.basename(dat_path)[len("solution"): -len(".dat")]
+        if digits.isdigit():
+            yield int(digits), dat_path
+
+
+def _up_to_date(fig_file, dat_path):
+    return (os.path.isfile(fig_file)
+            and os.path.getmtime(fig_file) >= os.path.getmtime(dat_path))
+
+
+@time_this
+def render_dats(data_dir, session_dir="session", workers=None, force=False):
+    """Renders all the solution*.dat files of a directory to .png files, on
+    a process pool (each worker reuses a single figure).
 
     Args:
-        ani (obj) : animation.FuncAnimation() object
+        data_dir (str)    : directory with the .dat files
+        session_dir (str) : where the iter_XXXX.png files are saved
+        workers (int)     : rendering processes (default: the cpu count)
+        force (bool)      : re-render the frames with an up-to-date .png
+
+    Returns:
+        rendered (list) : iterations of the rendered frames
     """
-    dpi = conf.DPI
-    fps = conf.FPS
-    # file name
-    date_n_time = str(datetime.now())[:19]
-    # Replace ':' with '-' for compatibility with windows file formating.
-    date_n_time = date_n_time.replace(':', '-').replace(' ', '_')
-    file_name = conf.MODE + '_animation_' + date_n_time
-
-    # Configure the writer
-    plt.rcParams['animation.ffmpeg_path'] = conf.PATH_TO_FFMPEG
-    FFwriter = animation.FFMpegWriter(
-        fps=fps, bitrate=-1,
-        extra_args=['-r', str(fps), '-pix_fmt', 'yuv420p', '-vcodec',
-                    'libx264', '-qscale:v', '1']
-    )
+    os.makedirs(session_dir, exist_ok=True)
+    dat_frames = list(_dat_frames(data_dir))
+    if conf.Nx is None and dat_frames:
+        # No pre-processing took place, take the grid from the .dat files.
+        X, Y, _, _ = _data_from_dat(dat_frames[0][1])
+        conf.Ny, conf.Nx = X.shape
+        conf.dx, conf.dy = X[0, 1] - X[0, 0], Y[1, 0] - Y[0, 0]
+    tasks = []
+    skipped = 0
+    for it, dat_path in dat_frames:
+        fig_file = os.path.join(session_dir, f"iter_{it:0>{4}}.png")
+        if not force and _up_to_date(fig_file, dat_path):
+            skipped += 1
+        else:
+            tasks.append((dat_path, it, fig_file))
 
-    # Save
-    try:
-        ani.save(os.path.join(conf.SAVE_DIR, f"{file_name}.{conf.VID_FORMAT}"),
-                 writer=FFwriter,
-                 dpi=dpi)
-
-        # log only if a log file is already initialzed
-        if isinstance(logger.find_open_log(), str):
-            logger.log(f'Animation saved as: {file_name}.'
-                       f'{conf.VID_FORMAT} | fps: {fps}')
-
-        # convert to a lighter gif
-        cmd = (f'ffmpeg -i {file_name}.{conf.VID_FORMAT} -vf '
-               f'"fps={fps},scale=240:-1:flags=lanczos,split'
-               '[s0][s1];[s0]palettegen[p];[s1][p]paletteuse" -hide_banner'
-               f' -loglevel panic -loop 0 {file_name}.gif')
-        os.system(cmd)
-        if isinstance(logger.find_open_log(), str):
-            logger.log(f'Animation saved as: {file_name}.gif | fps: {fps}')
-    except FileNotFoundError:
-        logger.log('Configure PATH_TO_FFMPEG')
-
-
-def _update_plot(frame_number, X, Y, Z, plot, fig, sub, t_hist, ani_title):
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) <= 1:
+        rendered = [_render_dat_task(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_dat_worker,
+                                 initargs=(utils.config_snapshot(),)) as pool:
+            rendered = list(pool.map(_render_dat_task, *zip(*tasks),
+                                     chunksize=4))
+    summary = (f"Rendered {len(rendered)} .dat files to {session_dir}"
+               f" | up to date: {skipped}")
+    logger.log(summary)
+    print(summary)
+    return rendered
+
+
+def _update_plot(frame_number, X, Y, Z, plot, fig, sub, t_hist, ani_title,
+                 iterations=None):
     """Plots a single frame.
 
     It is used from FuncAnimation to iteratively create an animation.
@@ -195,14 +255,13 @@ def _update_plot(frame_number, X, Y, Z, plot, fig, sub, t_hist, ani_title):
         sub (subplot)       : Axes3D subplot object
         t_hist (list)       : holds the iter-wise times
         ani_title (str)     : to be formated with the frame_number
+        iterations (array)  : iterations of the frames (default: derived from
+                              the frame_number)
     """
     if conf.PLOTTING_STYLE == 'water':
         plot[0].remove()
         if conf.ROTATION:
-            # Azimuthal rotate every 2 frames and vetical every 4 frames
-            azimuth = 45 + frame_number / 2
-            elevation = 55 - frame_number / 4
-            sub.view_init(elevation, azimuth)
+            sub.view_init(*_view_angle(frame_number))
         plot[0] = sub.plot_surface(X, Y, Z[frame_number],
                                    rstride=1, cstride=1, linewidth=0,
                                    color=(0.251, 0.643, 0.875, 0.95),
@@ -213,86 +272,193 @@ def _update_plot(frame_number, X, Y, Z, plot, fig, sub, t_hist, ani_title):
         # That's why fig is passed (matplotlib==3.3.1).
         sub.clear()
         sub.view_init(45, 55)
-        plt.subplots_adjust(left=0, bottom=0, right=1, top=1,
+        fig.subplots_adjust(left=0, bottom=0, right=1, top=1,
                             wspace=0, hspace=0)
-        fig.gca().set_zlim([-0.5, 4])
-        plt.axis('off')
+        sub.set_zlim([-0.5, 4])
+        sub.axis('off')
         plot[0] = sub.contour3D(X, Y, Z[frame_number], 120, cmap='ocean',
                                 vmin=0.5, vmax=1.5)
     elif conf.PLOTTING_STYLE == 'wireframe':
         plot[0].remove()
         if conf.ROTATION:
-            # Azimuthal rotate every 2 frames and vetical every 4 frames
-            azimuth = 45 + frame_number / 2
-            elevation = 55 - frame_number / 4
-            sub.view_init(elevation, azimuth)
+            sub.view_init(*_view_angle(frame_number))
         plot[0] = sub.plot_wireframe(X, Y, Z[frame_number],
                                      rstride=2, cstride=2, linewidth=1)
 
-    # Reverse engineer the iteration.
-    it = (
-        frame_number
-        + ((frame_number // conf.FRAMES_PER_PERIOD)
-           * (conf.FRAME_SAVE_FREQ - conf.FRAMES_PER_PERIOD))
-    )
-
     # Frame title
-    if t_hist is None:
-        ani_title = f"iter: {it:>{4}d}"
-    else:
-        ani_title = f"time: {t_hist[frame_number]:>{6}.3f}    iter: {it:>{4}d}"
-    plt.title(ani_title, y=0.8, fontsize=18)
+    ani_title = _frame_title(frame_number, t_hist, iterations)
+    sub.set_title(ani_title, y=0.8, fontsize=18)
     sub.title.set_position([0.51, 0.80])
 
 
-@time_this
-def animate(h_hist, t_hist=None):
-    """Generates and saves an animation of the simulation.
+def _view_angle(frame_number):
+    """(elevation, azimuth) of the frame."""
+    if conf.PLOTTING_STYLE == 'contour':
+        return 45, 55
+    if conf.ROTATION:
+        # Azimuthal rotate every 2 frames and vetical every 4 frames
+        return 55 - frame_number / 4, 45 + frame_number / 2
+    return 30, 20
+
+
+def frame_key(frame, frame_number, t_hist=None, iterations=None):
+    """Identifies a rendered frame at the FrameCache, by its content.
 
     Args:
-        h_hist (array) :  array of iter-wise heights solutions
-        t_hist (array) :  holds the iter-wise times
+        frame (2D array)   : the plotted heights (at the level of detail)
+        frame_number (int) : index of the frame at the animation
+        t_hist (array)     : holds the iter-wise times
+        iterations (array) : iterations of the frames
+    """
+    return (frame_cache.content_hash(frame), frame.shape,
+            _frame_title(frame_number, t_hist, iterations),
+            conf.PLOTTING_STYLE, _view_angle(frame_number), conf.DPI,
+            conf.FIG_HEIGHT, conf.SHOW_BASIN)
 
-    Returns:
-        ani (animation.FuncAnimation) : It is returned in case of ipython
+
+def rendered_frame_cache():
+    """The FrameCache of the 3D frames (None, if caching is disabled)."""
+    if conf.PLOTTING_STYLE == 'raster':
+        return None
+    return frame_cache.frame_cache()
+
+
+class _CachedPlayback:
+    """Updates the frames of the animation, showing the cached frames as an
+    image, instead of re-plotting them.
+
+    The frames that are plotted are captured when they are drawn and cached,
+    so every frame is plotted once, even if the animation is repeated.
     """
-    # resolution = figsize * dpi
-    # --------------------------
-    # example:
-    # figsize = (9.6, 5.4), dpi=200
-    # resolution: 1920x1080 (1920/200=9.6)
-    fps = conf.FPS
-    dpi = conf.DPI
-    figsize = (conf.FIG_HEIGHT * 1.618, conf.FIG_HEIGHT)
 
-    # total frames
-    frames = len(h_hist)
+    def __init__(self, fig, sub, cache, Z, t_hist=None, iterations=None):
+        self.sub = sub
+        self.cache = cache
+        self.Z = Z
+        self.t_hist = t_hist
+        self.iterations = iterations
+        # (height, width) of the frames rendered by the FrameRenderer
+        self.shape = (int(fig.get_figheight() * conf.DPI),
+                      int(fig.get_figwidth() * conf.DPI))
+        self.overlay = fig.add_axes([0, 0, 1, 1])
+        self.overlay.axis('off')
+        self.overlay.set_visible(False)
+        self.image = self.overlay.imshow(
+            np.zeros(self.shape + (3,), dtype=np.uint8),
+            aspect='auto', interpolation='nearest'
+        )
+        self._pending = None
+        fig.canvas.mpl_connect('draw_event', self._capture)
+
+    def update(self, frame_number, *update_args):
+        key = frame_key(self.Z[frame_number], frame_number, self.t_hist,
+                        self.iterations)
+        rgb = self.cache.get(key)
+        if rgb is None:
+            _update_plot(frame_number, *update_args)
+            self._pending = key
+        else:
+            self.image.set_data(rgb)
+        self.overlay.set_visible(rgb is not None)
+        self.sub.set_visible(rgb is None)
+
+    def _capture(self, event):
+        if self._pending is None:
+            return
+        key, self._pending = self._pending, None
+        try:
+            rgb = np.asarray(event.canvas.buffer_rgba())[..., :3]
+        except AttributeError:
+            # not an Agg based canvas
+            return
+        # Frames of hi-dpi screens do not match the exported frames.
+        if rgb.shape[:2] == self.shape:
+            self.cache.put(key, rgb)
+
+
+def _frame_title(frame_number, t_hist=None, iterations=None):
+    if iterations is None:
+        # Reverse engineer the iteration.
+        it = resampling.frame_iterations(frame_number)
+    else:
+        it = iterations[frame_number]
+    parts = []
+    if t_hist is not None:
+        parts.append(f"time: {t_hist[frame_number]:>{6}.3f}")
+    if it is not None:
+        parts.append(f"iter: {it:>{4}d}")
+    return "    ".join(parts)
 
-    # X, Y, Z
-    X, Y = np.meshgrid(conf.CX[conf.Ng: -conf.Ng], conf.CY[conf.Ng: -conf.Ng])
-    Z = h_hist
 
-    # Plot configuration
-    fig = plt.figure(figsize=figsize, dpi=dpi)
+def _update_raster(frame_number, Z, image, title, renderer, t_hist,
+                   iterations=None):
+    """Updates the image of a raster frame (used from FuncAnimation).
+
+    Args:
+        frame_number (int)        : current frame
+        Z (3D array)              : the heights
+        image (AxesImage)         : the image of the previous frame
+        title (Text)              : the frame title
+        renderer (RasterRenderer) : maps heights to RGB
+        t_hist (list)             : holds the iter-wise times
+        iterations (array)        : iterations of the frames
+    """
+    image.set_data(renderer.render(Z[frame_number]))
+    title.set_text(_frame_title(frame_number, t_hist, iterations))
+    return image, title
+
+
+def _raster_animation(fig, Z, t_hist=None, iterations=None):
+    """Creates the FuncAnimation of the raster (top-down) plotting style."""
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.axis('off')
+    renderer = raster.raster_renderer()
+    image = ax.imshow(renderer.render(Z[0]), interpolation='nearest')
+    title = fig.text(0.5, 0.96, _frame_title(0, t_hist, iterations),
+                     ha='center', fontsize=18)
+    fig.text(0.85, 0.06, s=f"MattFlow v{__version__}", fontsize=16, c='navy')
+    return animation.FuncAnimation(
+        fig, _update_raster, len(Z),
+        fargs=(Z, image, title, renderer, t_hist, iterations),
+        interval=1000 / conf.FPS,
+        blit=True,
+        repeat=True
+    )
+
+
+def _setup_figure(fig, t_hist=None):
+    """Adds and configures the Axes3D subplot of the animation figure.
+
+    Args:
+        fig (figure)   : a plt.figure or an offscreen Figure
+        t_hist (array) : holds the iter-wise times
+
+    Returns:
+        sub (subplot)   : Axes3D subplot object
+        ani_title (str) : title of the 1st frame
+    """
     sub = fig.add_subplot(111, projection="3d")
     if conf.ROTATION:
         sub.view_init(45, 55)
     else:
         sub.view_init(30, 20)
-    plt.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
-    fig.gca().set_zlim([-0.5, 4])
-    plt.axis('off')
+    fig.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
+    sub.set_zlim([-0.5, 4])
+    sub.axis('off')
     if t_hist is None:
         ani_title = f"iter: {0:>{5}d}"
     else:
         ani_title = f"time: {t_hist[0]:>{6}.3f}    iter: {0:>{5}d}"
-    plt.title(ani_title, y=0.8, fontsize=18)
+    sub.set_title(ani_title, y=0.8, fontsize=18)
     sub.title.set_position([0.51, 0.80])
     plt.rcParams.update({'font.size': 20})
     # Program name and version text
     fig.text(0.85, 0.06, s=f"MattFlow v{__version__}", fontsize=16, c='navy')
+    return sub, ani_title
 
-    # Plot initialization
+
+def _init_plot(sub, X, Y, Z):
+    """Plots the 1st frame, returning a list that holds the plot."""
     if conf.PLOTTING_STYLE == 'water':
         plot = [sub.plot_surface(X, Y, Z[0],
                                  rstride=1, cstride=1, linewidth=0,
@@ -305,22 +471,130 @@ def animate(h_hist, t_hist=None):
         plot = [sub.plot_wireframe(X, Y, Z[0], rstride=2, cstride=2,
                                    linewidth=1)]
     else:
-        logger.log("Configure PLOTTING_STYLE | options: 'water', 'contour',",
-                   "'wireframe'")
+        logger.log("Configure PLOTTING_STYLE | options: 'water', 'contour',"
+                   " 'wireframe'")
     # Render the basin that contains the fluid.
     _plot_basin(sub)
+    return plot
 
-    # Generate the animation.
-    ani = animation.FuncAnimation(
-        fig, _update_plot, frames,
-        fargs=(X, Y, Z, plot, fig, sub, t_hist, ani_title),
-        interval=1000 / fps,
-        repeat=True
-    )
+
+class FrameRenderer:
+    """Renders frames of the animation offscreen, on its own Agg figure.
+
+    The frames are identical to the ones of animate(), so it can be used to
+    render frames independently (e.g. on different processes).
+
+    Args:
+        t_hist (array)     : holds the iter-wise times
+        iterations (array) : iterations of the frames (default: derived from
+                             the frame_number)
+    """
+
+    def __init__(self, t_hist=None, iterations=None):
+        self.t_hist = t_hist
+        self.iterations = iterations
+        self.fig = Figure(figsize=(conf.FIG_HEIGHT * 1.618, conf.FIG_HEIGHT),
+                          dpi=conf.DPI)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.sub, self.ani_title = _setup_figure(self.fig, t_hist)
+        self.X, self.Y = lod.plot_grid()
+        self.plot = None
+
+    @property
+    def size(self):
+        """(width, height) of the rendered frames, in pixels"""
+        return self.canvas.get_width_height()
+
+    def render(self, frame, frame_number):
+        """Renders a frame of heights to an RGB array.
+
+        Args:
+            frame (2D array)   : the heights of the frame (full resolution
+                                 or already at the level of detail)
+            frame_number (int) : index of the frame at the animation
+
+        Returns:
+            rgb (3D array) : shape: (height, width, 3), dtype: uint8
+        """
+        if frame.shape != self.X.shape:
+            frame = lod.decimate(frame, lod.plot_factor(), conf.LOD_MODE)
+        # _update_plot() only indexes Z with the frame_number.
+        Z = {frame_number: frame}
+        if self.plot is None:
+            self.plot = _init_plot(self.sub, self.X, self.Y, [frame])
+        _update_plot(frame_number, self.X, self.Y, Z, self.plot, self.fig,
+                     self.sub, self.t_hist, self.ani_title, self.iterations)
+        self.canvas.draw()
+        return np.asarray(self.canvas.buffer_rgba())[..., :3].copy()
+
+
+@time_this
+def animate(h_hist, t_hist=None):
+    """Generates and saves an animation of the simulation.
+
+    Args:
+        h_hist (array) :  array of iter-wise heights solutions (or a lazy
+                          frame_history sink, read frame by frame)
+        t_hist (array) :  holds the iter-wise times
+
+    Returns:
+        ani (animation.FuncAnimation) : It is returned in case of ipython
+    """
+    # resolution = figsize * dpi
+    # --------------------------
+    # example:
+    # figsize = (9.6, 5.4), dpi=200
+    # resolution: 1920x1080 (1920/200=9.6)
+    fps = conf.FPS
+    dpi = conf.DPI
+    figsize = (conf.FIG_HEIGHT * 1.618, conf.FIG_HEIGHT)
+
+    # Resample the (sparsely) saved frames to uniform time spacing.
+    h_hist = resampling.resampled_history(h_hist, t_hist)
+    if isinstance(h_hist, resampling.ResampledHistory):
+        t_hist, iterations = h_hist.t_hist, h_hist.iterations
+    else:
+        iterations = None
+
+    # total frames
+    frames = len(h_hist)
+
+    # X, Y, Z (at the level of detail of the frame)
+    X, Y = lod.plot_grid()
+    Z = lod.plot_history(h_hist)
+    if X.shape != (conf.Ny, conf.Nx):
+        logger.log(f"LOD: {conf.Nx}x{conf.Ny} grid plotted at"
+                   f" {X.shape[1]}x{X.shape[0]} ({conf.LOD_MODE})")
+
+    # Plot configuration
+    fig = plt.figure(figsize=figsize, dpi=dpi)
+    if conf.PLOTTING_STYLE == 'raster':
+        ani = _raster_animation(fig, Z, t_hist, iterations)
+    else:
+        sub, ani_title = _setup_figure(fig, t_hist)
+
+        # Plot initialization
+        plot = _init_plot(sub, X, Y, Z)
+
+        # Generate the animation.
+        # (The cached frames are shown as images, instead of re-plotted.)
+        cache = rendered_frame_cache()
+        if cache is None:
+            update = _update_plot
+        else:
+            update = _CachedPlayback(fig, sub, cache, Z, t_hist,
+                                     iterations).update
+        ani = animation.FuncAnimation(
+            fig, update, frames,
+            fargs=(X, Y, Z, plot, fig, sub, t_hist, ani_title, iterations),
+            interval=1000 / fps,
+            repeat=True
+        )
 
     # Save the animation.
     if conf.SAVE_ANIMATION:
-        _save_ani(ani)
+        from mattflow import exporter
+        exporter.save_animation(h_hist, t_hist)
 
     # Play the animation.
     if conf.SHOW_ANIMATION is True:
@@ -19,11 +19,23 @@ import numpy as np
 
 from mattflow import (bcmanager,
                       config as conf,
+                      dataset,
                       dat_writer,
+                      diagnostics,
+                      field_stats,
                       flux,
+                      frame_history,
                       initializer,
+                      live_preview,
                       logger,
                       mattflow_post,
+                      memory_planner,
+                      output_pipeline,
+                      probes,
+                      profiler,
+                      scheduler,
+                      steady_state,
+                      throughput,
                       utils)
 from mattflow.utils import time_this
 
@@ -73,7 +85,8 @@ def _solve(U,
                               and (drops_count < conf.MAX_N_DROPS))
 
         if drop_condition:
-            U[0, :, :] = initializer.drop(U[0, :, :], drops_count + 1)
+            with profiler.phase("drops"):
+                U[0, :, :] = initializer.drop(U[0, :, :], drops_count + 1)
             drops_count += 1
             if ((conf.ITERS_BETWEEN_DROPS_MODE in ["custom", "random"])
                     and (drops_count < conf.MAX_N_DROPS)):
@@ -84,7 +97,9 @@ def _solve(U,
         if it % random.randrange(1, 15) == 0:
             simultaneous_drops = range(random.randrange(1, 2))
             for _ in simultaneous_drops:
-                U[0, :, :] = initializer.drop(U[0, :, :])
+                with profiler.phase("drops"):
+                    U[0, :, :] = initializer.drop(U[0, :, :])
+                drops_count += 1
     else:
         modes = ['drop', 'drops', 'rain']
         logger.log(f"Configure MODE | options: {modes}")
@@ -92,20 +107,30 @@ def _solve(U,
     # Numerical scheme
     # flux.flux() returns the total flux entering and leaving each cell.
     if conf.SOLVER_TYPE == 'Lax-Friedrichs Riemann':
-        U[:, Ng: -Ng, Ng: -Ng] += delta_t / cellArea * flux.flux(U)
+        with profiler.phase("flux"), throughput.flux():
+            F = flux.flux(U)
+            U[:, Ng: -Ng, Ng: -Ng] += delta_t / cellArea * F
     elif conf.SOLVER_TYPE == '2-stage Runge-Kutta':
         # 1st stage
-        U_pred = U
-        U_pred[:, Ng: -Ng, Ng: -Ng] += delta_t / cellArea * flux.flux(U)
+        with profiler.phase("flux stage 1"), throughput.flux():
+            U_pred = U
+            U_pred[:, Ng: -Ng, Ng: -Ng] += delta_t / cellArea * flux.flux(U)
 
         # 2nd stage
-        U[:, Ng: -Ng, Ng: -Ng] = \
-            0.5 * (U[:, Ng: -Ng, Ng: -Ng]
-                   + U_pred[:, Ng: -Ng, Ng: -Ng]
-                   + delta_t / cellArea * flux.flux(U_pred))
+        with profiler.phase("flux stage 2"), throughput.flux():
+            F = flux.flux(U_pred)
+            U[:, Ng: -Ng, Ng: -Ng] = \
+                0.5 * (U[:, Ng: -Ng, Ng: -Ng]
+                       + U_pred[:, Ng: -Ng, Ng: -Ng]
+                       + delta_t / cellArea * F)
     else:
         solver_types = ['Lax-Friedrichs Riemann', '2-stage Runge-Kutta']
         logger.log(f"Configure SOLVER_TYPE | Options: {solver_types}")
+        return U, drops_count, drop_its_iterator, next_drop_it
+
+    # The residual of the step, for the steady state detection
+    with profiler.phase("steady state"):
+        steady_state.observe(F)
     return U, drops_count, drop_its_iterator, next_drop_it
 
     '''
@@ -191,36 +216,167 @@ def _dt(U, epsilon=1e-4):
     return dt_final
 
 
+def _drop_its_iterator():
+    """Returns the iterator of the iterations at which the drops fall and the
+    iteration of the next drop (both None, if the drops fall every
+    ITERS_FOR_NEXT_DROP iters)."""
+    if conf.ITERS_BETWEEN_DROPS_MODE not in ["custom", "random"]:
+        return None, None
+    # List with the simulation iterations at which a drop is going to fall
+    drop_its = utils.drop_iters_list()
+    # Drop the 0th drop
+    drop_its_iterator = iter(drop_its[1:])
+    # The iteration at which the next drop will fall
+    try:
+        return drop_its_iterator, next(drop_its_iterator)
+    except StopIteration:
+        return None, None
+
+
+def _write_dat(pipeline, U, time, it):
+    """Writes the .dat file (and the .png) of the current iteration."""
+    frame = U[0, conf.Ng: conf.Ny + conf.Ng, conf.Ng: conf.Nx + conf.Ng]
+    if pipeline is not None:
+        pipeline.submit(frame, time, it)
+    else:
+        dat_writer.write_dat(frame, time, it)
+        mattflow_post.plot_from_dat(time, it)
+
+
+def _save_ds(U_ds, U, it, time, is_drop):
+    """Saves the state variables of the current iteration at the dataset."""
+    if conf.DS_FORMAT == "shards":
+        U_ds.write(U[:, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng],
+                   it, time, is_drop=is_drop)
+    else:
+        U_ds[it] = U[:, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng]
+
+
+def _open_outputs():
+    """Opens the .dat pipeline and the live preview (None, if not used)."""
+    # Writing and rendering overlaps with the solution (see output_pipeline).
+    if conf.WRITE_DAT and conf.ASYNC_OUTPUT:
+        pipeline = output_pipeline.dat_pipeline()
+    else:
+        pipeline = None
+    preview = live_preview.live_preview() if conf.LIVE_PREVIEW else None
+    return pipeline, preview
+
+
+def _close_outputs(pipeline, preview, h_hist, U_ds):
+    """Flushes and closes the outputs of the simulation.
+
+    Returns:
+        reports (list) : the reports of the outputs, as lines of text
+    """
+    reports = []
+    if pipeline is not None:
+        reports.append(output_pipeline.close_dat_pipeline(pipeline))
+    if preview is not None:
+        preview.close()
+    reports.append(frame_history.log_report(h_hist))
+    if isinstance(U_ds, dataset.DatasetWriter):
+        U_ds.close()
+    return reports
+
+
+def _grow(array):
+    """Doubles the length of a preallocated array."""
+    grown = np.zeros((2 * len(array),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def _save_frame(h_hist, t_hist, idx, frame, time):
+    """Saves the frame at h_hist[idx], growing the preallocated h_hist and
+    t_hist, if they are full (an estimate of the scheduler fell short)."""
+    if idx == len(t_hist):
+        t_hist = _grow(t_hist)
+        if isinstance(h_hist, np.ndarray):
+            h_hist = _grow(h_hist)
+    h_hist[idx] = frame
+    # time * 10 is insertd, because space is scaled about x10.
+    t_hist[idx] = time * 10
+    return h_hist, t_hist
+
+
+def _trim_history(h_hist, t_hist, n_frames):
+    """Trims the preallocated frames that were not used (the run ended
+    earlier than estimated).
+
+    A chunked h_hist holds only the appended frames, but t_hist is always
+    preallocated, so it is trimmed with any storage.
+    """
+    if isinstance(h_hist, np.ndarray):
+        h_hist = h_hist[:n_frames]
+    return h_hist, t_hist[:n_frames]
+
+
+class SimulationResult:
+    """The outcome of simulate().
+
+    It unpacks to (h_hist, t_hist, U_ds).
+
+    Args:
+        h_hist (array)           : the saved frames
+        t_hist (array)           : the times of the saved frames
+        U_ds (memmap)            : the dataset (None, if not SAVE_DS_FOR_ML)
+        throughput (Throughput)  : the throughput of the solver
+        diagnostics (array)      : the time series of the conserved
+                                   quantities (None, if not DIAGNOSTICS)
+        probes (Probes)          : the time series of h, u, v at the probe
+                                   points (None, if no PROBES)
+        field_stats (FieldStats) : the per-cell statistics of the height
+                                   (None, if not FIELD_STATS)
+        summary (list)           : the end-of-run reports, as lines of text
+                                   (already logged)
+    """
+
+    def __init__(self, h_hist, t_hist, U_ds, throughput, diagnostics=None,
+                 probes=None, field_stats=None, summary=None):
+        self.h_hist = h_hist
+        self.t_hist = t_hist
+        self.U_ds = U_ds
+        self.throughput = throughput
+        self.diagnostics = diagnostics
+        self.probes = probes
+        self.field_stats = field_stats
+        self.summary = summary or []
+
+    def __iter__(self):
+        return iter((self.h_hist, self.t_hist, self.U_ds))
+
+
 @time_this
 def simulate():
     time = 0
+    conf.RUN_ID = utils.new_run_id()
+    profiler.start()
 
     U, h_hist, t_hist, U_ds = initializer.initialize()
+    diagnostics.start(U)
+    probes.start(U)
+    field_stats.start(U)
+    steady_state.start()
     drops_count = 1
     # idx of the frame saved in h_hist
     saving_frame_idx = 0
-    # Counts up to conf.FRAMES_PER_PERIOD (1st frame saved at initialization).
-    consecutive_frames_counter = 1
-
-    if conf.ITERS_BETWEEN_DROPS_MODE in ["custom", "random"]:
-        # List with the simulation iterations at which a drop is going to fall
-        drop_its = utils.drop_iters_list()
-        # Drop the 0th drop
-        drop_its_iterator = iter(drop_its[1:])
-        # The iteration at which the next drop will fall
-        try:
-            next_drop_it = next(drop_its_iterator)
-        except StopIteration:
-            drop_its_iterator = None
-            next_drop_it = None
-    else:
-        drop_its_iterator = None
-        next_drop_it = None
+    # Decides which frames are saved (1st frame saved at initialization).
+    frame_scheduler = scheduler.frame_scheduler()
+    frame_scheduler.start(U[0, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng])
+
+    drop_its_iterator, next_drop_it = _drop_its_iterator()
 
+    pipeline, preview = _open_outputs()
+
+    # solved iterations
+    iterations = 0
+    throughput.start()
     for it in range(1, conf.MAX_ITERS):
 
         # Time discretization step (CFL condition)
-        delta_t = _dt(U)
+        with profiler.phase("cfl"):
+            delta_t = _dt(U)
 
         # Update current time
         time += delta_t
@@ -228,9 +384,12 @@ def simulate():
             break
 
         # Apply boundary conditions (reflective)
-        U = bcmanager.update_ghost_cells(U)
+        with profiler.phase("ghost cells"):
+            U = bcmanager.update_ghost_cells(U)
 
         # Numerical iterative scheme
+        prev_drops_count = drops_count
+        steady_state.arm(drops_count)
         U, drops_count, drop_its_iterator, next_drop_it = _solve(
             U=U,
             delta_t=delta_t,
@@ -240,34 +399,65 @@ def simulate():
             next_drop_it=next_drop_it
         )
 
+        with profiler.phase("diagnostics"):
+            diagnostics.record(it, time, U,
+                               is_drop=drops_count != prev_drops_count)
+        with profiler.phase("probes"):
+            probes.record(it, time, U)
+        with profiler.phase("field stats"):
+            field_stats.update(time, U)
+
+        if preview is not None:
+            with profiler.phase("io"):
+                preview.publish(U[0, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng],
+                                time, it)
+
         if conf.WRITE_DAT:
-            dat_writer.write_dat(
-                U[0, conf.Ng: conf.Ny + conf.Ng, conf.Ng: conf.Nx + conf.Ng],
-                time, it
-            )
-            mattflow_post.plot_from_dat(time, it)
+            with profiler.phase("io"):
+                _write_dat(pipeline, U, time, it)
         elif not conf.WRITE_DAT:
             # Append current frame to the list, to be animated at
             # post-processing.
-            if it % conf.FRAME_SAVE_FREQ == 0:
-                # Zero the counter, when a perfect division occurs.
-                consecutive_frames_counter = 0
-            if consecutive_frames_counter < conf.FRAMES_PER_PERIOD:
-                saving_frame_idx += 1
-                h_hist[saving_frame_idx] = \
-                    U[0, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng]
-                # time * 10 is insertd, because space is scaled about x10.
-                t_hist[saving_frame_idx] = time * 10
-                consecutive_frames_counter += 1
+            frame = U[0, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng]
+            with profiler.phase("frame saving"):
+                if frame_scheduler.due(it, time, frame):
+                    saving_frame_idx += 1
+                    h_hist, t_hist = _save_frame(h_hist, t_hist,
+                                                 saving_frame_idx, frame, time)
             if conf.SAVE_DS_FOR_ML:
-                U_ds[it] = U[:, conf.Ng: -conf.Ng, conf.Ng: -conf.Ng]
+                with profiler.phase("io"):
+                    _save_ds(U_ds, U, it, time,
+                             is_drop=drops_count != prev_drops_count)
         else:
             logger.log("Configure WRITE_DAT | Options: True, False")
 
-        logger.log_timestep(it, time)
+        with profiler.phase("io"):
+            logger.log_timestep(it, time)
+        iterations = it
+
+        if steady_state.converged():
+            break
+
+    run_throughput = throughput.stop(iterations)
+    summary = run_throughput.summary()
+    summary.append(memory_planner.log_peak_rss())
+    series = diagnostics.stop()
+    summary += diagnostics.summary(series)
+    gauges = probes.stop()
+    stats = field_stats.stop()
+    steady = steady_state.stop(iterations, time)
+    summary.append(steady)
+
+    h_hist, t_hist = _trim_history(h_hist, t_hist, saving_frame_idx + 1)
+    with profiler.phase("io"):
+        summary += _close_outputs(pipeline, preview, h_hist, U_ds)
+    run_profile = profiler.stop()
+    summary += run_profile.summary() if run_profile is not None else []
 
     # Clean-up the memmap
     if conf.DUMP_MEMMAP and conf.WORKERS > 1:
         utils.delete_memmap()
 
-    return h_hist, t_hist, U_ds
+    return SimulationResult(h_hist, t_hist, U_ds, run_throughput, series,
+                            gauges, stats,
+                            [line for line in summary if line is not None])
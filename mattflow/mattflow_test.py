@@ -11,6 +11,8 @@
 # ======================================================================
 """Houses all the tests"""
 
+import json
+import os
 import time
 from unittest import mock
 
@@ -18,15 +20,49 @@ import numpy as np
 from numpy.testing import assert_array_almost_equal
 import pytest
 
-from mattflow import (bcmanager,
+from mattflow import (autotune,
+                      bcmanager,
+                      benchmark,
                       config as conf,
+                      dat_writer,
+                      dataset,
+                      diagnostics,
+                      exporter,
+                      field_stats,
+                      flux,
+                      frame_cache,
+                      frame_history,
                       initializer,
+                      live_preview,
+                      lod,
+                      logger,
+                      mattflow_post,
                       mattflow_solver,
+                      memory_planner,
+                      output_pipeline,
+                      probes,
+                      profiler,
+                      raster,
+                      resampling,
+                      scheduler,
+                      steady_state,
+                      throughput,
                       utils)
 
 np.set_printoptions(suppress=True, formatter={"float": "{: 0.6f}".format})
 
 
+@pytest.fixture
+def fixed_drops():
+  """The drops of simulate() fall at fixed centers, iterations and sizes."""
+  with mock.patch("mattflow.initializer._variance", return_value=0.1), \
+      mock.patch("mattflow.initializer.uniform", return_value=0), \
+      mock.patch("mattflow.initializer.randint", return_value=10), \
+      mock.patch.multiple(conf, RANDOM_DROP_CENTERS=False,
+                          ITERS_BETWEEN_DROPS_MODE="fixed"):
+    yield
+
+
 @pytest.mark.parametrize("mode, factor",
                          [("drop", 1.), ("rain", 1 / 6)])
 @mock.patch("mattflow.initializer._variance", return_value=0.1)
@@ -126,6 +162,15 @@ class TestInitializer:
     assert_array_almost_equal(h_hist, h_hist_expected, decimal=6)
     assert_array_almost_equal(t_hist, t_hist_expected, decimal=6)
 
+  def test_init_h_hist_invalid_storage(self,
+                                       mock_randint, mock_uniform,
+                                       mock_variance, mode, factor):
+    conf.MODE = mode
+    U = initializer._init_U()
+    with mock.patch.object(conf, "HISTORY_STORAGE", "tape"):
+      with pytest.raises(ValueError, match="HISTORY_STORAGE"):
+        initializer._init_h_hist(U, num_states=3)
+
 
 class TestUtils():
   """utils.py tests"""
@@ -420,7 +465,10 @@ class TestMattflowSolver():
     """Can also be regarded as integration test."""
     conf.RANDOM_DROP_CENTERS = False
     conf.ITERS_BETWEEN_DROPS_MODE = drop_iters_mode
-    h_hist, t_hist, _ = mattflow_solver.simulate()
+    result = mattflow_solver.simulate()
+    h_hist, t_hist, _ = result
+    assert result.throughput.iterations == conf.MAX_ITERS - 1
+    assert result.throughput.mcups > 0
     h_hist_expected = np.array(
       [[[1.608689, 1.610595, 1.593548, 1.558355, 1.506661],
         [1.649861, 1.651833, 1.634196, 1.597786, 1.544305],
@@ -437,3 +485,880 @@ class TestMattflowSolver():
     t_hist_expected = np.array([0.000000, 0.055501])
     assert_array_almost_equal(h_hist, h_hist_expected)
     assert_array_almost_equal(t_hist, t_hist_expected)
+
+  @pytest.mark.usefixtures("fixed_drops")
+  def test_simulate_spill_history(self, tmp_path):
+    h_hist_ram, _, _ = mattflow_solver.simulate()
+    with mock.patch.multiple(conf,
+                             HISTORY_STORAGE="spill",
+                             HISTORY_CHUNK_FRAMES=1,
+                             HISTORY_RAM_CHUNKS=0,
+                             HISTORY_DIR=str(tmp_path)):
+      h_hist, _, _ = mattflow_solver.simulate()
+    assert isinstance(h_hist, frame_history.SpillHistory)
+    assert_array_almost_equal(h_hist[:], h_hist_ram)
+
+  @pytest.mark.parametrize("storage", ["ram", "spill", "compressed"])
+  @pytest.mark.usefixtures("fixed_drops")
+  def test_simulate_output_dt(self, storage, tmp_path):
+    h_hist_iters, t_hist_iters, _ = mattflow_solver.simulate()
+    # Every iteration steps over the output time, so all frames are saved.
+    with mock.patch.multiple(conf, OUTPUT_DT=1e-6, HISTORY_STORAGE=storage,
+                             HISTORY_CHUNK_FRAMES=2, HISTORY_RAM_CHUNKS=0,
+                             HISTORY_DIR=str(tmp_path)):
+      h_hist, t_hist, _ = mattflow_solver.simulate()
+    assert len(h_hist) == len(t_hist) == conf.MAX_ITERS
+    # the compressed frames are quantized to 16 bits
+    decimal = 4 if storage == "compressed" else 6
+    assert_array_almost_equal(h_hist[::3], h_hist_iters, decimal=decimal)
+    assert_array_almost_equal(t_hist[::3], t_hist_iters)
+
+
+class TestOutputPipeline():
+  """output_pipeline.py tests"""
+
+  def setup_method(self):
+    self.written = []
+
+  def teardown_method(self):
+    del self.written
+
+  def _consumer(self, frame, time, it):
+    self.written.append((frame.copy(), time, it))
+
+  def test_submit(self):
+    pipeline = output_pipeline.OutputPipeline((2, 3), self._consumer, depth=2)
+    pipeline.start()
+    for it in range(5):
+      pipeline.submit(np.full((2, 3), it), it / 10, it)
+    pipeline.close()
+    assert [w[2] for w in self.written] == list(range(5))
+    assert_array_almost_equal(self.written[3][0], np.full((2, 3), 3))
+    assert pipeline.submitted == 5
+    assert pipeline.dropped == 0
+    assert pipeline.max_queue_depth <= 2
+
+  def test_drop_backpressure(self):
+    release = mock.MagicMock()
+    pipeline = output_pipeline.OutputPipeline((2, 3), release, depth=1,
+                                              backpressure="drop")
+    # Not started: the single buffer is never freed.
+    assert pipeline.submit(np.zeros((2, 3)), 0., 1)
+    assert not pipeline.submit(np.zeros((2, 3)), 0., 2)
+    assert pipeline.dropped == 1
+    pipeline.start()
+    pipeline.close()
+    release.assert_called_once()
+
+
+class TestFrameHistory():
+  """frame_history.py tests"""
+
+  def setup_method(self):
+    self.frames = np.arange(7 * 2 * 3, dtype=conf.DTYPE).reshape(7, 2, 3)
+
+  def teardown_method(self):
+    del self.frames
+
+  @pytest.mark.parametrize("ram_chunks", [None, 0, 1])
+  def test_spill_history(self, tmp_path, ram_chunks):
+    path = str(tmp_path / "h_hist.bin")
+    h_hist = frame_history.SpillHistory((2, 3), chunk_frames=2,
+                                        ram_chunks=ram_chunks, path=path)
+    for idx, frame in enumerate(self.frames):
+      h_hist[idx] = frame
+    # The last frame lies at the open chunk and it can be overwritten.
+    h_hist[6] = self.frames[6]
+    assert len(h_hist) == 7
+    assert_array_almost_equal(h_hist[:], self.frames)
+    assert_array_almost_equal(h_hist[-2], self.frames[5])
+    assert_array_almost_equal(h_hist[1:6:2], self.frames[1:6:2])
+    assert_array_almost_equal(np.asarray(h_hist), self.frames)
+    spilled_chunks = 0 if ram_chunks is None else 3 - ram_chunks
+    if spilled_chunks:
+      assert (tmp_path / "h_hist.bin").stat().st_size \
+          == spilled_chunks * h_hist.chunk_bytes
+    with pytest.raises(IndexError):
+      h_hist[2] = self.frames[2]
+
+  @pytest.mark.parametrize("bits, codec, workers",
+                           [(16, "zlib", 2), (8, "lzma", 1)])
+  def test_compressed_history(self, bits, codec, workers):
+    frames = 1 + np.random.default_rng(0).random((7, 4, 5), dtype=conf.DTYPE)
+    h_hist = frame_history.CompressedHistory((4, 5), chunk_frames=3,
+                                             h_range=(0., 4.), bits=bits,
+                                             codec=codec, workers=workers)
+    for frame in frames:
+      h_hist.append(frame)
+    # quantization step: 4 / (2**bits - 1)
+    decimal = 4 if bits == 16 else 2
+    assert_array_almost_equal(h_hist[:], frames, decimal=decimal)
+    assert_array_almost_equal(h_hist[4], frames[4], decimal=decimal)
+    assert h_hist.raw_bytes == 2 * 3 * 4 * 5 * conf.DTYPE.itemsize
+    assert h_hist.compression_ratio > 1
+    assert h_hist.clipped == 0
+
+  @pytest.mark.parametrize("storage", ["spill", "compressed"])
+  def test_mip_levels(self, storage, tmp_path):
+    frames = 1 + np.random.default_rng(0).random((7, 9, 8), dtype=conf.DTYPE)
+    if storage == "spill":
+      h_hist = frame_history.SpillHistory(
+        (9, 8), chunk_frames=3, ram_chunks=0,
+        path=str(tmp_path / "h_hist.bin"), mip_levels=2, mip_mode="max"
+      )
+    else:
+      h_hist = frame_history.CompressedHistory((9, 8), chunk_frames=3,
+                                               workers=1, mip_levels=2,
+                                               mip_mode="max")
+    for frame in frames:
+      h_hist.append(frame)
+    half = lod.decimate(frames, 2, "max")
+    quarter = lod.decimate(half, 2, "max")
+    assert h_hist.level(0) is h_hist
+    assert h_hist.level(1)[:].shape == (7, 5, 4)
+    # The last frame lies at the open chunk and it is decimated on read.
+    assert_array_almost_equal(h_hist.level(1)[:], half, decimal=4)
+    assert_array_almost_equal(h_hist.level(2)[4], quarter[4], decimal=4)
+    assert_array_almost_equal(h_hist.level(2)[-1], quarter[-1], decimal=4)
+    with pytest.raises(ValueError):
+      h_hist.level(3)
+
+
+class TestDataset():
+  """dataset.py tests"""
+
+  def setup_method(self):
+    self.U = np.arange(10 * 3 * 2 * 2, dtype=conf.DTYPE).reshape(10, 3, 2, 2)
+
+  def teardown_method(self):
+    del self.U
+
+  def test_dataset_writer(self, tmp_path):
+    writer = dataset.DatasetWriter(str(tmp_path), (3, 2, 2), stride=2,
+                                   shard_size=2, dtype="float16",
+                                   run_id="run")
+    for it in range(10):
+      writer.write(self.U[it], it, it / 10, is_drop=it in (0, 3))
+    writer.close()
+    assert writer.shards_written == 3
+    assert len(writer) == 5
+    index = json.loads((tmp_path / "run_00001.json").read_text())
+    assert index["iteration"] == [4, 6]
+    assert index["time"] == [0.4, 0.6]
+    # The drop at iter 3 invalidates the sample of iter 4 as a label.
+    assert index["is_drop"] == [True, False]
+    shard = np.load(tmp_path / "run_00001.npy")
+    assert shard.dtype == np.float16
+    assert_array_almost_equal(shard, self.U[[4, 6]])
+    assert not list(tmp_path.glob("*.tmp"))
+
+  def test_dataset_loader(self, tmp_path):
+    # Two runs: the value of every sample is its iteration.
+    for run_id, drop_its in [("a", (0, 6)), ("b", (0,))]:
+      writer = dataset.DatasetWriter(str(tmp_path), (3, 2, 2), stride=1,
+                                     shard_size=3, run_id=run_id)
+      for it in range(10):
+        writer.write(np.full((3, 2, 2), it), it, it / 10,
+                     is_drop=it in drop_its)
+      writer.close()
+    loader = dataset.DatasetLoader(str(tmp_path), k=2, batch_size=4,
+                                   chunk_size=3, prefetch=2, seed=0)
+    # run a: 8 pairs, minus (4, 6) and (5, 7) | run b: 8 pairs
+    assert loader.num_pairs == 14
+    assert len(loader) == 4
+    inputs = []
+    for X, Y in loader:
+      assert X.shape[1:] == (3, 2, 2)
+      assert_array_almost_equal(Y - X, np.full(X.shape, 2))
+      inputs.extend(X[:, 0, 0, 0])
+    assert sorted(inputs) == sorted([0, 1, 2, 3, 6, 7] + list(range(8)))
+    assert loader.samples == 14
+
+  def test_dataset_loader_memmap(self, tmp_path):
+    ds_path = tmp_path / "mattflow_data_10x3x2x2.npy"
+    np.save(ds_path, self.U)
+    np.save(tmp_path / "drop_iters_list_10x3x2x2.npy", [0, 5])
+    loader = dataset.DatasetLoader(str(ds_path), batch_size=100,
+                                   shuffle=False)
+    X, Y = next(iter(loader))
+    assert_array_almost_equal(X, self.U[[0, 1, 2, 3, 5, 6, 7, 8]])
+    assert_array_almost_equal(Y, self.U[[1, 2, 3, 4, 6, 7, 8, 9]])
+
+
+class TestRaster():
+  """raster.py tests"""
+
+  def setup_method(self):
+    utils.preprocessing(mode="drops", max_len=1, N=10)
+
+  def test_hillshade_flat(self):
+    shade = raster.hillshade(np.ones((10, 10)), conf.dx, conf.dy,
+                             altitude=30.)
+    assert_array_almost_equal(shade, np.full((10, 10), 0.5))
+
+  @pytest.mark.parametrize("shade", [True, False])
+  def test_render(self, shade):
+    renderer = raster.RasterRenderer(h_range=(0., 2.), shade=shade, scale=3)
+    frame = np.ones((10, 10), dtype=conf.DTYPE)
+    frame[0] = 5  # clipped to the top of the colormap
+    rgb = renderer.render(frame)
+    assert rgb.shape == (30, 30, 3)
+    assert rgb.dtype == np.uint8
+    # first row at the bottom of the image
+    assert (rgb[-3:] != rgb[:3]).any()
+    assert (rgb[:3] == rgb[6:9]).all()
+
+
+class TestExporter():
+  """exporter.py tests"""
+
+  def setup_method(self):
+    utils.preprocessing(mode="drops", max_len=1, N=10)
+    self.h_hist = 1 + np.random.default_rng(0).random((7, 10, 10))
+
+  @pytest.mark.parametrize("frames, n, expected",
+                           [(7, 3, [0, 3, 6]), (2, 16, [0, 1])])
+  def test_palette_samples(self, frames, n, expected):
+    assert exporter._palette_samples(frames, n) == expected
+
+  @mock.patch.multiple(conf, PLOTTING_STYLE="raster", FIG_HEIGHT=1, DPI=10)
+  def test_frame_stream(self):
+    samples = {0: "frame_0", 4: "frame_4"}
+    stream = list(exporter._frame_stream(self.h_hist, None, samples))
+    assert stream[0] == "frame_0" and stream[4] == "frame_4"
+    assert not samples
+    renderer = raster.raster_renderer()
+    for n in (1, 2, 3, 5, 6):
+      assert (stream[n] == renderer.render(self.h_hist[n])).all()
+
+
+class TestLod():
+  """lod.py tests"""
+
+  @pytest.mark.parametrize("shape, frame_height, expected",
+                           [((100, 100), 400, 1), ((1000, 800), 400, 10),
+                            ((101, 101), 400, 2)])
+  def test_lod_factor(self, shape, frame_height, expected):
+    assert lod.lod_factor(shape, frame_height, 4) == expected
+
+  def test_decimate(self):
+    Z = np.arange(15, dtype=conf.DTYPE).reshape(3, 5)
+    # padded with the edge values to (4, 6)
+    assert_array_almost_equal(lod.decimate(Z, 2, "max"),
+                              [[6, 8, 9], [11, 13, 14]])
+    assert_array_almost_equal(lod.decimate(Z, 2, "mean"),
+                              [[3, 5, 6.5], [10.5, 12.5, 14]])
+    assert lod.decimate(Z, 2).dtype == conf.DTYPE
+    assert lod.decimate(Z, 1) is Z
+
+  def test_lod_history(self):
+    h_hist = np.random.default_rng(0).random((10, 6, 6))
+    lod_hist = lod.LODHistory(h_hist, 3, "max", batch_frames=4)
+    assert len(lod_hist) == 10
+    for idx in (0, 5, 9, -1, 2):
+      assert_array_almost_equal(lod_hist[idx],
+                                lod.decimate(h_hist[idx], 3, "max"))
+    with pytest.raises(IndexError):
+      lod_hist[10]
+
+  @mock.patch.multiple(conf, LOD_MODE="mean")
+  def test_plot_history_mip(self, tmp_path):
+    frames = np.random.default_rng(0).random((5, 16, 16)).astype(conf.DTYPE)
+    h_hist = frame_history.SpillHistory((16, 16), chunk_frames=2,
+                                        path=str(tmp_path / "h_hist.bin"),
+                                        mip_levels=1)
+    for frame in frames:
+      h_hist.append(frame)
+    # the decimation starts from the 1/2 level
+    plotted = lod.plot_history(h_hist, factor=4)
+    assert isinstance(plotted, lod.LODHistory) and plotted.factor == 2
+    for idx in range(5):
+      assert_array_almost_equal(plotted[idx],
+                                lod.decimate(frames[idx], 4, "mean"))
+    assert lod.mip_level(h_hist, 3, "mean") == 0
+    assert lod.mip_level(h_hist, 2, "max") == 0
+
+
+class TestFrameCache():
+  """frame_cache.py tests"""
+
+  def setup_method(self):
+    rng = np.random.default_rng(0)
+    # incompressible frames of 3000 bytes
+    self.frames = rng.integers(0, 256, (4, 20, 50, 3), dtype=np.uint8)
+
+  def test_memory_lru(self):
+    cache = frame_cache.FrameCache(max_bytes=7000)
+    for n in range(2):
+      cache.put(("run", n), self.frames[n])
+    # touch frame 0, so that frame 1 is the least recently used
+    assert (cache.get(("run", 0)) == self.frames[0]).all()
+    cache.put(("run", 2), self.frames[2])
+    assert ("run", 1) not in cache
+    assert cache.get(("run", 1)) is None
+    for n in (0, 2):
+      assert (cache.get(("run", n)) == self.frames[n]).all()
+    assert cache.nbytes <= 7000
+    assert (cache.hits, cache.misses) == (3, 1)
+
+  def test_disk(self, tmp_path):
+    cache = frame_cache.FrameCache(cache_dir=str(tmp_path))
+    cache.put(("run", 0, "water"), self.frames[0])
+    # another process (or run of the program)
+    cache = frame_cache.FrameCache(cache_dir=str(tmp_path))
+    assert ("run", 0, "water") in cache
+    assert ("run", 0, "contour") not in cache
+    assert (cache.get(("run", 0, "water")) == self.frames[0]).all()
+
+  def test_disk_lru(self, tmp_path):
+    cache = frame_cache.FrameCache(max_bytes=7000, cache_dir=str(tmp_path))
+    for n in range(2):
+      cache.put(("run", n), self.frames[n])
+      os.utime(cache._path(("run", n)), (n, n))
+    # touch frame 0, so that frame 1 is the least recently used
+    assert cache.get(("run", 0)) is not None
+    cache.put(("run", 2), self.frames[2])
+    assert ("run", 1) not in cache
+    assert ("run", 0) in cache and ("run", 2) in cache
+    assert cache.nbytes <= 7000
+    # the size on disk is picked up by the next process
+    assert frame_cache.FrameCache(cache_dir=str(tmp_path)).nbytes \
+        == cache.nbytes
+
+  def test_frame_key(self):
+    utils.preprocessing(mode="drops", max_len=0.1, N=5)
+    frame = np.ones((5, 5), dtype=conf.DTYPE)
+    t_hist = np.array([0.5])
+    # the same frame of another run
+    with mock.patch.object(conf, "RUN_ID", "a"):
+      key = mattflow_post.frame_key(frame, 0, t_hist)
+    with mock.patch.object(conf, "RUN_ID", "b"):
+      assert mattflow_post.frame_key(frame.copy(), 0, t_hist) == key
+    assert mattflow_post.frame_key(2 * frame, 0, t_hist) != key
+    assert mattflow_post.frame_key(frame, 0, 2 * t_hist) != key
+
+
+class TestMattflowPost():
+  """mattflow_post.py tests"""
+
+  def setup_method(self):
+    utils.preprocessing(mode="drops", max_len=1, N=10)
+
+  @pytest.mark.parametrize("style", ["raster", "wireframe"])
+  def test_render_dats(self, style, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(conf, "PLOTTING_STYLE", style)
+    for it in (0, 3, 12):
+      dat_writer.write_dat(np.ones((10, 10)), it / 10, it)
+    assert mattflow_post.render_dats("data_files", workers=1) == [0, 3, 12]
+    assert sorted(os.listdir("session")) == ["iter_0000.png", "iter_0003.png",
+                                             "iter_0012.png"]
+    # The .png files are up to date.
+    assert mattflow_post.render_dats("data_files", workers=1) == []
+    assert len(mattflow_post.render_dats("data_files", workers=1,
+                                         force=True)) == 3
+
+
+class TestLivePreview():
+  """live_preview.py tests"""
+
+  def test_frame_slot(self):
+    slot = live_preview.FrameSlot((4, 5))
+    # a viewer attaches to the slot by its name
+    viewer_slot = live_preview.FrameSlot((4, 5), name=slot.name)
+    try:
+      assert viewer_slot.read() is None
+      slot.write(np.full((4, 5), 2), 0.5, 7)
+      seq, frame, time, it = viewer_slot.read()
+      assert_array_almost_equal(frame, np.full((4, 5), 2))
+      assert (time, it) == (0.5, 7)
+      assert viewer_slot.read(seq) is None  # nothing new
+      slot._header[0] += 1  # a frame being written is not read
+      assert viewer_slot.read(seq) is None
+      slot._header[0] += 1
+      assert viewer_slot.read(seq)[0] == seq + 2
+      slot.mark_closed()
+      assert viewer_slot.closed
+    finally:
+      viewer_slot.close()
+      slot.close()
+
+
+class TestResampling():
+  """resampling.py tests"""
+
+  def setup_method(self):
+    # 4 saved frames, at non-uniform times, plus 2 preallocated ones
+    self.t_hist = np.array([0., 1., 1.5, 3., 0., 0.])
+    self.h_hist = (np.array([0., 2., 3., 6., 0., 0.], dtype=conf.DTYPE)
+                   [:, None, None] * np.ones((1, 2, 3), dtype=conf.DTYPE))
+
+  def test_saved_frames(self):
+    assert resampling.saved_frames(self.t_hist) == 4
+    assert resampling.saved_frames(self.t_hist[:4]) == 4
+    assert resampling.saved_frames(self.t_hist, frames=3) == 3
+
+  @mock.patch.multiple(conf, FRAME_SAVE_FREQ=10, FRAMES_PER_PERIOD=2)
+  def test_resampled_history(self):
+    # The heights are 2 * time, so the interpolation is exact.
+    resampled = resampling.ResampledHistory(self.h_hist, self.t_hist, 2)
+    assert len(resampled) == 7
+    assert_array_almost_equal(resampled.t_hist, np.arange(7) / 2)
+    for n in range(7):
+      assert_array_almost_equal(resampled[n], np.full((2, 3), n))
+    assert_array_almost_equal(resampled[2:5], resampled.frames([2, 3, 4]))
+    # saved frames at iterations 0, 1, 10, 11
+    assert resampled.iterations[0] == 0 and resampled.iterations[-1] == 11
+
+
+class TestScheduler():
+  """scheduler.py tests"""
+
+  @pytest.mark.parametrize("freq, frames_per_period", [(3, 1), (10, 4)])
+  def test_iteration_based(self, freq, frames_per_period):
+    frame_scheduler = scheduler.FrameScheduler(freq, frames_per_period)
+    max_iters = 37
+    # the 1st frame is saved at initialization
+    saved = 1 + sum(frame_scheduler.due(it, None, None)
+                    for it in range(1, max_iters))
+    assert saved == frame_scheduler.capacity(max_iters)
+
+  def test_dt_out(self):
+    frame_scheduler = scheduler.FrameScheduler(dt_out=1.)
+    times = [0.4, 0.9, 1.1, 1.6, 3.2, 3.5, 4.]
+    due = [frame_scheduler.due(it, time, None)
+           for it, time in enumerate(times, 1)]
+    # 3.2 steps over the output time 2, and the next one is 4.
+    assert due == [False, False, True, False, True, False, True]
+    assert frame_scheduler.capacity(100, dt=0.1, stopping_time=4) == 6
+
+  def test_max_change(self):
+    frame_scheduler = scheduler.FrameScheduler(max_change=0.5)
+    frame_scheduler.start(np.zeros((2, 2)))
+    heights = [0.2, 0.4, 0.6, 0.9, 1.2]
+    due = [frame_scheduler.due(it, 0, np.full((2, 2), h))
+           for it, h in enumerate(heights, 1)]
+    # the change is measured since the last saved frame (0.6)
+    assert due == [False, False, True, False, True]
+
+
+class TestLogger():
+  """logger.py tests"""
+
+  @mock.patch.multiple(conf, LOGGING_MODE=True, Nx=4, Ny=4,
+                       LOG_FLUSH_INTERVAL=60, LOG_BUFFER_RECORDS=3)
+  def test_log(self, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    logger.log("first")
+    assert logger.is_mattflow_log(logger.file_name)
+    for it in range(1, 3):
+      logger.log_timestep(it, it / 10)
+    # 3 records are pending, so they are written without waiting
+    for _ in range(100):
+      if "0.200" in (tmp_path / logger.file_name).read_text():
+        break
+      time.sleep(0.01)
+    else:
+      pytest.fail("the full buffer was not flushed")
+    logger.log("last")
+    logger.close()
+    done_log = tmp_path / (logger.file_name[:-4] + "_done.log")
+    lines = done_log.read_text().splitlines()
+    assert lines[-6:] == ["first", "  iter     time", "     1    0.100",
+                          "     2    0.200", "last", ""]
+
+  @mock.patch.multiple(conf, LOGGING_MODE=True)
+  def test_close_without_log(self, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    logger.close()
+    assert (tmp_path / (logger.file_name[:-4] + "_errored.log")).exists()
+
+
+class TestProfiler():
+  """profiler.py tests"""
+
+  def test_disabled(self):
+    with mock.patch.object(conf, "PROFILE", False):
+      profiler.start()
+    assert profiler.phase("cfl") is profiler.phase("flux")
+    assert profiler.stop() is None
+
+  def test_profiler(self):
+    prof = profiler.Profiler(max_events=3)
+    for _ in range(4):
+      with prof.phase("cfl"):
+        pass
+    prof.add("flux", 0, 5_000_000)
+    report = prof.report()
+    assert list(report) == ["flux", "cfl"]
+    assert report["cfl"]["count"] == 4
+    # 5 ms lie at the (4096, 8192] us bucket
+    assert report["flux"]["histogram_us"] == {"8192": 1}
+    events = prof.chrome_trace()["traceEvents"]
+    assert len(events) == 3
+    assert all(event["ph"] == "X" for event in events)
+
+  @pytest.mark.usefixtures("fixed_drops")
+  def test_simulate_profile(self, tmp_path):
+    conf.MAX_ITERS = 5
+    utils.preprocessing(mode="drops", max_len=0.1, N=5)
+    with mock.patch.multiple(conf, PROFILE=True, PROFILE_DIR=str(tmp_path)):
+      mattflow_solver.simulate()
+    report_path = tmp_path / f"profile_{conf.RUN_ID}.json"
+    report = json.loads(report_path.read_text())
+    assert report["cfl"]["count"] == conf.MAX_ITERS - 1
+    assert {"ghost cells", "flux stage 1", "flux stage 2", "frame saving",
+            "io"} <= set(report)
+    trace = json.loads((tmp_path / f"trace_{conf.RUN_ID}.json").read_text())
+    assert trace["traceEvents"]
+
+
+class TestThroughput():
+  """throughput.py tests"""
+
+  def test_throughput(self):
+    # 10 iterations of 2 stages on a 100x100 grid, in 0.5 sec
+    run = throughput.Throughput(10, 100 * 100, 2, elapsed=0.5, flux_time=0.4,
+                                itemsize=4)
+    assert run.cell_updates == 200000
+    assert run.iters_per_sec == pytest.approx(20)
+    assert run.mcups == pytest.approx(0.4)
+    assert run.bandwidth == pytest.approx(0.4e6 * 16.5 * 4 / 1e9)
+    assert run.flux_fraction == pytest.approx(0.8)
+    assert json.loads(json.dumps(run.to_dict()))["iterations"] == 10
+
+  def test_meter(self):
+    throughput.start()
+    with throughput.flux():
+      time.sleep(0.01)
+    run = throughput.stop(1)
+    assert 0 < run.flux_time <= run.elapsed
+    # not measuring
+    with throughput.flux():
+      pass
+
+  @pytest.mark.usefixtures("fixed_drops")
+  def test_simulate_summary(self, capsys):
+    result = mattflow_solver.simulate()
+    assert result.summary[:4] == result.throughput.summary()
+    # reported by the CLI, not printed by simulate()
+    assert "Iterations/s" not in capsys.readouterr().out
+
+
+class TestBenchmark():
+  """benchmark.py tests"""
+
+  def test_run(self):
+    snapshot = utils.config_snapshot()
+    report = benchmark.run(quick=True, select="scaling/strong",
+                           workers=(1,), repeat=1)
+    assert list(report["results"]) == ["scaling/strong/w1"]
+    assert report["scaling"]["strong"]["1"] == pytest.approx(1)
+    assert report["machine"]["cpus"] == os.cpu_count()
+    # the configuration is restored
+    assert utils.config_snapshot().keys() == snapshot.keys()
+    assert conf.Nx == snapshot["Nx"]
+
+  def test_compare(self):
+    baseline = {"results": {"a": {"median_s": 1.}, "b": {"median_s": 1.}}}
+    report = {"results": {"a": {"median_s": 1.1}, "b": {"median_s": 1.5},
+                          "c": {"median_s": 9.}}}
+    assert benchmark.compare(report, baseline, tolerance=0.2) == [("b", 1.5)]
+
+  def test_scaling_efficiency(self):
+    results = {"scaling/strong/w1": {"median_s": 4.},
+               "scaling/strong/w2": {"median_s": 2.5},
+               "scaling/weak/w1": {"median_s": 1.},
+               "scaling/weak/w4": {"median_s": 2.}}
+    efficiency = benchmark.scaling_efficiency(results)
+    assert efficiency["strong"] == {"1": 1., "2": 0.8}
+    assert efficiency["weak"] == {"1": 1., "4": 0.5}
+
+
+class TestAutotune():
+  """autotune.py tests"""
+
+  def setup_method(self):
+    utils.preprocessing(mode="drops", max_len=0.1, N=20)
+    self.U = np.random.default_rng(0).random(utils.U_shape(),
+                                             dtype=conf.DTYPE) + 1
+
+  def test_candidates(self):
+    assert autotune.candidates(1) == [{"WORKERS": 1, "DUMP_MEMMAP": False}]
+    workers = [c["WORKERS"] for c in autotune.candidates(6)]
+    assert workers == [1, 2, 2, 4, 4, 6, 6]
+
+  @pytest.mark.parametrize("dump_memmap", [False, True])
+  def test_parallel_flux(self, dump_memmap, tmp_path):
+    expected = flux.flux(self.U)
+    with mock.patch.multiple(conf, WORKERS=2, DUMP_MEMMAP=dump_memmap,
+                             MEMMAP_DIR=str(tmp_path / "flux_memmap")):
+      assert_array_almost_equal(flux.flux(self.U), expected)
+
+  def test_autotune(self, tmp_path):
+    best = {"WORKERS": 2, "DUMP_MEMMAP": True}
+    with mock.patch.multiple(conf, AUTOTUNE_CACHE=str(tmp_path / "tune.json"),
+                             WORKERS=1, DUMP_MEMMAP=False), \
+        mock.patch.object(autotune, "tune",
+                          return_value=(best, [(best, 0.1)])) as tune:
+      assert autotune.autotune(self.U) == best
+      assert (conf.WORKERS, conf.DUMP_MEMMAP) == (2, True)
+      conf.WORKERS = 1
+      assert autotune.autotune(self.U) == best  # read from the cache
+      assert conf.WORKERS == 2
+      tune.assert_called_once()
+
+  def test_tune(self):
+    workers = conf.WORKERS
+    with mock.patch.object(autotune, "measure",
+                           side_effect=[2., 1., 3., 5., 1.5]):
+      best, timings = autotune.tune(self.U, steps=1, max_workers=4)
+    assert best == {"WORKERS": 2, "DUMP_MEMMAP": False}
+    assert len(timings) == 5
+    # the configuration is restored
+    assert conf.WORKERS == workers
+
+
+class TestMemoryPlanner():
+  """memory_planner.py tests"""
+
+  def setup_method(self):
+    conf.MAX_ITERS = 3000
+    utils.preprocessing(mode="drops", max_len=0.1, N=100)
+    self.patch = mock.patch.multiple(conf, HISTORY_STORAGE="ram",
+                                     FRAME_SAVE_FREQ=3, FRAMES_PER_PERIOD=1,
+                                     WORKERS=1, SAVE_DS_FOR_ML=False)
+    self.patch.start()
+
+  def teardown_method(self):
+    self.patch.stop()
+
+  @pytest.mark.parametrize("size, expected",
+                           [("512M", 512 * 2**20), ("1.5G", 1.5 * 2**30),
+                            ("100", 100), ("2kb", 2048)])
+  def test_parse_size(self, size, expected):
+    assert memory_planner.parse_size(size) == expected
+
+  def test_plan(self):
+    plan = memory_planner.MemoryPlan()
+    # 1000 frames of 100x100 float32
+    assert plan.frames == 1000
+    assert dict((name, ram) for name, ram, _ in plan.items)[
+      "h_hist (ram, 1000 frames)"] == 1000 * 100 * 100 * 4
+    assert plan.disk == 0
+
+  def test_fit_spill(self):
+    plan, changes = memory_planner.fit(20 * 2**20)
+    assert changes == ["HISTORY_STORAGE = 'spill'"]
+    assert conf.HISTORY_STORAGE == "spill"
+    assert plan.peak <= 20 * 2**20 and plan.disk > 0
+
+  @mock.patch("mattflow.memory_planner._free_disk", return_value=0)
+  def test_fit_compressed(self, mock_free_disk):
+    plan, changes = memory_planner.fit(10 * 2**20)
+    assert changes == ["HISTORY_STORAGE = 'compressed'",
+                       "FRAME_SAVE_FREQ = 6", "FRAME_SAVE_FREQ = 12"]
+    assert plan.peak <= 10 * 2**20
+    with pytest.raises(MemoryError):
+      memory_planner.fit(2**20)
+
+  def test_peak_rss(self):
+    assert memory_planner.peak_rss() > 0
+
+
+class TestDiagnostics():
+  """diagnostics.py tests"""
+
+  def setup_method(self):
+    conf.MAX_ITERS = 5
+    utils.preprocessing(mode="drops", max_len=0.1, N=5)
+
+  def test_totals(self):
+    U = np.zeros(utils.U_shape(), dtype=conf.DTYPE)
+    U[0] = 2
+    U[1] = 1
+    # the ghost cells are not counted
+    U[:, 0, :] = 100
+    area = 0.2 * 0.2
+    mass, momentum_x, momentum_y, energy = diagnostics.totals(U)
+    assert mass == pytest.approx(2 * area)
+    assert momentum_x == pytest.approx(area)
+    assert momentum_y == 0
+    assert energy == pytest.approx((0.25 + 0.5 * 9.81 * 4) * area)
+
+  def test_mass_balance(self):
+    monitor = diagnostics.Diagnostics(4)
+    U = np.ones(utils.U_shape(), dtype=conf.DTYPE)
+    for it, (h, is_drop) in enumerate([(1, False), (1.5, True), (1.499, False),
+                                       (1.5, False)]):
+      U[0] = h
+      monitor.record(it, it / 10, U, is_drop)
+    added, drift = monitor.mass_balance()
+    assert added == pytest.approx(0.5)
+    assert drift == pytest.approx(0, abs=1e-6)
+    assert len(monitor.series) == 4
+
+  @pytest.mark.usefixtures("fixed_drops")
+  def test_simulate_diagnostics(self, tmp_path):
+    with mock.patch.multiple(conf, DIAGNOSTICS=True,
+                             DIAGNOSTICS_DIR=str(tmp_path)):
+      result = mattflow_solver.simulate()
+    series = result.diagnostics
+    assert_array_almost_equal(series["it"], np.arange(conf.MAX_ITERS))
+    # reflective boundaries: the mass is (nearly) conserved
+    assert_array_almost_equal(series["mass"] / series["mass"][0],
+                              np.ones(conf.MAX_ITERS), decimal=3)
+    saved = np.load(tmp_path / f"diagnostics_{conf.RUN_ID}.npy")
+    assert_array_almost_equal(saved["energy"], series["energy"])
+    with mock.patch.object(conf, "DIAGNOSTICS", False):
+      assert mattflow_solver.simulate().diagnostics is None
+
+
+class TestSteadyState():
+  """steady_state.py tests"""
+
+  def test_patience(self):
+    detector = steady_state.SteadyState(tolerance=0.1, patience=2)
+    detector.observe(0.01)
+    detector.observe(0.01)
+    # not armed: drops remain
+    assert not detector.converged
+    detector.arm()
+    for residual, converged in [(0.01, False), (0.2, False), (0.01, False),
+                                (0.05, True)]:
+      detector.observe(residual)
+      assert detector.converged == converged
+
+  def test_arm(self):
+    with mock.patch.multiple(conf, MODE="drops", MAX_N_DROPS=2,
+                             STEADY_STATE_TOL=1.):
+      steady_state.start()
+      steady_state.arm(drops_count=1)
+      assert not steady_state._detector.armed
+      steady_state.arm(drops_count=2)
+      assert steady_state._detector.armed
+    steady_state.stop(it=0, time=0)
+    with mock.patch.object(conf, "MODE", "rain"):
+      assert steady_state.drops_remain(100)
+
+  def test_residual(self):
+    utils.preprocessing(mode="drop", max_len=0.1, N=5)
+    F = np.zeros((3, 5, 5), dtype=conf.DTYPE)
+    F[2, 1, 3] = -0.02
+    assert steady_state.residual(F) == pytest.approx(0.02 / 0.04**2)
+
+  @pytest.mark.usefixtures("fixed_drops")
+  def test_simulate_steady_state(self):
+    utils.preprocessing(mode="drop", max_len=0.1, N=5)
+    with mock.patch.multiple(conf, MODE="drop", MAX_ITERS=4,
+                             FRAME_SAVE_FREQ=1):
+      h_hist_expected, t_hist_expected, _ = mattflow_solver.simulate()
+      with mock.patch.multiple(conf, MAX_ITERS=30, STEADY_STATE_TOL=1e9,
+                               STEADY_STATE_PATIENCE=3):
+        h_hist, t_hist, _ = mattflow_solver.simulate()
+    # every step is at rest, so the run ends after <patience> steps
+    assert len(h_hist) == len(t_hist) == 4
+    assert_array_almost_equal(h_hist, h_hist_expected)
+    assert_array_almost_equal(t_hist, t_hist_expected)
+
+  @pytest.mark.parametrize("storage", ["spill", "compressed"])
+  @pytest.mark.usefixtures("fixed_drops")
+  def test_simulate_steady_state_chunked(self, storage, tmp_path):
+    utils.preprocessing(mode="drop", max_len=0.1, N=5)
+    with mock.patch.multiple(conf, MODE="drop", MAX_ITERS=30,
+                             FRAME_SAVE_FREQ=1, STEADY_STATE_TOL=1e9,
+                             STEADY_STATE_PATIENCE=3, HISTORY_STORAGE=storage,
+                             HISTORY_CHUNK_FRAMES=2, HISTORY_RAM_CHUNKS=0,
+                             HISTORY_DIR=str(tmp_path)):
+      result = mattflow_solver.simulate()
+    assert len(result.t_hist) == len(result.h_hist) == 4
+
+
+class TestProbes():
+  """probes.py tests"""
+
+  def setup_method(self):
+    conf.MAX_ITERS = 5
+    utils.preprocessing(mode="drops", max_len=0.1, N=5)
+    self.U = np.zeros(utils.U_shape(), dtype=conf.DTYPE)
+    self.U[0] = np.arange(7)[None, :] + 10 * np.arange(7)[:, None]
+    self.U[1] = 2 * self.U[0]
+    self.U[2] = -self.U[0]
+
+  def test_gather(self):
+    # a cell center, halfway between 4 centers and beyond the last center
+    points = [(conf.CX[2], conf.CY[3]),
+              ((conf.CX[1] + conf.CX[2]) / 2, (conf.CY[1] + conf.CY[2]) / 2),
+              (conf.MAX_X, conf.CY[1])]
+    gauges = probes.Probes(points, max_steps=2)
+    gauges.record(1, 0.5, self.U)
+    assert gauges.samples.shape == (1, 3, 3)
+    assert_array_almost_equal(gauges.samples[0],
+                              [[32, 2, -1], [16.5, 2, -1], [15, 2, -1]],
+                              decimal=5)
+    assert_array_almost_equal(gauges.its, [1])
+
+  def test_outside(self):
+    with pytest.raises(ValueError):
+      probes.locate([(0, 2 * conf.MAX_Y)])
+
+  @pytest.mark.usefixtures("fixed_drops")
+  def test_simulate_probes(self, tmp_path):
+    points = [(conf.CX[1], conf.CY[1]), (conf.CX[3], conf.CY[4])]
+    with mock.patch.multiple(conf, PROBES=points, PROBES_DIR=str(tmp_path)):
+      result = mattflow_solver.simulate()
+    samples = result.probes.samples
+    assert samples.shape == (conf.MAX_ITERS, 2, 3)
+    # the frames are saved every FRAME_SAVE_FREQ iterations
+    assert_array_almost_equal(samples[::conf.FRAME_SAVE_FREQ, 0, 0],
+                              result.h_hist[:, 0, 0])
+    assert_array_almost_equal(samples[::conf.FRAME_SAVE_FREQ, 1, 0],
+                              result.h_hist[:, 3, 2])
+    saved = np.load(tmp_path / f"probes_{conf.RUN_ID}.npz")
+    assert_array_almost_equal(saved["samples"], samples)
+    assert_array_almost_equal(saved["points"], points)
+
+
+class TestFieldStats():
+  """field_stats.py tests"""
+
+  def setup_method(self):
+    conf.MAX_ITERS = 5
+    utils.preprocessing(mode="drops", max_len=0.1, N=5)
+
+  def test_update(self):
+    rng = np.random.default_rng(3)
+    frames = rng.uniform(0.9, 1.1, (6, 5, 5)).astype(conf.DTYPE)
+    times = np.arange(6) * 0.1
+    stats = field_stats.FieldStats((5, 5), threshold=0.05)
+    U = np.zeros(utils.U_shape(), dtype=conf.DTYPE)
+    for t, frame in zip(times, frames):
+      U[0, 1: -1, 1: -1] = frame
+      stats.update(t, U)
+    assert_array_almost_equal(stats.max_height, frames.max(axis=0))
+    assert_array_almost_equal(stats.max_time, times[frames.argmax(axis=0)])
+    assert_array_almost_equal(stats.mean, frames.mean(axis=0))
+    assert_array_almost_equal(stats.std, frames.std(axis=0))
+    assert_array_almost_equal(
+      stats.rms, np.sqrt(((frames - conf.SURFACE_LEVEL)**2).mean(axis=0))
+    )
+    arrived = frames - conf.SURFACE_LEVEL > 0.05
+    arrival_expected = np.where(arrived.any(axis=0),
+                                times[arrived.argmax(axis=0)], np.nan)
+    assert_array_almost_equal(stats.arrival_time, arrival_expected)
+
+  @pytest.mark.usefixtures("fixed_drops")
+  def test_simulate_field_stats(self, tmp_path):
+    with mock.patch.multiple(conf, FIELD_STATS=True, FRAME_SAVE_FREQ=1,
+                             FIELD_STATS_DIR=str(tmp_path)):
+      result = mattflow_solver.simulate()
+    # every frame is saved, so the maps match the statistics of h_hist
+    h_hist = result.h_hist
+    stats = result.field_stats
+    assert stats.steps == len(h_hist) == conf.MAX_ITERS
+    assert_array_almost_equal(stats.max_height, h_hist.max(axis=0))
+    assert_array_almost_equal(stats.mean, h_hist.mean(axis=0))
+    assert_array_almost_equal(stats.std, h_hist.std(axis=0))
+    saved = np.load(tmp_path / f"field_stats_{conf.RUN_ID}.npz")
+    assert_array_almost_equal(saved["rms"], stats.rms)
+    assert_array_almost_equal(saved["arrival_time"], stats.arrival_time)
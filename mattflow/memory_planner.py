@@ -0,0 +1,211 @@
+# memory_planner.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Plans the memory footprint of a run, from the configuration, and fits the
+storage of the saved frames to a memory limit."""
+
+# peak RAM = U + flux temporaries + h_hist + t_hist + dataset buffer
+#            + field stats
+#
+# Over the limit, the storage of h_hist is degraded step by step:
+#   1. 'spill'      : if the disk under HISTORY_DIR can hold the frames
+#   2. 'compressed' : quantized and compressed in RAM (~1/4 of the size)
+#   3. FRAME_SAVE_FREQ is doubled, until the compressed frames fit
+#
+# The flux temporaries are an estimate: a flux evaluation allocates about
+# <_FLUX_FRAMES> arrays of a grid, plus a copy of U per parallel worker.
+
+import math
+import os
+import shutil
+
+import numpy as np
+
+from mattflow import config as conf, logger, scheduler
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # not available on Windows
+    resource = None
+
+# grid-sized arrays allocated by a flux evaluation (speeds, F, G, fluxes)
+_FLUX_FRAMES = 20
+# expected compression of CompressedHistory
+_COMPRESSION_RATIO = 4
+_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+def parse_size(size):
+    """Parses a size, such as 512M or 4G, to bytes."""
+    size = str(size).strip().upper().rstrip("B")
+    unit = size[-1] if size[-1:] in _UNITS else ""
+    return int(float(size[:len(size) - len(unit)]) * _UNITS[unit])
+
+
+def format_size(n_bytes):
+    return f"{n_bytes / 2**20:.1f} MB"
+
+
+def _frames_to_save():
+    if scheduler.iteration_based():
+        dt = None
+    else:
+        dt = scheduler.dt_estimate(np.array([conf.SURFACE_LEVEL]))
+    return scheduler.frame_scheduler().capacity(
+        conf.MAX_ITERS, dt=dt, stopping_time=conf.STOPPING_TIME
+    )
+
+
+def _h_hist_bytes(frames, frame_bytes):
+    """(RAM, disk) bytes of h_hist."""
+    # mip levels add 1/4 + 1/16 + ... of the frames
+    levels = conf.HISTORY_MIP_LEVELS if conf.HISTORY_STORAGE != "ram" else 0
+    total = frames * frame_bytes * sum(4 ** -k for k in range(levels + 1))
+    chunk_bytes = conf.HISTORY_CHUNK_FRAMES * frame_bytes
+    if conf.HISTORY_STORAGE == "spill":
+        ram = min(total, (conf.HISTORY_RAM_CHUNKS + 1) * chunk_bytes)
+        return ram, total - ram
+    if conf.HISTORY_STORAGE == "compressed":
+        # the open and the last decoded chunk, plus the compressed ones
+        return 2 * chunk_bytes + total / _COMPRESSION_RATIO, 0
+    return total, 0
+
+
+def _dataset_bytes(sample_bytes):
+    """(RAM, disk) bytes of the dataset."""
+    if not conf.SAVE_DS_FOR_ML:
+        return 0, 0
+    if conf.DS_FORMAT == "shards":
+        itemsize = np.dtype(conf.DS_DTYPE).itemsize / conf.DTYPE.itemsize
+        samples = math.ceil(conf.MAX_ITERS / conf.DS_STRIDE)
+        return (conf.DS_SHARD_SIZE * sample_bytes * itemsize,
+                samples * sample_bytes * itemsize)
+    return 0, conf.MAX_ITERS * sample_bytes
+
+
+class MemoryPlan:
+    """The memory footprint of a run, estimated from the configuration.
+
+    Attributes:
+        items (list) : (name, RAM bytes, disk bytes)
+    """
+
+    def __init__(self):
+        itemsize = conf.DTYPE.itemsize
+        frame_bytes = conf.Nx * conf.Ny * itemsize
+        U_bytes = 3 * (conf.Nx + 2 * conf.Ng) * (conf.Ny + 2 * conf.Ng) \
+            * itemsize
+        workers = conf.WORKERS if conf.WORKERS > 1 else 0
+        frames = _frames_to_save()
+        self.frames = frames
+        self.items = [
+            ("U", U_bytes, 0),
+            ("flux temporaries", _FLUX_FRAMES * frame_bytes
+             + workers * U_bytes, 0),
+            (f"h_hist ({conf.HISTORY_STORAGE}, {frames} frames)",
+             *_h_hist_bytes(frames, frame_bytes)),
+            ("t_hist", frames * itemsize, 0),
+            (f"dataset ({conf.DS_FORMAT})",
+             *_dataset_bytes(3 * frame_bytes)),
+            # max height (DTYPE) and 4 float64 maps
+            ("field stats", conf.FIELD_STATS * conf.Nx * conf.Ny
+             * (itemsize + 4 * 8), 0)
+        ]
+
+    @property
+    def peak(self):
+        """Peak RAM (bytes)."""
+        return int(sum(ram for _, ram, _ in self.items))
+
+    @property
+    def disk(self):
+        return int(sum(disk for _, _, disk in self.items))
+
+    def lines(self):
+        """Returns the plan as lines of text."""
+        lines = [f"Memory plan | grid: {conf.Nx}x{conf.Ny}"
+                 f" | MAX_ITERS: {conf.MAX_ITERS}",
+                 f"{'':<40}{'RAM':>12}{'disk':>12}"]
+        for name, ram, disk in self.items:
+            if ram or disk:
+                lines.append(f"{name:<40}{format_size(ram):>12}"
+                             f"{format_size(disk):>12}")
+        lines.append(f"{'peak':<40}{format_size(self.peak):>12}"
+                     f"{format_size(self.disk):>12}")
+        return lines
+
+
+def _free_disk(path):
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def fit(limit):
+    """Degrades the storage of h_hist, until the plan fits in <limit> bytes.
+
+    Returns:
+        plan (MemoryPlan)
+        changes (list)    : the applied changes, as strings
+
+    Raises:
+        MemoryError : if the run does not fit, even with the lightest storage
+    """
+    plan = MemoryPlan()
+    changes = []
+    if plan.peak > limit and conf.HISTORY_STORAGE == "ram":
+        conf.HISTORY_STORAGE = "spill"
+        plan = MemoryPlan()
+        if plan.peak <= limit and plan.disk < _free_disk(conf.HISTORY_DIR):
+            changes.append("HISTORY_STORAGE = 'spill'")
+            return plan, changes
+        conf.HISTORY_STORAGE = "compressed"
+        plan = MemoryPlan()
+        changes.append("HISTORY_STORAGE = 'compressed'")
+    while (plan.peak > limit and scheduler.iteration_based()
+           and plan.frames > 2):
+        conf.FRAME_SAVE_FREQ *= 2
+        plan = MemoryPlan()
+        changes.append(f"FRAME_SAVE_FREQ = {conf.FRAME_SAVE_FREQ}")
+    if plan.peak > limit:
+        raise MemoryError(f"The run needs {format_size(plan.peak)} of RAM,"
+                          f" over the limit of {format_size(limit)}.")
+    return plan, changes
+
+
+def enforce(limit):
+    """Fits the run to the memory <limit> (bytes), logging the changes."""
+    plan, changes = fit(limit)
+    for change in changes:
+        logger.log(f"Memory limit {format_size(limit)}: {change}")
+    for line in plan.lines():
+        logger.log(line)
+    return plan
+
+
+def peak_rss():
+    """Peak resident set size of the process (bytes, None if unknown)."""
+    if resource is None:  # pragma: no cover
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return rss if os.uname().sysname == "Darwin" else rss * 1024
+
+
+def log_peak_rss():
+    """Logs the peak RSS and returns the message (None, if unknown)."""
+    rss = peak_rss()
+    if rss is None:  # pragma: no cover
+        return None
+    msg = f"{'Peak RSS':-<30}{format_size(rss)}"
+    logger.log(msg)
+    return msg
@@ -0,0 +1,183 @@
+# output_pipeline.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Overlaps the solution with the writing and rendering of the output."""
+
+#   solver ---> [ free slots ] ---> copy frame ---> [ filled slots ]
+#                     ^                                    |
+#                     |                                    v
+#                     +------ writer thread (dat, png) <---+
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+import queue
+import threading
+from timeit import default_timer as timer
+
+import numpy as np
+
+from mattflow import config as conf, dat_writer, logger, mattflow_post, utils
+
+
+class OutputPipeline:
+    """Bounded producer/consumer queue between the solver and the writers.
+
+    The solver copies each frame into a ring of preallocated buffers and a
+    writer thread drains them, passing every frame to the consumer.
+
+    Args:
+        frame_shape (tuple) : shape of a single frame
+        consumer (callable) : consumer(frame, time, it), called at the writer
+                              thread
+        depth (int)         : number of preallocated buffers
+        backpressure (str)  : 'block' or 'drop', when all buffers are in use
+    """
+
+    def __init__(self, frame_shape, consumer, depth=8, backpressure="block"):
+        if backpressure not in ("block", "drop"):
+            raise ValueError("Configure OUTPUT_BACKPRESSURE | options:"
+                             " 'block', 'drop'")
+        self.depth = depth
+        self.backpressure = backpressure
+        self.consumer = consumer
+        self._ring = np.empty((depth,) + tuple(frame_shape), dtype=conf.DTYPE)
+        self._meta = [None] * depth
+        self._free = queue.Queue()
+        for slot in range(depth):
+            self._free.put(slot)
+        self._filled = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+
+        # stats
+        self.submitted = 0
+        self.dropped = 0
+        self.stall_time = 0.
+        self.max_queue_depth = 0
+        self._queue_depth_sum = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, frame, time, it):
+        """Copies a frame into a free buffer and queues it for writing.
+
+        Returns:
+            queued (bool) : False if the frame was dropped
+        """
+        try:
+            slot = self._free.get_nowait()
+        except queue.Empty:
+            if self.backpressure == "drop":
+                self.dropped += 1
+                return False
+            start = timer()
+            slot = self._free.get()
+            self.stall_time += timer() - start
+        np.copyto(self._ring[slot], frame)
+        self._meta[slot] = (time, it)
+        self._filled.put(slot)
+
+        queue_depth = self.depth - self._free.qsize()
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+        self._queue_depth_sum += queue_depth
+        self.submitted += 1
+        return True
+
+    def _drain(self):
+        while True:
+            slot = self._filled.get()
+            if slot is None:
+                break
+            try:
+                if self._error is None:
+                    self.consumer(self._ring[slot], *self._meta[slot])
+            except Exception as e:
+                # Keep draining, so that the solver never blocks forever.
+                self._error = e
+            finally:
+                self._free.put(slot)
+
+    def close(self):
+        """Waits for the queued frames to be written and stops the thread."""
+        self._filled.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def report(self):
+        mean_depth = self._queue_depth_sum / max(self.submitted, 1)
+        return (f"Output queue | frames: {self.submitted}"
+                f" | dropped: {self.dropped}"
+                f" | depth (mean/max): {mean_depth:.1f}/{self.max_queue_depth}"
+                f" of {self.depth}"
+                f" | stalled: {timedelta(seconds=self.stall_time)}")
+
+
+class _DatConsumer:
+    """Writes the .dat file of a frame and renders it to a .png."""
+
+    def __init__(self, workers=1):
+        self._pending = []
+        if workers > 1:
+            self._max_pending = 2 * workers
+            self._pool = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=utils.restore_config,
+                initargs=(utils.config_snapshot(),)
+            )
+        else:
+            self._pool = None
+
+    def __call__(self, frame, time, it):
+        dat_writer.write_dat(frame, time, it)
+        if self._pool is None:
+            mattflow_post.plot_from_dat(time, it)
+            return
+        # Bound the in-flight renders, so that the backpressure propagates
+        # to the solver.
+        if len(self._pending) >= self._max_pending:
+            self._pending.pop(0).result()
+        self._pending.append(
+            self._pool.submit(mattflow_post.plot_from_dat, time, it)
+        )
+
+    def close(self):
+        if self._pool is not None:
+            for future in self._pending:
+                future.result()
+            self._pool.shutdown()
+
+
+def dat_pipeline():
+    """Creates and starts the pipeline that writes the .dat and .png files."""
+    consumer = _DatConsumer(conf.RENDER_WORKERS)
+    pipeline = OutputPipeline((conf.Ny, conf.Nx),
+                              consumer,
+                              depth=conf.OUTPUT_QUEUE_DEPTH,
+                              backpressure=conf.OUTPUT_BACKPRESSURE)
+    return pipeline.start()
+
+
+def close_dat_pipeline(pipeline):
+    """Drains the pipeline, shuts down the renderers and logs the stats.
+
+    Returns:
+        report (str)
+    """
+    try:
+        pipeline.close()
+    finally:
+        pipeline.consumer.close()
+    report = pipeline.report()
+    logger.log(report)
+    return report
@@ -0,0 +1,163 @@
+# probes.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Samples h, u and v at a few gauge points, every step."""
+
+# The cells around every probe and the bilinear weights are located once, on
+# the cell centers (conf.CX, conf.CY):
+#
+#   (j, i) -------- (j, i + 1)       wx = (x - CX[i]) / dx
+#     |        *        |            wy = (y - CY[j]) / dy
+#   (j + 1, i) ---- (j + 1, i + 1)
+#
+# After every step, a compiled kernel gathers h, hu, hv of the 4 cells of
+# every probe, interpolates them and writes (h, u, v) into a preallocated
+# (n_steps, n_probes, 3) buffer, which is saved at the end of the run. The
+# probes near the walls are clamped to the centers of the boundary cells.
+
+import os
+
+import numba as nb
+import numpy as np
+
+from mattflow import config as conf, logger
+
+
+def locate(points):
+    """Locates the probes on the grid.
+
+    Args:
+        points (array) : (x, y) of every probe
+
+    Returns:
+        idx (2D array)     : (j, i) of the top-left cell of every probe
+        weights (2D array) : (wy, wx) bilinear weights of every probe
+
+    Raises:
+        ValueError : if a probe lies outside the basin
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    x, y = points[:, 0], points[:, 1]
+    if ((x < conf.MIN_X) | (x > conf.MAX_X)
+            | (y < conf.MIN_Y) | (y > conf.MAX_Y)).any():
+        raise ValueError("The probes must lie inside the basin"
+                         f" [{conf.MIN_X}, {conf.MAX_X}] x"
+                         f" [{conf.MIN_Y}, {conf.MAX_Y}].")
+    idx = np.empty((len(points), 2), dtype=np.int64)
+    weights = np.empty((len(points), 2), dtype=np.float64)
+    for axis, (coords, centers, n) in enumerate([(y, conf.CY, conf.Ny),
+                                                 (x, conf.CX, conf.Nx)]):
+        # only the cells of the domain (the ghost cells are not updated)
+        first, last = conf.Ng, conf.Ng + n - 1
+        cells = np.clip(np.searchsorted(centers, coords) - 1, first, last - 1)
+        step = centers[cells + 1] - centers[cells]
+        idx[:, axis] = cells
+        weights[:, axis] = np.clip((coords - centers[cells]) / step, 0, 1)
+    return idx, weights
+
+
+# The kernels are compiled at the first call, for the U of the solver.
+@nb.njit(nogil=True)
+def _bilinear(U, k, j, i, wy, wx):
+    return ((1 - wy) * ((1 - wx) * U[k, j, i] + wx * U[k, j, i + 1])
+            + wy * ((1 - wx) * U[k, j + 1, i] + wx * U[k, j + 1, i + 1]))
+
+
+@nb.njit(nogil=True)
+def _gather(U, idx, weights, out):
+    """Writes (h, u, v) of every probe at out."""
+    for p in range(idx.shape[0]):
+        j, i = idx[p, 0], idx[p, 1]
+        wy, wx = weights[p, 0], weights[p, 1]
+        h = _bilinear(U, 0, j, i, wy, wx)
+        hu = _bilinear(U, 1, j, i, wy, wx)
+        hv = _bilinear(U, 2, j, i, wy, wx)
+        out[p, 0] = h
+        out[p, 1] = hu / h if h > 0 else 0.
+        out[p, 2] = hv / h if h > 0 else 0.
+
+
+class Probes:
+    """Per-step time series of h, u and v at the probe points.
+
+    Args:
+        points (array)  : (x, y) of every probe
+        max_steps (int) : steps to preallocate (including the initial state)
+    """
+
+    def __init__(self, points, max_steps):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self._idx, self._weights = locate(self.points)
+        self._samples = np.zeros((max_steps, len(self.points), 3),
+                                 dtype=conf.DTYPE)
+        self._its = np.zeros(max_steps, dtype=np.int64)
+        self._times = np.zeros(max_steps, dtype=np.float64)
+        self._len = 0
+
+    def record(self, it, time, U):
+        _gather(U, self._idx, self._weights, self._samples[self._len])
+        self._its[self._len] = it
+        self._times[self._len] = time
+        self._len += 1
+
+    @property
+    def samples(self):
+        """(n_steps, n_probes, 3) array of (h, u, v)."""
+        return self._samples[:self._len]
+
+    @property
+    def its(self):
+        return self._its[:self._len]
+
+    @property
+    def times(self):
+        return self._times[:self._len]
+
+    def save(self, path):
+        np.savez(path, points=self.points, it=self.its, time=self.times,
+                 samples=self.samples)
+
+
+# The probes of the current run (None: no PROBES)
+_probes = None
+
+
+def start(U):
+    """Starts sampling a run, recording the initial state."""
+    global _probes
+    if not conf.PROBES:
+        _probes = None
+        return
+    _probes = Probes(conf.PROBES, conf.MAX_ITERS)
+    _probes.record(0, 0., U)
+
+
+def record(it, time, U):
+    """Samples the probes at a step (no-op, if there are no PROBES)."""
+    if _probes is not None:
+        _probes.record(it, time, U)
+
+
+def stop():
+    """Stops sampling and saves the time series under PROBES_DIR.
+
+    Returns:
+        probes (Probes) : None, if there are no PROBES
+    """
+    global _probes
+    probes, _probes = _probes, None
+    if probes is None:
+        return None
+    os.makedirs(conf.PROBES_DIR, exist_ok=True)
+    path = os.path.join(conf.PROBES_DIR, f"probes_{conf.RUN_ID}.npz")
+    probes.save(path)
+    logger.log(f"Probes saved at: {path}")
+    return probes
@@ -0,0 +1,196 @@
+# profiler.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Times the phases of the solver's iterations (CFL, ghost cells, flux
+stages, drops, frame saving, I/O)."""
+
+# with profiler.phase("cfl"):        disabled: a shared no-op context manager
+#     delta_t = _dt(U)               enabled:  perf_counter_ns() on enter/exit
+#
+# Every phase aggregates its durations in a histogram of log2(us) buckets, and
+# the first <max_events> intervals are kept as a Chrome trace
+# (chrome://tracing or https://ui.perfetto.dev).
+
+import json
+import os
+from time import perf_counter_ns
+
+from mattflow import config as conf, logger
+
+
+class _NullPhase:
+    """Context manager that does nothing (profiling disabled)."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class PhaseStats:
+    """Aggregated durations of a phase.
+
+    Attributes:
+        count (int)       : number of the timed intervals
+        total_ns (int)    : total duration
+        min_ns (int)      : shortest interval
+        max_ns (int)      : longest interval
+        histogram (dict)  : {k: count} of the intervals that lasted
+                            [2**(k-1), 2**k) us
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+        self.histogram = {}
+
+    def add(self, duration_ns):
+        self.count += 1
+        self.total_ns += duration_ns
+        if self.min_ns is None or duration_ns < self.min_ns:
+            self.min_ns = duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+        bucket = (duration_ns // 1000).bit_length()
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_s": self.total_ns / 1e9,
+            "mean_us": self.total_ns / max(self.count, 1) / 1e3,
+            "min_us": (self.min_ns or 0) / 1e3,
+            "max_us": self.max_ns / 1e3,
+            # upper bound of the bucket (us): count
+            "histogram_us": {str(2 ** k): n
+                             for k, n in sorted(self.histogram.items())}
+        }
+
+
+class _Phase:
+    """Times an interval of a phase (context manager)."""
+
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, self.start, perf_counter_ns())
+        return False
+
+
+class Profiler:
+    """Collects the durations of the phases of a run.
+
+    Args:
+        max_events (int) : intervals kept for the Chrome trace (the
+                           statistics include all of them)
+    """
+
+    def __init__(self, max_events=100000):
+        self.max_events = max_events
+        self.stats = {}
+        self.events = []
+        self._t0 = perf_counter_ns()
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def add(self, name, start_ns, end_ns):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = PhaseStats()
+        stats.add(end_ns - start_ns)
+        if len(self.events) < self.max_events:
+            self.events.append((name, start_ns, end_ns))
+
+    def report(self):
+        """{phase: statistics}, in order of total duration."""
+        phases = sorted(self.stats.items(), key=lambda p: -p[1].total_ns)
+        return {name: stats.to_dict() for name, stats in phases}
+
+    def chrome_trace(self):
+        """The timed intervals in the Chrome trace event format."""
+        pid = os.getpid()
+        return {
+            "traceEvents": [
+                {"name": name, "cat": "mattflow", "ph": "X", "pid": pid,
+                 "tid": 0, "ts": (start - self._t0) / 1e3,
+                 "dur": (end - start) / 1e3}
+                for name, start, end in self.events
+            ],
+            "displayTimeUnit": "ms"
+        }
+
+    def save(self, report_path, trace_path):
+        """Exports the report and the trace as .json files."""
+        with open(report_path, 'w') as fw:
+            json.dump(self.report(), fw, indent=2)
+        with open(trace_path, 'w') as fw:
+            json.dump(self.chrome_trace(), fw)
+
+    def summary(self):
+        """Returns the per-phase totals as lines of text."""
+        lines = ["phase               total (s)   mean (us)   count"]
+        for name, stats in self.report().items():
+            lines.append(f"{name:<18}{stats['total_s']:>11.3f}"
+                         f"{stats['mean_us']:>12.1f}{stats['count']:>8d}")
+        return lines
+
+
+# The profiler of the current run (None: profiling disabled)
+_profiler = None
+
+
+def phase(name):
+    """Context manager that times a phase (no-op, if profiling is off)."""
+    if _profiler is None:
+        return _NULL_PHASE
+    return _profiler.phase(name)
+
+
+def start():
+    """Starts profiling the run, if PROFILE is on."""
+    global _profiler
+    _profiler = Profiler(conf.PROFILE_MAX_EVENTS) if conf.PROFILE else None
+
+
+def stop():
+    """Stops profiling, logs the summary and exports the report and the trace
+    under PROFILE_DIR.
+
+    Returns:
+        profiler (Profiler) : None, if profiling was off
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return None
+    os.makedirs(conf.PROFILE_DIR, exist_ok=True)
+    report_path = os.path.join(conf.PROFILE_DIR, f"profile_{conf.RUN_ID}.json")
+    trace_path = os.path.join(conf.PROFILE_DIR, f"trace_{conf.RUN_ID}.json")
+    profiler.save(report_path, trace_path)
+    for line in profiler.summary():
+        logger.log(line)
+    logger.log(f"Profile saved at: {report_path} | trace: {trace_path}")
+    return profiler
@@ -0,0 +1,118 @@
+# raster.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Renders top-down, shaded-relief raster frames, without matplotlib 3D."""
+
+# height ---> LUT index ---> color (over the background) ---> * hillshade
+#
+# Every step is a vectorized NumPy operation on the whole frame, so a frame
+# is rendered in a fraction of a millisecond (for the default mesh sizes).
+
+import numpy as np
+
+from mattflow import config as conf, mattflow_cmaps
+
+
+def color_lut(cmap, background=(1., 1., 1.), n=256):
+    """Samples a colormap to an (n, 3) lookup table, compositing the alpha
+    channel of the colormap over the background."""
+    rgba = cmap(np.linspace(0, 1, n))
+    alpha = rgba[:, 3:]
+    rgb = rgba[:, :3] * alpha + np.asarray(background) * (1 - alpha)
+    return (255 * rgb).astype(np.float32)
+
+
+def hillshade(Z, dx, dy, azimuth=315., altitude=45., z_factor=1.):
+    """Lambertian shading of a height field, lit from (azimuth, altitude).
+
+    Args:
+        Z (2D array)      : the heights
+        dx, dy (float)    : spatial discretization steps
+        azimuth (float)   : direction of the light, in degrees (clockwise
+                            from the north)
+        altitude (float)  : angle of the light above the horizon, in degrees
+        z_factor (float)  : vertical exaggeration
+
+    Returns:
+        shade (2D array)  : in [0, 1]
+    """
+    dz_dy, dz_dx = np.gradient(Z * z_factor, dy, dx)
+    az = np.deg2rad(azimuth)
+    alt = np.deg2rad(altitude)
+    # dot product of the surface normal, (-dz/dx, -dz/dy, 1), with the light
+    shade = ((np.cos(alt) * np.sin(az)) * -dz_dx
+             + (np.cos(alt) * np.cos(az)) * -dz_dy
+             + np.sin(alt))
+    shade /= np.sqrt(1 + dz_dx ** 2 + dz_dy ** 2)
+    return np.clip(shade, 0, 1, out=shade)
+
+
+class RasterRenderer:
+    """Maps height frames to RGB images, through a colormap lookup table.
+
+    Args:
+        cmap (Colormap)  : default: mattflow_cmaps.deep_water_cmap()
+        h_range (tuple)  : (min, max) heights mapped to the colormap ends
+        shade (bool)     : apply hillshading (shaded relief)
+        ambient (float)  : brightness of the fully shaded cells
+        scale (int)      : integer upscaling of the frames
+    """
+
+    def __init__(self, cmap=None, h_range=(0.5, 1.5), shade=True,
+                 ambient=0.35, scale=1):
+        if cmap is None:
+            cmap = mattflow_cmaps.deep_water_cmap()
+        self._lut = color_lut(cmap)
+        self.h_min, self.h_max = h_range
+        self._norm = (len(self._lut) - 1) / (self.h_max - self.h_min)
+        self.shade = shade
+        self.ambient = ambient
+        self.scale = scale
+
+    def render(self, frame):
+        """Renders a frame of heights.
+
+        Args:
+            frame (2D array) : the heights, (Ny, Nx)
+
+        Returns:
+            rgb (3D array) : shape: (Ny * scale, Nx * scale, 3), dtype: uint8
+                             (north up)
+        """
+        frame = np.asarray(frame)[::-1]
+        idx = ((frame - self.h_min) * self._norm).astype(np.intp)
+        np.clip(idx, 0, len(self._lut) - 1, out=idx)
+        rgb = self._lut[idx]
+        if self.shade:
+            light = hillshade(frame, conf.dx, -conf.dy)
+            light *= 1 - self.ambient
+            light += self.ambient
+            rgb *= light[..., np.newaxis]
+        rgb = rgb.astype(np.uint8)
+        if self.scale > 1:
+            rgb = rgb.repeat(self.scale, axis=0).repeat(self.scale, axis=1)
+        return rgb
+
+
+def raster_renderer(frame_height=None):
+    """Creates a RasterRenderer, configured by the RASTER_* options.
+
+    Args:
+        frame_height (int) : target height of the frames, in pixels (the
+                             frames are upscaled by an integer factor)
+    """
+    cmaps = {"deep": mattflow_cmaps.deep_water_cmap,
+             "shallow": mattflow_cmaps.shallow_water_cmap}
+    scale = 1 if frame_height is None else max(1, frame_height // conf.Ny)
+    return RasterRenderer(cmap=cmaps[conf.RASTER_CMAP](),
+                          h_range=conf.RASTER_RANGE,
+                          shade=conf.RASTER_SHADE,
+                          scale=scale)
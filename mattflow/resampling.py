@@ -0,0 +1,137 @@
+# resampling.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Resamples the saved frames to uniform time spacing."""
+
+# saved:      |  |  |           |  |  |           |  |  |    (t_hist)
+# resampled:  |   |   |   |   |   |   |   |   |   |   |    (uniform)
+#
+# Every resampled frame is a linear interpolation of the two saved frames
+# around its time.
+
+import copy
+
+import numpy as np
+
+from mattflow import config as conf, scheduler
+
+
+def frame_iterations(frame_numbers):
+    """Iterations of the saved frames, <FRAMES_PER_PERIOD> of which are saved
+    every <FRAME_SAVE_FREQ> iters (None, if the frames are scheduled by
+    simulated time or change)."""
+    if not scheduler.iteration_based():
+        return None
+    frame_numbers = np.asarray(frame_numbers)
+    return (frame_numbers
+            + ((frame_numbers // conf.FRAMES_PER_PERIOD)
+               * (conf.FRAME_SAVE_FREQ - conf.FRAMES_PER_PERIOD)))
+
+
+def saved_frames(t_hist, frames=None):
+    """Number of the saved frames, ignoring the preallocated, but not used,
+    trailing part of t_hist (where the time stops increasing)."""
+    not_increasing = np.flatnonzero(np.diff(np.asarray(t_hist)) <= 0)
+    n = not_increasing[0] + 1 if len(not_increasing) else len(t_hist)
+    return n if frames is None else min(n, frames)
+
+
+class ResampledHistory:
+    """Read-only view of h_hist, resampled to uniform time spacing.
+
+    Args:
+        h_hist (array)  : array of iter-wise heights solutions (or a
+                          frame_history sink)
+        t_hist (array)  : holds the iter-wise times
+        factor (float)  : resampled frames per saved frame
+
+    Attributes:
+        t_hist (array)     : times of the resampled frames
+        iterations (array) : (interpolated) iterations of the resampled frames
+                             (None, if they are not known)
+    """
+
+    def __init__(self, h_hist, t_hist, factor=1):
+        self.h_hist = h_hist
+        n = saved_frames(t_hist, len(h_hist))
+        self._t_saved = np.asarray(t_hist[:n], dtype=np.float64)
+        n_out = max(1, int(round((n - 1) * factor)) + 1)
+        self.t_hist = np.linspace(self._t_saved[0], self._t_saved[-1], n_out)
+        saved_iterations = frame_iterations(range(n))
+        if saved_iterations is None:
+            self.iterations = None
+        else:
+            self.iterations = np.rint(
+                np.interp(self.t_hist, self._t_saved, saved_iterations)
+            ).astype(int)
+
+        # Saved frame before every resampled frame and the weight of the
+        # saved frame after it.
+        self._before = np.clip(
+            np.searchsorted(self._t_saved, self.t_hist, side='right') - 1,
+            0, max(n - 2, 0)
+        )
+        if n == 1:
+            self._weight = np.zeros(n_out)
+        else:
+            t0 = self._t_saved[self._before]
+            t1 = self._t_saved[self._before + 1]
+            self._weight = np.clip((self.t_hist - t0) / (t1 - t0), 0, 1)
+
+    def __len__(self):
+        return len(self.t_hist)
+
+    @property
+    def mip_levels(self):
+        return getattr(self.h_hist, "mip_levels", 0)
+
+    @property
+    def mip_mode(self):
+        return getattr(self.h_hist, "mip_mode", None)
+
+    def level(self, level):
+        """The resampled view of a mip level of h_hist."""
+        resampled = copy.copy(self)
+        resampled.h_hist = self.h_hist.level(level)
+        return resampled
+
+    def frames(self, frame_numbers):
+        """The resampled frames, shape: (len(frame_numbers), Ny, Nx)"""
+        before = self._before[frame_numbers]
+        if not len(before):
+            return np.empty((0,) + np.shape(self.h_hist[0]),
+                            dtype=self.h_hist[0].dtype)
+        # Read every needed saved frame once.
+        needed = np.unique(np.concatenate([before, before + 1]))
+        needed = needed[needed < len(self._t_saved)]
+        saved = np.stack([self.h_hist[i] for i in needed])
+        h0 = saved[np.searchsorted(needed, before)]
+        after = np.minimum(before + 1, needed[-1])
+        h1 = saved[np.searchsorted(needed, after)]
+        w = self._weight[frame_numbers].astype(h0.dtype)[:, None, None]
+        return h0 + w * (h1 - h0)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.frames(np.arange(*key.indices(len(self))))
+        idx = int(key)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("frame index out of range")
+        return self.frames(np.array([idx]))[0]
+
+
+def resampled_history(h_hist, t_hist):
+    """Resamples h_hist by INTERP_FACTOR (h_hist itself, if it is 1)."""
+    if conf.INTERP_FACTOR == 1 or t_hist is None:
+        return h_hist
+    return ResampledHistory(h_hist, t_hist, conf.INTERP_FACTOR)
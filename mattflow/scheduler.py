@@ -0,0 +1,130 @@
+# scheduler.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Decides at which iterations a frame is saved at h_hist."""
+
+import math
+
+import numpy as np
+
+from mattflow import config as conf
+
+
+class FrameScheduler:
+    """Output trigger of the frames.
+
+    A frame is saved every <dt_out> of simulated time and/or whenever the
+    height has changed by more than <max_change> since the last saved frame.
+    If neither is set, <frames_per_period> consecutive frames are saved
+    every <save_freq> iterations.
+
+    Args:
+        save_freq (int)         : iterations between the periods of frames
+        frames_per_period (int) : consecutive frames saved per period
+        dt_out (float)          : simulated time between the frames
+        max_change (float)      : max |dh| since the last saved frame
+    """
+
+    def __init__(self, save_freq=3, frames_per_period=1, dt_out=None,
+                 max_change=None):
+        self.save_freq = save_freq
+        self.frames_per_period = frames_per_period
+        self.dt_out = dt_out
+        self.max_change = max_change
+        # The 1st frame is saved at initialization.
+        self._consecutive_frames = 1
+        self._next_time = dt_out
+        self._last_frame = None
+
+    @property
+    def iteration_based(self):
+        return self.dt_out is None and self.max_change is None
+
+    def capacity(self, max_iters, dt=None, stopping_time=math.inf):
+        """Number of frames to preallocate (exact, if iteration based, else
+        estimated from the time step <dt>).
+
+        Args:
+            max_iters (int)       : max iterations of the simulation
+            dt (float)            : estimate of the time step
+            stopping_time (float) : end time of the simulation
+        """
+        if self.iteration_based:
+            # Number of integer divisions with the freq, times the
+            # consecutive frames, plus the consecutive frames that we can take
+            # from the remainder of the division.
+            return (
+                max_iters // self.save_freq * self.frames_per_period
+                + min(max_iters % self.save_freq, self.frames_per_period)
+            )
+        frames = 1
+        if self.dt_out is not None:
+            end_time = min(stopping_time, max_iters * dt)
+            # 25% margin, because dt grows as the fluid calms down
+            frames += math.ceil(1.25 * end_time / self.dt_out)
+        if self.max_change is not None:
+            frames += 64
+        return min(frames, max_iters)
+
+    def start(self, frame):
+        """Registers the 1st frame (saved at initialization)."""
+        if self.max_change is not None:
+            self._last_frame = np.array(frame)
+
+    def due(self, it, time, frame):
+        """Returns True, if the frame of this iteration has to be saved.
+
+        Args:
+            it (int)         : current iteration
+            time (float)     : current time
+            frame (2D array) : current heights
+        """
+        if self.iteration_based:
+            if it % self.save_freq == 0:
+                # Zero the counter, when a perfect division occurs.
+                self._consecutive_frames = 0
+            if self._consecutive_frames < self.frames_per_period:
+                self._consecutive_frames += 1
+                return True
+            return False
+
+        due = False
+        if self.dt_out is not None and time >= self._next_time:
+            # Skip the output times that were stepped over.
+            self._next_time += self.dt_out * (
+                (time - self._next_time) // self.dt_out + 1
+            )
+            due = True
+        if (self.max_change is not None
+                and (due or (np.max(np.abs(frame - self._last_frame))
+                             > self.max_change))):
+            self._last_frame[...] = frame
+            due = True
+        return due
+
+
+def dt_estimate(h):
+    """CFL time step of the fluid at rest, with the heights <h>."""
+    c = math.sqrt(9.81 * float(np.max(h)))
+    return conf.COURANT / (c / conf.dx + c / conf.dy)
+
+
+def frame_scheduler():
+    """Creates a FrameScheduler, configured by the FRAME_SAVE_FREQ,
+    FRAMES_PER_PERIOD and OUTPUT_* options."""
+    return FrameScheduler(conf.FRAME_SAVE_FREQ, conf.FRAMES_PER_PERIOD,
+                          dt_out=conf.OUTPUT_DT,
+                          max_change=conf.OUTPUT_MAX_CHANGE)
+
+
+def iteration_based():
+    """Frames are saved by iteration, rather than by simulated time/change."""
+    return conf.OUTPUT_DT is None and conf.OUTPUT_MAX_CHANGE is None
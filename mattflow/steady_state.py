@@ -0,0 +1,137 @@
+# steady_state.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Detects that the basin has relaxed to rest, to end the run early."""
+
+# The residual of a step is the max rate of change of the state variables,
+#
+#   residual = max |dU/dt| = max |flux| / cell_area
+#
+# reduced from the flux that the update step has already evaluated (the flux
+# of the last stage, for the multi-stage solvers), so it costs a single pass
+# over the flux and no copy of U. The detector is armed once no drops remain
+# to fall, and the run has converged when the residual stays below
+# STEADY_STATE_TOL for STEADY_STATE_PATIENCE consecutive steps.
+
+import numba as nb
+
+from mattflow import config as conf, logger
+
+
+# compiled at the first call, for the flux of the solver
+@nb.njit(nogil=True)
+def _max_abs(a):
+    max_abs = 0.
+    for k in range(a.shape[0]):
+        for j in range(a.shape[1]):
+            for i in range(a.shape[2]):
+                if abs(a[k, j, i]) > max_abs:
+                    max_abs = abs(a[k, j, i])
+    return max_abs
+
+
+def residual(flux):
+    """max |dU/dt| of a step, from its flux."""
+    return _max_abs(flux) / (conf.dx * conf.dy)
+
+
+def drops_remain(drops_count):
+    """Whether more drops will fall, after <drops_count> drops."""
+    if conf.MODE == "drop":
+        return False
+    if conf.MODE == "drops":
+        return drops_count < conf.MAX_N_DROPS
+    # 'rain' never stops raining
+    return True
+
+
+class SteadyState:
+    """Counts the consecutive steps with a residual below the tolerance.
+
+    Args:
+        tolerance (float) : max |dU/dt| that counts as rest
+        patience (int)    : consecutive steps at rest, to converge
+    """
+
+    def __init__(self, tolerance, patience):
+        self.tolerance = tolerance
+        self.patience = patience
+        self.armed = False
+        self.residual = None
+        self.steps_at_rest = 0
+
+    def arm(self):
+        """Starts observing the residuals (no drops remain)."""
+        if not self.armed:
+            self.armed = True
+            self.steps_at_rest = 0
+
+    def observe(self, residual):
+        self.residual = residual
+        if residual < self.tolerance:
+            self.steps_at_rest += 1
+        else:
+            self.steps_at_rest = 0
+
+    @property
+    def converged(self):
+        return self.armed and self.steps_at_rest >= self.patience
+
+
+# The detector of the current run (None: STEADY_STATE_TOL is not set)
+_detector = None
+
+
+def start():
+    """Starts detecting the steady state of a run."""
+    global _detector
+    if conf.STEADY_STATE_TOL is None:
+        _detector = None
+        return
+    _detector = SteadyState(conf.STEADY_STATE_TOL, conf.STEADY_STATE_PATIENCE)
+
+
+def arm(drops_count):
+    """Arms the detector, once no drops remain to fall."""
+    if _detector is not None and not drops_remain(drops_count):
+        _detector.arm()
+
+
+def observe(flux):
+    """Observes the residual of the step with <flux> (no-op, if the detector
+    is off or not armed yet)."""
+    if _detector is not None and _detector.armed:
+        _detector.observe(residual(flux))
+
+
+def converged():
+    return _detector is not None and _detector.converged
+
+
+def stop(it, time):
+    """Stops detecting and logs the steady state, if the run ended at it.
+
+    Args:
+        it (int)     : the last solved iteration
+        time (float) : the time of the last solved iteration
+
+    Returns:
+        msg (str) : the logged message (None, if the run did not end at the
+                    steady state)
+    """
+    global _detector
+    detector, _detector = _detector, None
+    if detector is None or not detector.converged:
+        return None
+    msg = (f"Steady state at iteration {it}, time {time:.3f}"
+           f" (max |dU/dt|: {detector.residual:.2e})")
+    logger.log(msg)
+    return msg
@@ -0,0 +1,185 @@
+# throughput.py is part of MattFlow
+#
+# MattFlow is free software; you may redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version. You should have received a copy of the GNU
+# General Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+# (C) 2019 Athanasios Mattas
+# ======================================================================
+"""Measures the throughput of the solver, comparable across grid sizes,
+workers and solvers."""
+
+# cell updates = iterations * Nx * Ny * (flux stages per iteration)
+#
+# The memory traffic is estimated per cell update, from the arrays that a
+# flux stage streams: U is read for the fluxes and for the update (2 x 3
+# state variables), the flux is written and read back (2 x 3) and the
+# updated U is written (3), plus the CFL condition that reads U once per
+# iteration (3 / stages).
+
+from contextlib import nullcontext
+from time import perf_counter_ns
+from timeit import default_timer as timer
+
+from mattflow import config as conf, logger, __version__
+
+# flux evaluations per iteration
+_STAGES = {
+    "Lax-Friedrichs Riemann": 1,
+    "2-stage Runge-Kutta": 2
+}
+
+
+def stages():
+    """Flux stages per iteration of the configured SOLVER_TYPE."""
+    return _STAGES.get(conf.SOLVER_TYPE, 1)
+
+
+def bytes_per_cell_update(itemsize, n_stages=1):
+    """Estimated memory traffic of a cell update (see the top of the module).
+    """
+    return (15 + 3 / n_stages) * itemsize
+
+
+class Throughput:
+    """Throughput of a simulation run.
+
+    Args:
+        iterations (int)  : solved iterations
+        cells (int)       : cells of the grid (without the ghost cells)
+        stages (int)      : flux stages per iteration
+        elapsed (float)   : wall time of the iterations (sec)
+        flux_time (float) : part of the elapsed time spent at the fluxes
+        itemsize (int)    : bytes per value of the state variables
+    """
+
+    def __init__(self, iterations, cells, stages, elapsed, flux_time,
+                 itemsize):
+        self.iterations = iterations
+        self.cells = cells
+        self.stages = stages
+        self.elapsed = elapsed
+        self.flux_time = flux_time
+        self.itemsize = itemsize
+
+    @property
+    def cell_updates(self):
+        return self.iterations * self.cells * self.stages
+
+    @property
+    def iters_per_sec(self):
+        return self.iterations / max(self.elapsed, 1e-9)
+
+    @property
+    def mcups(self):
+        """Million cell updates per second."""
+        return self.cell_updates / max(self.elapsed, 1e-9) / 1e6
+
+    @property
+    def bandwidth(self):
+        """Estimated effective memory bandwidth (GB/s)."""
+        return (self.mcups * 1e6
+                * bytes_per_cell_update(self.itemsize, self.stages) / 1e9)
+
+    @property
+    def flux_fraction(self):
+        """Fraction of the elapsed time spent at the fluxes."""
+        return self.flux_time / max(self.elapsed, 1e-9)
+
+    def to_dict(self):
+        return {
+            "version": __version__,
+            "solver": conf.SOLVER_TYPE,
+            "workers": conf.WORKERS,
+            "grid": [conf.Nx, conf.Ny],
+            "iterations": self.iterations,
+            "stages": self.stages,
+            "elapsed_s": self.elapsed,
+            "iters_per_sec": self.iters_per_sec,
+            "mcups": self.mcups,
+            "bandwidth_gbs": self.bandwidth,
+            "flux_fraction": self.flux_fraction
+        }
+
+    def summary(self):
+        """Returns the throughput as lines of text."""
+        return [
+            f"{'Iterations/s':-<30}{self.iters_per_sec:.1f}",
+            f"{'Cell updates/s':-<30}{self.mcups:.2f} M",
+            f"{'Memory bandwidth (est.)':-<30}{self.bandwidth:.2f} GB/s",
+            f"{'Time at the fluxes':-<30}{100 * self.flux_fraction:.1f} %"
+        ]
+
+
+class _FluxTimer:
+    """Adds the duration of a flux evaluation to the meter."""
+
+    __slots__ = ("meter", "start")
+
+    def __init__(self, meter):
+        self.meter = meter
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.meter.flux_ns += perf_counter_ns() - self.start
+        return False
+
+
+class ThroughputMeter:
+    """Measures the elapsed time of a run and the time spent at the fluxes.
+    """
+
+    def __init__(self):
+        self.flux_ns = 0
+        self._flux_timer = _FluxTimer(self)
+        self._start = timer()
+
+    def flux(self):
+        """Context manager that times a flux evaluation."""
+        return self._flux_timer
+
+    def throughput(self, iterations):
+        """The Throughput of the <iterations> solved so far."""
+        return Throughput(iterations, conf.Nx * conf.Ny, stages(),
+                          timer() - self._start, self.flux_ns / 1e9,
+                          conf.DTYPE.itemsize)
+
+
+# The meter of the current run
+_meter = None
+
+
+def start():
+    """Starts measuring a run."""
+    global _meter
+    _meter = ThroughputMeter()
+
+
+def flux():
+    """Context manager that times a flux evaluation of the current run."""
+    if _meter is None:
+        return nullcontext()
+    return _meter.flux()
+
+
+def stop(iterations):
+    """Stops measuring and logs the throughput.
+
+    Args:
+        iterations (int) : solved iterations
+
+    Returns:
+        throughput (Throughput)
+    """
+    global _meter
+    meter, _meter = _meter, None
+    throughput = meter.throughput(iterations)
+    for line in throughput.summary():
+        logger.log(line)
+    return throughput
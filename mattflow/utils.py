@@ -11,13 +11,18 @@
 # ======================================================================
 """Provides some helper functions."""
 
-from datetime import timedelta
+from datetime import datetime, timedelta
 from functools import wraps
 import os
+import platform
 import random
 import shutil
+import socket
 from timeit import default_timer as timer
+import types
+import uuid
 
+import numba
 import numpy as np
 
 from mattflow import config as conf, logger
@@ -36,6 +41,27 @@ def cell_centers():
     return cx, cy
 
 
+def new_run_id():
+    """A unique id of a simulation run."""
+    date_n_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    return (f"{socket.gethostname()}_{os.getpid()}_{date_n_time}"
+            f"_{uuid.uuid4().hex[:6]}")
+
+
+def machine_info():
+    """Describes the machine and the numerical stack (for the benchmark
+    reports and the tuning cache)."""
+    return {
+        "node": platform.node(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": numba.__version__
+    }
+
+
 def delete_prev_runs_data():  # pragma: no cover
     """Deletes all the output files (log, dat, png etc) from previous runs."""
     input("Deleting data from previous runs. Press ENTER to continue...")
@@ -66,10 +92,24 @@ def delete_memmap():  # pragma: no cover
         print("Could not clean-up the memmap folder.")
 
 
+def config_snapshot():
+    """Returns a picklable copy of the configuration, to pass to workers."""
+    return {name: value for name, value in vars(conf).items()
+            if not name.startswith('_')
+            and not isinstance(value, types.ModuleType)}
+
+
+def restore_config(snapshot):
+    """Applies a configuration snapshot (used as a worker initializer)."""
+    for name, value in snapshot.items():
+        setattr(conf, name, value)
+
+
 def print_duration(start, end, process):
     """Prints the duration of a process."""
     process_name = {
         "main": "Total",
+        "_simulate": "Total",
         "simulate": "Solution",
         "animate": "Animating"
     }
@@ -185,7 +225,7 @@ def drop_iters_list():
     # # Overwrite max number of drops.
     # conf.MAX_N_DROPS = len(drop_iters)
 
-    if conf.SAVE_DS_FOR_ML:
+    if conf.SAVE_DS_FOR_ML and conf.DS_FORMAT == "memmap":
         # It is needed to retrieve the new drop frames, because these frames
         # cannot be used as labels (the previous frame cannot know when and
         # where a new drop will fall).